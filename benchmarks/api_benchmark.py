@@ -0,0 +1,152 @@
+# Copyright (c) 2014 Mortar Data
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+"""
+Measure the Mortar API overhead of submitting and polling MortarProjectTasks
+against the in-process fake Mortar API, at 1, 10 and 100 concurrent jobs.
+
+Each level is run two ways: one luigi worker thread per task, and all
+tasks from a single worker with `run_concurrently`. For each run it reports:
+
+* API calls per job
+* worker-seconds blocked: total time worker threads spent running tasks
+* completion-detection latency: time from a job finishing in the fake
+  API until its task noticed
+
+Usage: python benchmarks/api_benchmark.py [latency_seconds] [failure_rate]
+"""
+
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import luigi
+
+from mortar.luigi import clustercache
+from mortar.luigi.fakeapi import FakeMortarAPI
+from mortar.luigi.mortartask import MortarProjectTask, run_concurrently
+
+CONCURRENCY_LEVELS = [1, 10, 100]
+
+# jobs run for 3-6 seconds; new clusters take 2 seconds to start
+MIN_JOB_SECONDS = 3
+MAX_JOB_SECONDS = 6
+CLUSTER_START_SECONDS = 2
+
+_api = None
+_detected = {}
+_detected_lock = threading.Lock()
+
+class BenchmarkTask(MortarProjectTask):
+    token_dir = luigi.Parameter()
+    index = luigi.IntParameter()
+
+    def is_control_script(self):
+        return False
+
+    def project(self):
+        return 'benchmark'
+
+    def script(self):
+        return 'benchmark_script'
+
+    def script_output(self):
+        return []
+
+    def token_path(self):
+        return 'file://%s/%s' % (self.token_dir, self.index)
+
+    def _get_api(self):
+        return _api
+
+    def _finish_job(self, job_id, job):
+        with _detected_lock:
+            _detected[job_id] = time.time()
+        super(BenchmarkTask, self)._finish_job(job_id, job)
+
+def _tasks(token_dir, num_jobs):
+    return [BenchmarkTask(token_dir=token_dir, index=i, cluster_size=2, job_polling_interval=1,
+                          max_job_polling_interval=5, cluster_starting_polling_interval=2)
+            for i in range(num_jobs)]
+
+def _run_worker_per_job(tasks):
+    blocked = [0.0]
+    lock = threading.Lock()
+    def work(task):
+        start = time.time()
+        try:
+            task.run()
+        except Exception:
+            pass
+        with lock:
+            blocked[0] += time.time() - start
+    threads = [threading.Thread(target=work, args=(task,)) for task in tasks]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return blocked[0]
+
+def _run_single_worker(tasks):
+    start = time.time()
+    try:
+        run_concurrently(tasks)
+    except Exception:
+        pass
+    return time.time() - start
+
+def run(mode, num_jobs, latency, failure_rate):
+    global _api
+    rng = random.Random(num_jobs)
+    _api = FakeMortarAPI(latency=latency, failure_rate=failure_rate,
+                         job_duration=lambda: rng.uniform(MIN_JOB_SECONDS, MAX_JOB_SECONDS),
+                         cluster_start_seconds=CLUSTER_START_SECONDS, seed=num_jobs)
+    # half the jobs find an idle cluster, the rest start their own
+    for _ in range(num_jobs / 2):
+        _api.add_cluster(2)
+    clustercache.get_cluster_cache().invalidate()
+    _detected.clear()
+
+    token_dir = tempfile.mkdtemp()
+    try:
+        blocked = mode(_tasks(token_dir, num_jobs))
+    finally:
+        shutil.rmtree(token_dir)
+
+    latencies = [_detected[job_id] - job['end_time']
+                 for (job_id, job) in _api.jobs.items() if job_id in _detected]
+    return {
+        'calls_per_job': float(_api.total_calls()) / num_jobs,
+        'blocked': blocked,
+        'mean_latency': sum(latencies) / len(latencies) if latencies else float('nan'),
+        'max_latency': max(latencies) if latencies else float('nan'),
+        'finished': len(latencies),
+    }
+
+def main(latency, failure_rate):
+    print 'api latency: %ss, failure rate: %s' % (latency, failure_rate)
+    print '%-18s %5s %10s %16s %14s %14s %9s' % ('mode', 'jobs', 'calls/job', 'worker-s blocked',
+                                                  'mean detect s', 'max detect s', 'finished')
+    for num_jobs in CONCURRENCY_LEVELS:
+        for (name, mode) in [('worker per job', _run_worker_per_job), ('single worker', _run_single_worker)]:
+            result = run(mode, num_jobs, latency, failure_rate)
+            print '%-18s %5s %10.1f %16.1f %14.2f %14.2f %9s' % (name, num_jobs, result['calls_per_job'],
+                result['blocked'], result['mean_latency'], result['max_latency'], result['finished'])
+
+if __name__ == '__main__':
+    main(float(sys.argv[1]) if len(sys.argv) > 1 else 0.02,
+         float(sys.argv[2]) if len(sys.argv) > 2 else 0.01)
@@ -0,0 +1,85 @@
+# Copyright (c) 2014 Mortar Data
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+"""
+Measure the cold-start cost of importing each mortar.luigi module:
+the median time to import it in a fresh interpreter, and which heavy
+dependencies the import pulled in.
+
+Usage: python benchmarks/import_benchmark.py [num_trials]
+"""
+
+import json
+import os
+import subprocess
+import sys
+
+MODULES = [
+    'luigi',
+    'mortar.luigi.target_factory',
+    'mortar.luigi.mortartask',
+    'mortar.luigi.jobpoller',
+    'mortar.luigi.shellscript',
+    'mortar.luigi.s3transfer',
+    'mortar.luigi.dbms',
+    'mortar.luigi.mongodb',
+    'mortar.luigi.dynamodb',
+    'mortar.luigi.redshift',
+    'mortar.luigi.mortar_recsys_api',
+]
+
+HEAVY_DEPENDENCIES = ['boto', 'luigi.s3', 'requests', 'pymongo', 'mortar.api.v2']
+
+MEASURE = '''
+import json, sys, time
+start = time.time()
+import %s
+elapsed = time.time() - start
+print(json.dumps({'seconds': elapsed,
+                  'loaded': [m for m in %r if sys.modules.get(m) is not None]}))
+'''
+
+def measure(module):
+    """
+    Import a module in a fresh interpreter.
+
+    :rtype: dict:
+    :returns: seconds the import took and heavy dependencies loaded,
+              or None if the module could not be imported
+    """
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+    process = subprocess.Popen([sys.executable, '-c', MEASURE % (module, HEAVY_DEPENDENCIES)],
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env)
+    (out, _) = process.communicate()
+    if process.returncode != 0:
+        return None
+    return json.loads(out.strip().splitlines()[-1])
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) / 2]
+
+def main():
+    num_trials = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    print '%-32s %12s  %s' % ('module', 'median ms', 'heavy dependencies loaded')
+    for module in MODULES:
+        results = [measure(module) for _ in range(num_trials)]
+        if None in results:
+            print '%-32s %12s' % (module, 'unavailable')
+            continue
+        print '%-32s %12.1f  %s' % (module, 1000 * median([r['seconds'] for r in results]),
+                                    ', '.join(results[0]['loaded']) or '-')
+
+if __name__ == '__main__':
+    main()
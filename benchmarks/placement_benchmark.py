@@ -0,0 +1,63 @@
+# Copyright (c) 2014 Mortar Data
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+"""
+Compare the simulated makespan of cluster placement strategies
+on randomly generated waves of Mortar jobs.
+
+Usage: python benchmarks/placement_benchmark.py [num_trials]
+"""
+
+import random
+import sys
+
+from mortar.luigi import placement
+
+CLUSTER_SIZES = [20, 10, 5, 5, 3]
+
+STRATEGIES = [
+    ('largest', placement.LargestClusterStrategy()),
+    ('best-fit', placement.BestFitStrategy()),
+]
+
+def random_workload(rng, num_jobs=40, wave_seconds=300):
+    """
+    Mostly small jobs with a few large ones, submitted in one wave.
+    """
+    jobs = []
+    for _ in range(num_jobs):
+        cluster_size = rng.choice([2, 2, 2, 3, 5, 10, 20])
+        duration = rng.randint(300, 3600)
+        jobs.append((rng.randint(0, wave_seconds), cluster_size, duration))
+    return jobs
+
+def main(num_trials):
+    totals = dict((name, 0) for (name, _) in STRATEGIES)
+    wins = 0
+    for trial in range(num_trials):
+        jobs = random_workload(random.Random(trial))
+        makespans = dict((name, placement.simulate(strategy, CLUSTER_SIZES, jobs))
+                         for (name, strategy) in STRATEGIES)
+        for (name, makespan) in makespans.items():
+            totals[name] += makespan
+        if makespans['best-fit'] < makespans['largest']:
+            wins += 1
+
+    print 'clusters: %s, trials: %s' % (CLUSTER_SIZES, num_trials)
+    for (name, _) in STRATEGIES:
+        print '%-10s mean makespan: %8.0f s' % (name, float(totals[name]) / num_trials)
+    print 'best-fit shorter in %s/%s trials' % (wins, num_trials)
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100)
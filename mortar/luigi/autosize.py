@@ -0,0 +1,152 @@
+# Copyright (c) 2014 Mortar Data
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+import json
+import logging
+import math
+import os
+
+from mortar.luigi import lazyimport
+from mortar.luigi import target_factory
+
+s3 = lazyimport.LazyModule('luigi.s3')
+
+logger = logging.getLogger('luigi-interface')
+
+# Bytes of input each cluster node is assumed to handle
+# when there are too few past runs to fit the model.
+DEFAULT_BYTES_PER_NODE = 10 * 1024 ** 3
+
+
+def input_bytes(path, client=None):
+    """
+    Total size of the data at a path: the size of an S3 key, or the sum
+    of the sizes of every key under an S3 directory, found with a single
+    listing, or of every file under a local path.
+
+    :type path: str
+    :param path: s3 (or s3n) or file URL, or local path
+
+    :type client: :py:class:`luigi.s3.S3Client`
+    :param client: S3 client to list with. Default: a new client.
+
+    :rtype: int:
+    :returns: total bytes
+    """
+    if path.startswith(('s3://', 's3n://')):
+        client = client or s3.S3Client()
+        (bucket_name, key_name) = client._path_to_bucket_and_key(path)
+        bucket = client.s3.get_bucket(bucket_name, validate=False)
+        # the keys under the directory, not those of siblings sharing its name as a prefix
+        prefix = key_name.rstrip('/') + '/' if key_name.rstrip('/') else ''
+        keys = list(bucket.list(prefix=prefix))
+        if keys or not prefix:
+            return sum(key.size for key in keys)
+        key = bucket.get_key(key_name)
+        return key.size if key else 0
+    if path.startswith('file://'):
+        path = path[len('file://'):]
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    total = 0
+    for (dirpath, _, filenames) in os.walk(path):
+        total += sum(os.path.getsize(os.path.join(dirpath, f)) for f in filenames)
+    return total
+
+
+def _median(values):
+    values = sorted(values)
+    middle = len(values) / 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+class ClusterSizeModel(object):
+    """
+    Chooses a cluster size from the bytes of input a job reads.
+
+    Each node is assumed to handle `bytes_per_node` bytes in
+    `target_seconds`. Once enough past runs are recorded, `bytes_per_node`
+    is instead fitted from them: the median bytes each node processed per
+    second, times `target_seconds`.
+    """
+
+    def __init__(self, bytes_per_node=DEFAULT_BYTES_PER_NODE, target_seconds=3600,
+                 runs=None, min_runs=3, max_runs=20):
+        """
+        :type bytes_per_node: int
+        :param bytes_per_node: bytes each node handles, until fitted from past runs
+
+        :type target_seconds: int
+        :param target_seconds: how long jobs should take
+
+        :type runs: list
+        :param runs: (input bytes, cluster size, seconds) of each past run
+
+        :type min_runs: int
+        :param min_runs: number of past runs needed to fit the model
+
+        :type max_runs: int
+        :param max_runs: number of most recent runs to keep
+        """
+        self.bytes_per_node = bytes_per_node
+        self.target_seconds = target_seconds
+        self.runs = runs or []
+        self.min_runs = min_runs
+        self.max_runs = max_runs
+
+    @classmethod
+    def load(cls, target, **kwargs):
+        """
+        Load the past runs saved at a target into a new model.
+
+        :rtype: :py:class:`ClusterSizeModel`:
+        :returns: model including the saved runs
+        """
+        if not target.exists():
+            return cls(**kwargs)
+        try:
+            runs = json.loads(target.open('r').read())['runs']
+        except (ValueError, KeyError) as e:
+            logger.warning('Ignoring unreadable sizing history at %s: %s' % (target.path, e))
+            runs = []
+        return cls(runs=[tuple(run) for run in runs], **kwargs)
+
+    def save(self, target):
+        target_factory.write_file(target, text=json.dumps({'runs': self.runs}))
+
+    def add_run(self, input_bytes, cluster_size, seconds):
+        if cluster_size > 0 and seconds > 0:
+            self.runs = (self.runs + [(input_bytes, cluster_size, seconds)])[-self.max_runs:]
+
+    def fitted_bytes_per_node(self):
+        """
+        :rtype: float:
+        :returns: bytes each node is expected to handle in `target_seconds`
+        """
+        if len(self.runs) < self.min_runs:
+            return self.bytes_per_node
+        throughput = _median([float(b) / (size * seconds) for (b, size, seconds) in self.runs])
+        return throughput * self.target_seconds or self.bytes_per_node
+
+    def cluster_size(self, input_bytes, min_size=2, max_size=None):
+        """
+        :rtype: int:
+        :returns: number of nodes for a job reading `input_bytes`
+        """
+        size = max(min_size, int(math.ceil(float(input_bytes) / self.fitted_bytes_per_node())))
+        if max_size is not None:
+            size = min(max_size, size)
+        return size
@@ -0,0 +1,207 @@
+# Copyright (c) 2014 Mortar Data
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+import hashlib
+import logging
+import os
+import re
+import threading
+
+logger = logging.getLogger('luigi-interface')
+
+# S3 metadata field recording the part size an object was uploaded
+# with, which is needed to compute its multipart ETag from local data
+PART_SIZE_METADATA = 'part-size'
+
+# Size of each read when hashing a local file
+READ_SIZE = 1024 ** 2
+
+# ETag of an object uploaded in one request: the MD5 of its content.
+# ETag of a multipart upload: the MD5 of its parts' MD5s, then the part count.
+_MD5_ETAG = re.compile(r'^"?([0-9a-f]{32})(?:-(\d+))?"?$')
+
+
+def parse_etag(etag):
+    """
+    :rtype: tuple:
+    :returns: (MD5 hex digest, number of parts or None for an object
+              uploaded in one request), or None if the ETag is not
+              MD5-based, e.g. for objects encrypted with SSE-KMS
+    """
+    match = _MD5_ETAG.match(etag or '')
+    if not match:
+        return None
+    return (match.group(1), int(match.group(2)) if match.group(2) else None)
+
+def num_parts(size, part_size):
+    """
+    :rtype: int:
+    :returns: number of parts of `part_size` holding `size` bytes
+    """
+    return max(1, (size + part_size - 1) / part_size)
+
+def etag_part_size(key, default_part_size):
+    """
+    Find the part size an S3 object was uploaded with, so its ETag can
+    be computed from local data with :py:class:`PartHasher`.
+
+    :type key: :py:class:`boto.s3.key.Key`
+    :param key: S3 object
+
+    :type default_part_size: int
+    :param default_part_size: part size to assume for a multipart upload
+                              that did not record its part size
+
+    :rtype: tuple:
+    :returns: (part size or 0 for an object uploaded in one request,
+              whether the part size was recorded rather than assumed),
+              or None if the ETag cannot be computed from local data
+    """
+    parsed = parse_etag(key.etag)
+    if parsed is None:
+        return None
+    (_, parts) = parsed
+    if parts is None:
+        return (0, True)
+    recorded = (key.metadata or {}).get(PART_SIZE_METADATA)
+    if recorded and recorded.isdigit() and num_parts(key.size, int(recorded)) == parts:
+        return (int(recorded), True)
+    if num_parts(key.size, default_part_size) == parts:
+        return (default_part_size, False)
+    return None
+
+
+class PartHasher(object):
+    """
+    Computes the ETag S3 assigns an object from its content, fed
+    incrementally in order.
+    """
+
+    def __init__(self, part_size=0):
+        """
+        :type part_size: int
+        :param part_size: size of each part of a multipart upload, or 0
+                          for an object uploaded in one request
+        """
+        self.part_size = part_size
+        self.digests = []
+        self._md5 = hashlib.md5()
+        self._filled = 0
+
+    def update(self, data):
+        if not self.part_size:
+            self._md5.update(data)
+            return
+        view = buffer(data)
+        while view:
+            chunk = view[:self.part_size - self._filled]
+            self._md5.update(chunk)
+            self._filled += len(chunk)
+            view = view[len(chunk):]
+            if self._filled == self.part_size:
+                self.add_part(self._md5.digest())
+                self._md5 = hashlib.md5()
+                self._filled = 0
+
+    def add_part(self, digest):
+        """
+        Add the MD5 digest of a whole part, hashed elsewhere.
+        """
+        self.digests.append(digest)
+
+    def etag(self):
+        """
+        :rtype: str:
+        :returns: ETag of the content fed so far, quoted as S3 returns it
+        """
+        if not self.part_size:
+            return '"%s"' % self._md5.hexdigest()
+        digests = self.digests + ([self._md5.digest()] if self._filled else [])
+        return multipart_etag(digests)
+
+
+def multipart_etag(digests):
+    """
+    :type digests: list of str
+    :param digests: MD5 digest of each part, in order
+
+    :rtype: str:
+    :returns: ETag of a multipart upload of the parts
+    """
+    return '"%s-%d"' % (hashlib.md5(''.join(digests)).hexdigest(), len(digests))
+
+def etags_equal(etag, other):
+    return (etag or '').strip('"') == (other or '').strip('"')
+
+
+_file_etags = {}
+_file_etags_lock = threading.Lock()
+
+def file_etag(path, part_size=0):
+    """
+    Compute the ETag S3 would assign a local file uploaded with the given
+    part size. Results are remembered for the file's inode, size and
+    modification time, so a file is read at most once while unchanged.
+
+    :rtype: str:
+    :returns: ETag of the file
+    """
+    stat = os.stat(path)
+    with _file_etags_lock:
+        etag = _file_etags.get(_file_etag_key(path, stat, part_size))
+    if etag is None:
+        hasher = PartHasher(part_size)
+        with open(path, 'rb') as f:
+            for data in iter(lambda: f.read(READ_SIZE), ''):
+                hasher.update(data)
+        etag = hasher.etag()
+        remember_file_etag(path, part_size, etag, stat)
+    return etag
+
+def remember_file_etag(path, part_size, etag, stat=None):
+    """
+    Record the ETag of a local file whose content was hashed while
+    transferring it, so :py:func:`file_etag` need not read it again.
+
+    :type stat: posix.stat_result
+    :param stat: status of the file when it was hashed. Default: its status now.
+    """
+    cache_key = _file_etag_key(path, stat or os.stat(path), part_size)
+    with _file_etags_lock:
+        if len(_file_etags) > 10000:
+            _file_etags.clear()
+        _file_etags[cache_key] = etag
+
+def _file_etag_key(path, stat, part_size):
+    return (os.path.abspath(path), stat.st_ino, stat.st_size, stat.st_mtime, part_size)
+
+def file_matches_key(path, key, default_part_size):
+    """
+    Whether a local file has the same content as an S3 object, judged
+    by size and then ETag. If the ETag can't be computed from local data
+    (SSE-KMS encryption, or parts of an unrecorded size other than
+    `default_part_size`), a file of the same size is taken to match.
+
+    :rtype: bool:
+    :returns: True if the contents match, or are assumed to
+    """
+    if not os.path.isfile(path) or os.path.getsize(path) != key.size:
+        return False
+    layout = etag_part_size(key, default_part_size)
+    if layout is not None and etags_equal(file_etag(path, layout[0]), key.etag):
+        return True
+    if layout is not None and layout[1]:
+        return False
+    logger.debug('Unable to compute the ETag of %s from %s: matched by size only' % (key.name, path))
+    return True
@@ -0,0 +1,107 @@
+# Copyright (c) 2014 Mortar Data
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+import logging
+import threading
+from multiprocessing.pool import ThreadPool
+
+from mortar.luigi import lazyimport
+
+logger = logging.getLogger('luigi-interface')
+
+# Maximum number of keys S3 deletes in one multi-object delete request
+S3_DELETE_BATCH_SIZE = 1000
+
+# Default number of targets removed at once
+DEFAULT_CLEANUP_THREADS = 8
+
+
+def remove_s3_prefix(client, path, batch_size=S3_DELETE_BATCH_SIZE):
+    """
+    Remove an S3 file, or every key under an S3 directory, listing the
+    keys once and deleting them with multi-object delete requests.
+
+    :type client: :py:class:`luigi.s3.S3Client`
+    :param client: S3 client
+
+    :type path: str
+    :param path: S3 path of the file or directory to remove
+
+    :rtype: int:
+    :returns: number of keys removed
+    """
+    (bucket_name, key) = client._path_to_bucket_and_key(path)
+    if not key.strip('/'):
+        raise RuntimeError('Cannot remove the root of bucket at path %s' % path)
+    directory = key if key.endswith('/') else key + '/'
+    bucket = client.s3.get_bucket(bucket_name, validate=False)
+    keys = [k.key for k in bucket.list(prefix=key) if k.key == key or k.key.startswith(directory)]
+    for start in range(0, len(keys), batch_size):
+        result = bucket.delete_keys(keys[start:start + batch_size], quiet=True)
+        if result.errors:
+            raise IOError('Failed to delete %s keys under %s, e.g. %s: %s' % \
+                (len(result.errors), path, result.errors[0].key, result.errors[0].message))
+    logger.debug('Removed %s keys under %s' % (len(keys), path))
+    return len(keys)
+
+def remove_target(target):
+    """
+    Remove a target. S3 targets are removed with batched deletes.
+    """
+    if lazyimport.is_instance(target, 'luigi.s3', 'S3Target'):
+        remove_s3_prefix(target.fs, target.path)
+    else:
+        target.remove()
+
+def remove_targets(targets, max_threads=DEFAULT_CLEANUP_THREADS):
+    """
+    Remove several targets, up to `max_threads` at once. Every target is
+    attempted; failures are logged and returned rather than raised.
+
+    :type targets: list of Target
+    :param targets: targets to remove
+
+    :type max_threads: int
+    :param max_threads: maximum number of targets being removed at once
+
+    :rtype: list of tuple:
+    :returns: (target, exception) for each target that could not be removed
+    """
+    def remove(target):
+        try:
+            remove_target(target)
+        except Exception as e:
+            logger.exception('Failed to remove %s' % target)
+            return (target, e)
+
+    if not targets:
+        return []
+    pool = ThreadPool(max(1, min(max_threads, len(targets))))
+    try:
+        return [f for f in pool.map(remove, targets) if f]
+    finally:
+        pool.close()
+
+def remove_targets_in_background(targets, max_threads=DEFAULT_CLEANUP_THREADS):
+    """
+    Start removing targets on a background thread. The thread is not a
+    daemon, so the process does not exit until the targets are removed.
+
+    :rtype: threading.Thread:
+    :returns: the thread removing the targets
+    """
+    thread = threading.Thread(target=remove_targets, args=(targets, max_threads),
+                              name='mortar-output-cleanup')
+    thread.start()
+    return thread
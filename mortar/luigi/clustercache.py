@@ -0,0 +1,209 @@
+# Copyright (c) 2014 Mortar Data
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+import copy
+import logging
+import os
+import threading
+import time
+
+from mortar.luigi import lazyimport
+
+clusters = lazyimport.LazyModule('mortar.api.v2.clusters')
+
+logger = logging.getLogger('luigi-interface')
+
+
+def _account_key(api):
+    """
+    Identify the Mortar account an API talks to, so that
+    API instances for the same account share cached clusters.
+    """
+    auth = getattr(api, 'auth', None)
+    return (getattr(api, 'host', None), getattr(auth, 'username', None))
+
+
+class ClusterCache(object):
+    """
+    Process-wide, short-lived cache of the clusters returned by
+    `clusters.get_clusters`.
+
+    Jobs submitted from this process are recorded against their cluster
+    as soon as they are placed, so concurrent submitters see each other's
+    placements without another API round trip. Use :py:func:`get_cluster_cache`
+    to get the shared instance rather than constructing one directly.
+    """
+
+    def __init__(self):
+        # held while choosing a cluster and recording the choice, so that
+        # two submitters can't both claim the same idle cluster
+        self.lock = threading.RLock()
+        self._entries = {}
+        self._job_demands = {}
+        self._last_busy = {}
+        self.hits = 0
+        self.misses = 0
+        self.pid = os.getpid()
+
+    def get_clusters(self, api, ttl):
+        """
+        Get the account's clusters, fetching them from the API if the
+        cached copy is older than `ttl` seconds.
+
+        Callers must not modify the returned clusters.
+
+        :type api: :class:`mortar.api.v2.api.API`
+        :param api: API
+
+        :type ttl: int
+        :param ttl: maximum age in seconds of cached clusters to accept
+
+        :rtype: list of dict:
+        :returns: cluster details, including jobs recorded by this process
+        """
+        key = _account_key(api)
+        with self.lock:
+            entry = self._entries.get(key)
+            if entry and (time.time() - entry[0]) < ttl:
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            cluster_list = copy.deepcopy(clusters.get_clusters(api)['clusters'])
+            self._entries[key] = (time.time(), cluster_list)
+            self._prune_job_demands()
+            self._record_busy(cluster_list)
+            return cluster_list
+
+    def record_job(self, api, cluster_id, job_id, demand=None):
+        """
+        Record that a job was placed on a cluster, so that cached
+        copies show it as running there.
+
+        :type api: :class:`mortar.api.v2.api.API`
+        :param api: API the job was submitted through
+
+        :type cluster_id: str
+        :param cluster_id: cluster the job was placed on
+
+        :type job_id: str
+        :param job_id: ID of the placed job
+
+        :type demand: :py:class:`mortar.luigi.placement.JobDemand`
+        :param demand: slots needed by the job, if known
+        """
+        with self.lock:
+            if demand:
+                self._job_demands[job_id] = demand
+            self._last_busy[cluster_id] = time.time()
+            for cluster in self._cached_clusters(api):
+                if cluster.get('cluster_id') == cluster_id:
+                    running_jobs = cluster.get('running_jobs') or []
+                    if job_id not in running_jobs:
+                        cluster['running_jobs'] = running_jobs + [job_id]
+
+    def forget_job(self, api, cluster_id, job_id):
+        """
+        Remove a job recorded with :py:meth:`record_job`, e.g. when its
+        submission failed.
+        """
+        with self.lock:
+            self._job_demands.pop(job_id, None)
+            for cluster in self._cached_clusters(api):
+                if cluster.get('cluster_id') == cluster_id:
+                    cluster['running_jobs'] = \
+                        [j for j in (cluster.get('running_jobs') or []) if j != job_id]
+
+    def record_job_finished(self, cluster_id):
+        """
+        Record that a job running on a cluster has just finished, so that
+        the cluster's idle time is counted from now.
+
+        :type cluster_id: str
+        :param cluster_id: cluster the job ran on
+        """
+        with self.lock:
+            self._last_busy[cluster_id] = time.time()
+
+    def job_demands(self):
+        """
+        :rtype: dict:
+        :returns: slots needed by jobs recorded with a demand, by job_id
+        """
+        with self.lock:
+            return dict(self._job_demands)
+
+    def last_busy(self, cluster_id):
+        """
+        :rtype: float:
+        :returns: last time this process saw a job running on the cluster,
+                  or None if it never has
+        """
+        with self.lock:
+            return self._last_busy.get(cluster_id)
+
+    def invalidate(self, api=None):
+        """
+        Drop cached clusters for one account, or for all accounts
+        if no API is given.
+        """
+        with self.lock:
+            if api is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(_account_key(api), None)
+
+    def stats(self):
+        """
+        :rtype: dict:
+        :returns: cache hit and miss counts
+        """
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses}
+
+    def _prune_job_demands(self):
+        # forget demands of jobs no longer running on any cached cluster
+        running = set()
+        for (_, cluster_list) in self._entries.values():
+            for cluster in cluster_list:
+                running.update(cluster.get('running_jobs') or [])
+        for job_id in self._job_demands.keys():
+            if job_id not in running:
+                del self._job_demands[job_id]
+
+    def _record_busy(self, cluster_list):
+        now = time.time()
+        for cluster in cluster_list:
+            if cluster.get('running_jobs'):
+                self._last_busy[cluster.get('cluster_id')] = now
+
+    def _cached_clusters(self, api):
+        entry = self._entries.get(_account_key(api))
+        return entry[1] if entry else []
+
+
+_cluster_cache = None
+_cluster_cache_lock = threading.Lock()
+
+def get_cluster_cache():
+    """
+    Get the shared :py:class:`ClusterCache` for this process.
+
+    :rtype: :py:class:`ClusterCache`:
+    :returns: the process-wide cluster cache
+    """
+    global _cluster_cache
+    with _cluster_cache_lock:
+        if _cluster_cache is None or _cluster_cache.pid != os.getpid():
+            _cluster_cache = ClusterCache()
+        return _cluster_cache
@@ -0,0 +1,84 @@
+# Copyright (c) 2014 Mortar Data
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+from luigi import format
+
+# Value of a compression option that turns off compression,
+# even for a path with a compression suffix
+NO_COMPRESSION = 'none'
+
+
+class Zstd(format.Format):
+    """
+    Zstandard compression, streamed through the zstd command-line tool.
+    """
+
+    @classmethod
+    def pipe_reader(cls, input_pipe):
+        return format.InputPipeProcessWrapper(['zstd', '-d', '-c', '-q'], input_pipe)
+
+    @classmethod
+    def pipe_writer(cls, output_pipe):
+        return format.OutputPipeProcessWrapper(['zstd', '-c', '-q'], output_pipe)
+
+
+# compression name -> luigi Format that streams it
+FORMATS = {
+    'gzip': format.Gzip,
+    'bzip2': format.Bzip2,
+    'zstd': Zstd,
+}
+
+# path suffix -> compression name
+SUFFIXES = {
+    '.gz': 'gzip',
+    '.bz2': 'bzip2',
+    '.zst': 'zstd',
+}
+
+
+def compression_for(path, compression=None):
+    """
+    Choose how the data at a path is compressed.
+
+    :type path: str
+    :param path: path of the data
+
+    :type compression: str
+    :param compression: gzip, bzip2, zstd or none. Default: chosen
+                        from the path's suffix, e.g. .gz for gzip.
+
+    :rtype: str:
+    :returns: compression name, or None for uncompressed data
+    """
+    if compression == NO_COMPRESSION:
+        return None
+    if compression:
+        if compression not in FORMATS:
+            raise RuntimeError('Unknown compression %s; expected one of %s' % \
+                (compression, ', '.join(sorted(FORMATS.keys() + [NO_COMPRESSION]))))
+        return compression
+    for (suffix, name) in SUFFIXES.items():
+        if path.endswith(suffix):
+            return name
+    return None
+
+def get_format(path, compression=None):
+    """
+    :rtype: :py:class:`luigi.format.Format`:
+    :returns: format that streams the compression chosen by
+              :py:func:`compression_for`, or None for uncompressed data
+    """
+    name = compression_for(path, compression)
+    return FORMATS[name] if name else None
@@ -426,8 +426,15 @@ class ExtractFromMySQL(luigi.Task):
 
     # Output location for the extracted data.
     # Example: s3://my-path/my-output-path
+    #
+    # Output paths ending in .gz, .bz2 or .zst are compressed
+    # as the data is extracted.
     output_path = luigi.Parameter()
 
+    # Compression for the extracted data: gzip, bzip2, zstd or none.
+    # Default: chosen from the output_path suffix.
+    compression = luigi.Parameter(default=None)
+
     # The mysql CLI exports the string "NULL" whenever a field
     # is NULL. If replace_null_with_blank is true, any occurrrence of
     # the string "NULL" in the extract will be replaced with a
@@ -458,7 +465,7 @@ class ExtractFromMySQL(luigi.Task):
         Tell Luigi about the output that this Task produces.
         If that output already exists, Luigi will not rerun it.
         """
-        return [target_factory.get_target(self.output_path)]
+        return [target_factory.get_target(self.output_path, compression=self.compression)]
 
     def run(self):
         config = luigi.configuration.get_config()
@@ -497,7 +504,8 @@ class ExtractFromMySQL(luigi.Task):
             raw_option=raw_option,
             dbname=dbname)
 
-        # open up the target output to store data
+        # open up the target output to store data; mysql writes
+        # straight into it, through the compressor if there is one
         output_data_file = self.output()[0].open('w')
         logger.info('Extracting data from MySQL with command: %s' % cmd_printable)
         output = subprocess.Popen(
@@ -0,0 +1,248 @@
+# Copyright (c) 2014 Mortar Data
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+import random
+import threading
+import time
+
+from requests.exceptions import HTTPError
+
+from mortar.api.v2 import clusters
+from mortar.api.v2 import jobs
+
+
+class _Auth(object):
+    def __init__(self, username):
+        self.username = username
+
+
+class FakeMortarAPI(object):
+    """
+    In-process stand-in for the Mortar v2 API, for testing and benchmarking
+    tasks without the real service. Supports the `jobs` and `clusters`
+    endpoints used by `mortar.api.v2.jobs` and `mortar.api.v2.clusters`:
+    posting jobs to new or existing clusters, getting and stopping a job,
+    listing clusters and stopping a cluster. Stopping a job with
+    DELETE jobs/<job_id> is not part of the v2 client; pass
+    `stop_jobs=False` to reject it with a 404, as an API without it would.
+
+    Jobs progress in real time (or on the given `clock`): a job on a new
+    cluster waits `cluster_start_seconds` for the cluster to start, then
+    runs for its duration and succeeds, or fails with probability
+    `job_failure_rate`. Every call takes `latency` seconds and fails
+    with probability `failure_rate`, raising an HTTPError.
+
+    Calls made are counted by method and resource in `calls`.
+    """
+
+    def __init__(self, latency=0.0, failure_rate=0.0, job_duration=60.0, cluster_start_seconds=0.0,
+                 job_failure_rate=0.0, seed=None, clock=time.time, host='fake.mortardata.com',
+                 email='fake@mortardata.com', stop_jobs=True):
+        """
+        :type latency: float
+        :param latency: seconds each call takes
+
+        :type failure_rate: float
+        :param failure_rate: probability that a call fails
+
+        :type job_duration: float or function
+        :param job_duration: seconds each job runs, or a function returning them
+
+        :type cluster_start_seconds: float
+        :param cluster_start_seconds: seconds a new cluster takes to start
+
+        :type job_failure_rate: float
+        :param job_failure_rate: probability that a job fails
+
+        :type seed: int
+        :param seed: seed for the random failures
+
+        :type clock: function
+        :param clock: returns the current time in seconds
+
+        :type stop_jobs: bool
+        :param stop_jobs: whether DELETE jobs/<job_id> stops the job
+        """
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.job_duration = job_duration
+        self.cluster_start_seconds = cluster_start_seconds
+        self.job_failure_rate = job_failure_rate
+        self.clock = clock
+        self.stop_jobs = stop_jobs
+        self.host = host
+        self.auth = _Auth(email)
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.jobs = {}
+        self.clusters = {}
+
+    def add_cluster(self, size, cluster_type=clusters.CLUSTER_TYPE_PERSISTENT):
+        """
+        Add a running cluster.
+
+        :rtype: str:
+        :returns: cluster_id of the new cluster
+        """
+        with self.lock:
+            return self._new_cluster(size, cluster_type, self.clock())
+
+    def total_calls(self):
+        """
+        :rtype: int:
+        :returns: number of calls made to the API
+        """
+        with self.lock:
+            return sum(self.calls.values())
+
+    def get(self, path, params=None):
+        self._call('GET', path)
+        resource = path.split('/')
+        with self.lock:
+            now = self.clock()
+            if resource == ['clusters']:
+                return {'clusters': [self._cluster_details(c, now) for c in self.clusters.values()]}
+            if resource[0] == 'jobs' and len(resource) == 2:
+                job = self.jobs.get(resource[1])
+                if not job:
+                    raise HTTPError('404 Client Error: job %s not found' % resource[1])
+                return self._job_details(job, now)
+        raise HTTPError('404 Client Error: %s not supported' % path)
+
+    def post(self, path, payload):
+        self._call('POST', path)
+        if path != 'jobs':
+            raise HTTPError('404 Client Error: %s not supported' % path)
+        with self.lock:
+            now = self.clock()
+            cluster_id = payload.get('cluster_id')
+            if cluster_id == clusters.LOCAL_CLUSTER_ID:
+                ready_time = now
+            elif cluster_id:
+                cluster = self.clusters.get(cluster_id)
+                if not cluster or self._cluster_status(cluster, now) != clusters.CLUSTER_STATUS_RUNNING:
+                    raise HTTPError('400 Client Error: cluster %s is not running' % cluster_id)
+                ready_time = now
+            else:
+                cluster_id = self._new_cluster(payload['cluster_size'], payload.get('cluster_type'),
+                                               now + self.cluster_start_seconds)
+                ready_time = self.clusters[cluster_id]['ready_time']
+            duration = self.job_duration() if callable(self.job_duration) else self.job_duration
+            job_id = 'job-%s' % (len(self.jobs) + 1)
+            self.jobs[job_id] = {
+                'job_id': job_id,
+                'cluster_id': cluster_id,
+                'new_cluster': ready_time > now,
+                'start_time': ready_time,
+                'end_time': ready_time + duration,
+                'failed': self.random.random() < self.job_failure_rate,
+                'parameters': payload.get('parameters'),
+            }
+            if cluster_id in self.clusters:
+                self.clusters[cluster_id]['job_ids'].append(job_id)
+            return {'job_id': job_id}
+
+    def put(self, path, payload):
+        self._call('PUT', path)
+        raise HTTPError('404 Client Error: %s not supported' % path)
+
+    def delete(self, path):
+        self._call('DELETE', path)
+        resource = path.split('/')
+        with self.lock:
+            if resource[0] == 'clusters' and len(resource) == 2 and resource[1] in self.clusters:
+                self.clusters[resource[1]]['stopped'] = True
+                return
+            if resource[0] == 'jobs' and len(resource) == 2 and resource[1] in self.jobs and self.stop_jobs:
+                job = self.jobs[resource[1]]
+                job['stopped'] = True
+                job['end_time'] = min(job['end_time'], self.clock())
+                return
+        raise HTTPError('404 Client Error: %s not found' % path)
+
+    def _call(self, method, path):
+        key = '%s %s' % (method, path.split('/')[0])
+        with self.lock:
+            self.calls[key] = self.calls.get(key, 0) + 1
+            failed = self.random.random() < self.failure_rate
+        if self.latency:
+            time.sleep(self.latency)
+        if failed:
+            raise HTTPError('503 Server Error: fake failure')
+
+    def _new_cluster(self, size, cluster_type, ready_time):
+        cluster_id = 'cluster-%s' % (len(self.clusters) + 1)
+        self.clusters[cluster_id] = {
+            'cluster_id': cluster_id,
+            'size': size,
+            'cluster_type_code': cluster_type or clusters.CLUSTER_TYPE_PERSISTENT,
+            'start_timestamp': self.clock(),
+            'ready_time': ready_time,
+            'job_ids': [],
+            'stopped': False,
+        }
+        return cluster_id
+
+    def _running_job_ids(self, cluster, now):
+        return [job_id for job_id in cluster['job_ids'] if self.jobs[job_id]['end_time'] > now]
+
+    def _cluster_status(self, cluster, now):
+        if cluster['stopped']:
+            return clusters.CLUSTER_STATUS_DESTROYED
+        if now < cluster['ready_time']:
+            return clusters.CLUSTER_STATUS_STARTING
+        if cluster['cluster_type_code'] == clusters.CLUSTER_TYPE_SINGLE_JOB \
+                and cluster['job_ids'] and not self._running_job_ids(cluster, now):
+            return clusters.CLUSTER_STATUS_DESTROYED
+        return clusters.CLUSTER_STATUS_RUNNING
+
+    def _cluster_details(self, cluster, now):
+        status = self._cluster_status(cluster, now)
+        return {
+            'cluster_id': cluster['cluster_id'],
+            'size': cluster['size'],
+            'cluster_type_code': cluster['cluster_type_code'],
+            'status_code': status,
+            'status_description': status,
+            'start_timestamp': cluster['start_timestamp'],
+            'running_jobs': self._running_job_ids(cluster, now)
+                if status == clusters.CLUSTER_STATUS_RUNNING else [],
+        }
+
+    def _job_details(self, job, now):
+        progress = 0
+        if now < job['start_time']:
+            status = jobs.STATUS_STARTING_CLUSTER if job['new_cluster'] else jobs.STATUS_STARTING
+        elif now < job['end_time']:
+            status = jobs.STATUS_RUNNING
+            progress = int(100 * (now - job['start_time']) / (job['end_time'] - job['start_time']))
+        elif job.get('stopped'):
+            status = jobs.STATUS_STOPPED
+        elif job['failed']:
+            status = jobs.STATUS_EXECUTION_ERROR
+            progress = 100
+        else:
+            status = jobs.STATUS_SUCCESS
+            progress = 100
+        details = {
+            'job_id': job['job_id'],
+            'cluster_id': job['cluster_id'],
+            'status_code': status,
+            'status_description': status,
+            'progress': progress,
+        }
+        if status == jobs.STATUS_EXECUTION_ERROR:
+            details['error'] = {'message': 'fake job failure'}
+        return details
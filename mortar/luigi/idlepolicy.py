@@ -0,0 +1,131 @@
+# Copyright (c) 2014 Mortar Data
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+import calendar
+import logging
+import time
+
+logger = logging.getLogger('luigi-interface')
+
+# Assumed hourly cost (in dollars) of one cluster node, used
+# when enforcing a cost ceiling.
+DEFAULT_NODE_HOURLY_COST = 0.35
+
+
+def parse_timestamp(value):
+    """
+    Parse a timestamp from Mortar API cluster details: either seconds
+    since the epoch or an ISO 8601 UTC string, e.g. 2014-03-10T18:43:07.
+
+    :rtype: float:
+    :returns: seconds since the epoch, or None if the value can't be parsed
+    """
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        pass
+    try:
+        return float(calendar.timegm(time.strptime(str(value)[:19], '%Y-%m-%dT%H:%M:%S')))
+    except ValueError:
+        return None
+
+
+class IdleClusterPolicy(object):
+    """
+    Decides which idle clusters to stop.
+
+    An idle cluster is stopped once it has been idle for at least
+    `min_idle_seconds`, unless it is one of the `keep_warm` clusters kept
+    for its size. When the running clusters cost more than `max_hourly_cost`,
+    idle clusters are stopped regardless, longest idle first, until the
+    cost is back under the ceiling.
+
+    With the defaults, every idle cluster is stopped.
+    """
+
+    def __init__(self, min_idle_seconds=0, keep_warm=None, max_hourly_cost=None,
+                 node_hourly_cost=DEFAULT_NODE_HOURLY_COST):
+        """
+        :type min_idle_seconds: int
+        :param min_idle_seconds: how long a cluster must be idle before it is stopped
+
+        :type keep_warm: dict
+        :param keep_warm: number of idle clusters to keep running, by cluster size
+
+        :type max_hourly_cost: float
+        :param max_hourly_cost: ceiling on the hourly cost of all running clusters,
+                                or None for no ceiling
+
+        :type node_hourly_cost: float
+        :param node_hourly_cost: hourly cost of one cluster node
+        """
+        self.min_idle_seconds = min_idle_seconds
+        self.keep_warm = keep_warm or {}
+        self.max_hourly_cost = max_hourly_cost
+        self.node_hourly_cost = node_hourly_cost
+
+    def clusters_to_stop(self, running_clusters, idle_since, now=None):
+        """
+        Choose the idle clusters to stop.
+
+        :type running_clusters: list of dict
+        :param running_clusters: details of every running cluster, busy or idle
+
+        :type idle_since: function
+        :param idle_since: returns the time a cluster became idle, or None if unknown.
+                           Clusters idle for an unknown time are treated as idle
+                           for longer than any minimum.
+
+        :rtype: list of dict:
+        :returns: clusters to stop, longest idle first
+        """
+        now = time.time() if now is None else now
+        idle = [c for c in running_clusters if not c.get('running_jobs')]
+        idle_seconds = {}
+        for c in idle:
+            since = idle_since(c)
+            idle_seconds[c.get('cluster_id')] = float('inf') if since is None else now - since
+        # longest idle first, so the most recently used clusters stay warm
+        idle.sort(key=lambda c: idle_seconds[c.get('cluster_id')], reverse=True)
+
+        kept_warm = set()
+        for (size, count) in self.keep_warm.items():
+            of_size = [c for c in idle if int(c.get('size')) == int(size)]
+            if count > 0:
+                kept_warm.update(c.get('cluster_id') for c in of_size[-count:])
+
+        to_stop = [c for c in idle
+                   if idle_seconds[c.get('cluster_id')] >= self.min_idle_seconds
+                   and c.get('cluster_id') not in kept_warm]
+
+        if self.max_hourly_cost is not None:
+            stopping = set(c.get('cluster_id') for c in to_stop)
+            cost = sum(self._hourly_cost(c) for c in running_clusters
+                       if c.get('cluster_id') not in stopping)
+            for c in idle:
+                if cost <= self.max_hourly_cost:
+                    break
+                if c.get('cluster_id') not in stopping:
+                    logger.info('Running clusters cost %.2f/hour, over the ceiling of %.2f/hour' % \
+                        (cost, self.max_hourly_cost))
+                    to_stop.append(c)
+                    stopping.add(c.get('cluster_id'))
+                    cost -= self._hourly_cost(c)
+            to_stop.sort(key=lambda c: idle_seconds[c.get('cluster_id')], reverse=True)
+        return to_stop
+
+    def _hourly_cost(self, cluster):
+        return int(cluster.get('size')) * self.node_hourly_cost
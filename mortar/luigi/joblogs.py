@@ -0,0 +1,270 @@
+# Copyright (c) 2014 Mortar Data
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+import abc
+import datetime
+import logging
+import re
+import time
+
+from mortar.luigi import lazyimport
+
+requests = lazyimport.LazyModule('requests')
+
+logger = logging.getLogger('luigi-interface')
+
+# e.g. 2014-03-10 18:43:07,123 [main] INFO  org.apache.pig...MapReduceLauncher - HadoopJobId: job_201403101843_0001
+_LOG_LINE = re.compile(r'^(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2})')
+_ALIASES = re.compile(r'Processing aliases (\S+)')
+_HADOOP_JOB_ID = re.compile(r'HadoopJobId: (job_\S+)')
+_JOB_STATS_HEADER = 'Job Stats (time in seconds):'
+
+# columns of the Pig Job Stats table that hold times, in seconds
+_JOB_STATS_TIMES = {
+    'MaxMapTime': 'max_map_seconds',
+    'AvgMapTime': 'avg_map_seconds',
+    'MaxReduceTime': 'max_reduce_seconds',
+    'AvgReduceTime': 'avg_reduce_seconds',
+}
+
+
+class LogSource(object):
+    """
+    Superclass for places the log of a Mortar job can be read from.
+    """
+
+    @abc.abstractmethod
+    def read(self, job_id, offset):
+        """
+        Read the part of a job's log written since `offset`.
+
+        :type job_id: str
+        :param job_id: Mortar job_id
+
+        :type offset: int
+        :param offset: number of bytes of the log already read
+
+        :rtype: str:
+        :returns: the log from `offset` on, which may be empty
+        """
+        raise RuntimeError("Please implement the read method")
+
+
+class UrlLogSource(LogSource):
+    """
+    Reads job logs over HTTP, fetching only new bytes with a Range request.
+
+    To read job logs from a URL, define the following in your Luigi
+    client configuration file, where {job_id} is replaced with the
+    Mortar job_id:
+
+    ::[mortar]
+    ::job_log_url: https://my-log-host/jobs/{job_id}/log
+    """
+
+    def __init__(self, url_template, auth=None):
+        """
+        :type url_template: str
+        :param url_template: URL of a job's log, with a {job_id} placeholder
+
+        :param auth: requests authentication to send, e.g. the Mortar API's auth
+        """
+        self.url_template = url_template
+        self.auth = auth
+
+    def read(self, job_id, offset):
+        response = requests.get(self.url_template.format(job_id=job_id), auth=self.auth,
+                                headers={'Range': 'bytes=%d-' % offset})
+        if response.status_code == 416:
+            # nothing past offset yet
+            return ''
+        response.raise_for_status()
+        if response.status_code == 206:
+            return response.content
+        # the server ignored the range
+        return response.content[offset:]
+
+
+def _parse_time(line):
+    match = _LOG_LINE.match(line)
+    if not match:
+        return None
+    timestamp = datetime.datetime.strptime(match.group(1), '%Y-%m-%d %H:%M:%S')
+    return (timestamp - datetime.datetime(1970, 1, 1)).total_seconds()
+
+
+class PigStageParser(object):
+    """
+    Parses per-stage timings from Pig output, one line at a time.
+
+    A stage is a Hadoop job launched by Pig. Its start time and aliases come
+    from the MapReduceLauncher messages; its map and reduce times come from
+    the Job Stats table Pig prints when the script finishes. A stage's end
+    is taken to be when the next stage started or the table was printed.
+    """
+
+    def __init__(self):
+        self._stages = []
+        self._by_hadoop_job_id = {}
+        self._pending_aliases = None
+        self._last_time = None
+        self._stats_columns = None
+        self._in_stats = False
+
+    def feed(self, line):
+        """
+        Parse one line of Pig output.
+        """
+        t = _parse_time(line)
+        if t is not None:
+            self._last_time = t
+
+        if self._in_stats:
+            self._parse_stats_line(line)
+            return
+        if _JOB_STATS_HEADER in line:
+            self._in_stats = True
+            self._end_running_stages(self._last_time)
+            return
+
+        match = _ALIASES.search(line)
+        if match:
+            self._pending_aliases = match.group(1)
+            return
+        match = _HADOOP_JOB_ID.search(line)
+        if match and match.group(1) not in self._by_hadoop_job_id:
+            self._end_running_stages(t)
+            stage = {'hadoop_job_id': match.group(1), 'aliases': self._pending_aliases,
+                     'start_time': t, 'end_time': None}
+            self._pending_aliases = None
+            self._stages.append(stage)
+            self._by_hadoop_job_id[stage['hadoop_job_id']] = stage
+
+    def stages(self):
+        """
+        :rtype: list of dict:
+        :returns: timings of each stage seen so far, in launch order, with
+                  hadoop_job_id, aliases, start_time, end_time, duration_seconds
+                  and, once Pig reports them, map and reduce times in seconds
+        """
+        result = []
+        for stage in self._stages:
+            stage = dict(stage)
+            if stage['start_time'] is not None and stage['end_time'] is not None:
+                stage['duration_seconds'] = stage['end_time'] - stage['start_time']
+            else:
+                stage['duration_seconds'] = None
+            result.append(stage)
+        return result
+
+    def _end_running_stages(self, t):
+        if t is None:
+            return
+        for stage in self._stages:
+            if stage['end_time'] is None:
+                stage['end_time'] = t
+
+    def _parse_stats_line(self, line):
+        fields = line.rstrip('\n').split('\t')
+        if self._stats_columns is None:
+            if fields and fields[0] == 'JobId':
+                self._stats_columns = fields
+            return
+        if not line.strip() or len(fields) < 2:
+            # the table ends at the first blank line
+            self._in_stats = False
+            return
+        row = dict(zip(self._stats_columns, fields))
+        stage = self._by_hadoop_job_id.get(row.get('JobId'))
+        if stage is None:
+            return
+        for (column, key) in _JOB_STATS_TIMES.items():
+            try:
+                stage[key] = float(row[column])
+            except (KeyError, ValueError):
+                pass
+        if row.get('Alias'):
+            stage['aliases'] = row['Alias']
+
+
+class JobLogTailer(object):
+    """
+    Incrementally reads the logs of running Mortar jobs into the luigi log,
+    fetching only bytes not yet read, and parses Pig stage timings from them.
+    """
+
+    def __init__(self, source, interval=30):
+        """
+        :type source: :py:class:`LogSource`
+        :param source: where to read job logs
+
+        :type interval: float
+        :param interval: minimum seconds between reads of a job's log
+        """
+        self.source = source
+        self.interval = interval
+        self._offsets = {}
+        self._partial_lines = {}
+        self._last_read = {}
+        self._parsers = {}
+
+    def tail(self, job_id, force=False):
+        """
+        Log any new complete lines of a job's log, unless it was read less
+        than `interval` seconds ago. Failures to read are logged, not raised.
+
+        :type force: bool
+        :param force: read regardless of when the log was last read
+        """
+        now = time.time()
+        if not force and now - self._last_read.get(job_id, 0) < self.interval:
+            return
+        self._last_read[job_id] = now
+        offset = self._offsets.get(job_id, 0)
+        try:
+            data = self.source.read(job_id, offset)
+        except Exception as e:
+            logger.info('Unable to read log for Mortar job_id [%s]: %s' % (job_id, e))
+            return
+        if not data:
+            return
+        self._offsets[job_id] = offset + len(data)
+        lines = (self._partial_lines.pop(job_id, '') + data).split('\n')
+        if lines[-1]:
+            self._partial_lines[job_id] = lines[-1]
+        self._feed(job_id, lines[:-1])
+
+    def finish(self, job_id):
+        """
+        Read the rest of a finished job's log, including a last line
+        with no trailing newline.
+        """
+        self.tail(job_id, force=True)
+        partial_line = self._partial_lines.pop(job_id, None)
+        if partial_line:
+            self._feed(job_id, [partial_line])
+
+    def _feed(self, job_id, lines):
+        parser = self._parsers.setdefault(job_id, PigStageParser())
+        for line in lines:
+            logger.info('[%s] %s' % (job_id, line))
+            parser.feed(line)
+
+    def stage_timings(self, job_id):
+        """
+        :rtype: list of dict:
+        :returns: Pig stage timings parsed from the job's log so far
+        """
+        parser = self._parsers.get(job_id)
+        return parser.stages() if parser else []
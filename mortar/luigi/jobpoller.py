@@ -0,0 +1,512 @@
+# Copyright (c) 2014 Mortar Data
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+import logging
+import os
+import random
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+from mortar.luigi import lazyimport
+from mortar.luigi import timing
+
+jobs = lazyimport.LazyModule('mortar.api.v2.jobs')
+
+logger = logging.getLogger('luigi-interface')
+
+# Longest time (in seconds) a waiting thread blocks before re-checking
+# its job, so that waiters stay responsive to KeyboardInterrupt.
+WAIT_SLICE_SECONDS = 1.0
+
+# Default maximum number of jobs polled at once, so that a slow
+# or failing poll does not hold up polls of other jobs.
+DEFAULT_POLL_THREADS = 4
+
+
+def is_starting_status(status):
+    """
+    Whether a job status means the job is waiting on a cluster
+    rather than making progress.
+
+    :rtype: bool:
+    :returns: True for the job statuses before a job starts running
+    """
+    return status in (
+        jobs.STATUS_STARTING,
+        jobs.STATUS_GATEWAY_STARTING,
+        jobs.STATUS_VALIDATING_SCRIPT,
+        jobs.STATUS_STARTING_CLUSTER)
+
+
+def get_job_status_description(job):
+    """
+    Build a human-readable description of a job's current status.
+
+    :type job: dict
+    :param job: job details, as returned by `jobs.get_job`
+
+    :rtype: str:
+    :returns: status description, including status details if present
+    """
+    desc = job.get('status_description')
+    if job.get('status_details'):
+        if desc:
+            desc += ' - %s' % job.get('status_details')
+        else:
+            desc = job.get('status_details')
+    return desc
+
+
+class FixedPollingPolicy(object):
+    """
+    Polls a job at a fixed interval, and retries failed polls
+    at that same interval.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+
+    def next_interval(self, watch, job):
+        """
+        Seconds to wait before polling again after a successful poll.
+
+        :type watch: :py:class:`JobWatch`
+        :param watch: polling state for the job
+
+        :type job: dict
+        :param job: job details from the latest poll
+
+        :rtype: float:
+        :returns: seconds until the next poll
+        """
+        return self.interval
+
+    def retry_interval(self, watch):
+        """
+        Seconds to wait before polling again after a failed poll.
+        `watch.exception_count` holds the number of consecutive failures.
+
+        :rtype: float:
+        :returns: seconds until the next poll
+        """
+        return self.interval
+
+
+class AdaptivePollingPolicy(FixedPollingPolicy):
+    """
+    Polls slowly while a job waits on cluster startup and, once it is
+    running, at a fraction of the time its progress rate says remains.
+    Failed polls back off exponentially with random jitter so that
+    many jobs do not retry against the API in lockstep.
+    """
+
+    def __init__(self, interval=5, min_interval=1, max_interval=60,
+                 starting_interval=30, eta_fraction=0.25, jitter=0.5):
+        """
+        :type interval: float
+        :param interval: seconds between polls when no better estimate is available
+
+        :type min_interval: float
+        :param min_interval: shortest allowed polling interval
+
+        :type max_interval: float
+        :param max_interval: longest allowed polling interval
+
+        :type starting_interval: float
+        :param starting_interval: seconds between polls while the job waits on a cluster
+
+        :type eta_fraction: float
+        :param eta_fraction: fraction of the estimated remaining time to wait between polls
+
+        :type jitter: float
+        :param jitter: maximum random fraction added to or removed from retry intervals
+        """
+        super(AdaptivePollingPolicy, self).__init__(interval)
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.starting_interval = starting_interval
+        self.eta_fraction = eta_fraction
+        self.jitter = jitter
+
+    def next_interval(self, watch, job):
+        status = job.get('status_code')
+        if is_starting_status(status):
+            interval = self.starting_interval
+        elif status == jobs.STATUS_RUNNING:
+            interval = self._running_interval(watch)
+        else:
+            interval = self.interval
+        return self._clamp(interval)
+
+    def retry_interval(self, watch):
+        backoff = self.interval * (2 ** (watch.exception_count - 1))
+        jittered = backoff * random.uniform(1 - self.jitter, 1 + self.jitter)
+        return self._clamp(jittered)
+
+    def _running_interval(self, watch):
+        rate = watch.progress_rate()
+        if not rate:
+            return self.interval
+        (_, progress) = watch.last_progress
+        remaining_seconds = (100 - progress) / rate
+        return remaining_seconds * self.eta_fraction
+
+    def _clamp(self, interval):
+        return max(self.min_interval, min(self.max_interval, interval))
+
+
+class JobWatch(object):
+    """
+    Polling state for a single Mortar job tracked by a :py:class:`JobPoller`.
+    Callers block on :py:meth:`wait` until the job reaches a complete status
+    or polling gives up.
+    """
+
+    def __init__(self, api, job_id, policy, num_polling_retries):
+        self.api = api
+        self.job_id = job_id
+        self.policy = policy
+        self.num_polling_retries = num_polling_retries
+
+        self.current_job_status = None
+        self.current_progress = None
+        self.start_time = time.time()
+        self.status_start_time = self.start_time
+        self.exception_count = 0
+        self.next_poll_time = 0
+
+        # (time, progress) when progress was first and last seen while running
+        self.first_progress = None
+        self.last_progress = None
+        # when the job was first seen running, and every (time, progress) since
+        self.running_since = None
+        self.progress_samples = []
+
+        self.job = None
+        self.error = None
+        self._done = threading.Event()
+        self._callbacks = []
+        self._callbacks_lock = threading.Lock()
+
+    def done(self):
+        """
+        Whether the job has finished, or polling has failed.
+
+        :rtype: bool:
+        :returns: True if :py:meth:`wait` will return without blocking
+        """
+        return self._done.is_set()
+
+    def progress_rate(self):
+        """
+        Average progress rate of the running job since its progress was
+        first observed.
+
+        :rtype: float:
+        :returns: percent complete per second, or None if unknown
+        """
+        if not (self.first_progress and self.last_progress):
+            return None
+        (first_time, first_progress) = self.first_progress
+        (last_time, last_progress) = self.last_progress
+        if last_time <= first_time:
+            return None
+        return float(last_progress - first_progress) / (last_time - first_time)
+
+    def progress_curve(self):
+        """
+        Progress of the job over time since it was first seen running.
+
+        :rtype: list of tuple:
+        :returns: (seconds since running, percent complete) for each progress change
+        """
+        if self.running_since is None:
+            return []
+        return [(t - self.running_since, progress) for (t, progress) in self.progress_samples]
+
+    def wait(self, timeout=None):
+        """
+        Block until the job completes.
+
+        :type timeout: float
+        :param timeout: maximum seconds to block. Default: block until the job completes.
+
+        :raises: the last polling exception if polling failed more than
+                 `num_polling_retries` times in a row
+
+        :rtype: dict:
+        :returns: final job details, or None if the timeout passed first
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        while not self._done.wait(WAIT_SLICE_SECONDS if deadline is None
+                                  else max(0, min(WAIT_SLICE_SECONDS, deadline - time.time()))):
+            if deadline is not None and time.time() >= deadline:
+                return None
+        if self.error is not None:
+            raise self.error
+        return self.job
+
+    def add_done_callback(self, callback):
+        """
+        Call `callback(watch)` once the job completes or polling fails.
+        If that has already happened, it is called immediately.
+
+        Callbacks run on the poller's thread and should return quickly.
+        """
+        with self._callbacks_lock:
+            if not self.done():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def _finish(self, job=None, error=None):
+        self.job = job
+        self.error = error
+        with self._callbacks_lock:
+            self._done.set()
+            callbacks = self._callbacks
+            self._callbacks = []
+        for callback in callbacks:
+            try:
+                callback(self)
+            except Exception:
+                logger.exception('Error in callback for Mortar job_id [%s]' % self.job_id)
+
+
+class JobPoller(object):
+    """
+    Process-wide service that tracks all outstanding Mortar jobs and
+    refreshes their status from a single background thread, which hands
+    due polls to a small pool of polling threads.
+
+    Each job is polled on the schedule set by its polling policy,
+    regardless of how many tasks are waiting on it. Use :py:func:`get_job_poller`
+    to get the shared instance rather than constructing one directly.
+    """
+
+    def __init__(self, max_poll_threads=DEFAULT_POLL_THREADS):
+        """
+        :type max_poll_threads: int
+        :param max_poll_threads: maximum number of jobs polled at once
+        """
+        self.max_poll_threads = max_poll_threads
+        self._condition = threading.Condition()
+        self._watches = {}
+        # watches with a poll in progress, never handed out twice
+        self._polling = set()
+        self._thread = None
+        self._pool = None
+        self.pid = os.getpid()
+
+    def watch(self, api, job_id, polling_interval=5, num_polling_retries=3, policy=None):
+        """
+        Start tracking a job, or join an existing watch on it.
+
+        :type api: :class:`mortar.api.v2.api.API`
+        :param api: API used to fetch the job
+
+        :type job_id: str
+        :param job_id: ID of job to poll
+
+        :type polling_interval: int
+        :param polling_interval: seconds between polls for this job, if no policy is given
+
+        :type num_polling_retries: int
+        :param num_polling_retries: consecutive polling failures tolerated
+                                    before giving up
+
+        :type policy: :py:class:`FixedPollingPolicy`
+        :param policy: schedule for polling this job. Default: poll every `polling_interval` seconds.
+
+        :rtype: :py:class:`JobWatch`:
+        :returns: watch to wait on
+        """
+        with self._condition:
+            watch = self._watches.get(job_id)
+            if watch:
+                # several waiters on one job share a watch and the
+                # first waiter's policy; honor the most patient retries
+                watch.num_polling_retries = max(watch.num_polling_retries, num_polling_retries)
+            else:
+                watch = JobWatch(api, job_id, policy or FixedPollingPolicy(polling_interval),
+                                 num_polling_retries)
+                self._watches[job_id] = watch
+            self._ensure_thread()
+            self._condition.notify()
+        return watch
+
+    def wait(self, api, job_id, polling_interval=5, num_polling_retries=3, policy=None):
+        """
+        Track a job and block until it completes.
+
+        :rtype: dict:
+        :returns: final job details
+        """
+        return self.watch(api, job_id, polling_interval, num_polling_retries, policy).wait()
+
+    def outstanding_job_ids(self):
+        """
+        :rtype: list of str:
+        :returns: job_ids currently being polled
+        """
+        with self._condition:
+            return self._watches.keys()
+
+    def _ensure_thread(self):
+        if self._pool is None:
+            self._pool = ThreadPool(max(1, self.max_poll_threads))
+        if not (self._thread and self._thread.is_alive()):
+            self._thread = threading.Thread(target=self._run, name='mortar-job-poller')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                due = self._due_watches()
+                self._polling.update(due)
+            for watch in due:
+                self._pool.apply_async(self._poll_in_pool, (watch,))
+
+    def _poll_in_pool(self, watch):
+        try:
+            self._poll(watch)
+        except Exception as e:
+            # never let a polling thread die while watches are pending
+            logger.exception('Error polling Mortar job_id [%s]' % watch.job_id)
+            self._complete(watch, error=e)
+        finally:
+            with self._condition:
+                self._polling.discard(watch)
+                self._condition.notify()
+
+    def _due_watches(self):
+        """
+        Wait, with the condition held, until at least one watch
+        without a poll in progress is due.
+        """
+        while True:
+            now = time.time()
+            idle = [w for w in self._watches.values() if w not in self._polling]
+            due = [w for w in idle if w.next_poll_time <= now]
+            if due:
+                return due
+            if idle:
+                next_poll_time = min(w.next_poll_time for w in idle)
+                self._condition.wait(next_poll_time - now)
+            else:
+                self._condition.wait()
+
+    def _poll(self, watch):
+        # any failure in a poll, not just fetching the job,
+        # counts against num_polling_retries
+        try:
+            job = _get_job(watch.api, watch.job_id)
+            self._update(watch, job)
+        except Exception as e:
+            if watch.exception_count < watch.num_polling_retries:
+                watch.exception_count += 1
+                logger.info('Failure to get job status for job %s: %s' % (watch.job_id, str(e)))
+                self._schedule(watch, watch.policy.retry_interval(watch))
+            else:
+                self._complete(watch, error=e)
+
+    def _update(self, watch, job):
+        new_job_status = job.get('status_code')
+
+        # check for updated status
+        if new_job_status != watch.current_job_status:
+            self._record_status_time(watch)
+            watch.current_job_status = new_job_status
+            if new_job_status == jobs.STATUS_RUNNING and watch.running_since is None:
+                watch.running_since = time.time()
+            logger.info('Mortar job_id [%s] switched to status_code [%s], description: %s' % \
+                (watch.job_id, new_job_status, get_job_status_description(job)))
+
+        # check for updated progress on running job
+        if (new_job_status == jobs.STATUS_RUNNING) and (job.get('progress') != watch.current_progress):
+            watch.current_progress = job.get('progress')
+            self._record_progress(watch)
+            timing.emit('job_progress', job_id=watch.job_id, progress=watch.current_progress,
+                        elapsed_seconds=time.time() - watch.start_time)
+            logger.info('Mortar job_id [%s] progress: [%s%%]' % (watch.job_id, watch.current_progress))
+
+        # final state
+        if new_job_status in jobs.COMPLETE_STATUSES:
+            timing.emit('job_complete', job_id=watch.job_id, status_code=new_job_status,
+                        elapsed_seconds=time.time() - watch.start_time)
+            self._complete(watch, job=job)
+        else:
+            interval = watch.policy.next_interval(watch, job)
+            # reset exception count on successful poll
+            watch.exception_count = 0
+            self._schedule(watch, interval)
+
+    def _record_status_time(self, watch):
+        now = time.time()
+        if watch.current_job_status is not None:
+            timing.emit('job_status', job_id=watch.job_id, status_code=watch.current_job_status,
+                        duration_seconds=now - watch.status_start_time)
+        watch.status_start_time = now
+
+    def _record_progress(self, watch):
+        try:
+            sample = (time.time(), float(watch.current_progress))
+        except (TypeError, ValueError):
+            return
+        if watch.first_progress is None:
+            watch.first_progress = sample
+        watch.last_progress = sample
+        watch.progress_samples.append(sample)
+
+    def _schedule(self, watch, interval):
+        watch.next_poll_time = time.time() + interval
+
+    def _complete(self, watch, job=None, error=None):
+        with self._condition:
+            if self._watches.get(watch.job_id) is watch:
+                del self._watches[watch.job_id]
+        watch._finish(job=job, error=error)
+
+
+def _get_job(api, job_id):
+    """
+    Fetch a job's details once. The pooled client's own retries
+    would sleep for half a minute on a failing poll, so it is asked
+    not to retry: the poller retries on its watch's polling policy.
+    """
+    if lazyimport.is_instance(api, 'mortar.luigi.mortarapi', 'PooledAPI'):
+        return api.get_once('jobs/%s' % job_id)
+    return jobs.get_job(api, job_id)
+
+
+_job_poller = None
+_job_poller_lock = threading.Lock()
+
+def get_job_poller():
+    """
+    Get the shared :py:class:`JobPoller` for this process.
+
+    A new poller is created after a fork, since the background
+    thread of the parent's poller does not survive into the child.
+
+    :rtype: :py:class:`JobPoller`:
+    :returns: the process-wide job poller
+    """
+    global _job_poller
+    with _job_poller_lock:
+        if _job_poller is None or _job_poller.pid != os.getpid():
+            _job_poller = JobPoller()
+        return _job_poller
@@ -0,0 +1,65 @@
+# Copyright (c) 2014 Mortar Data
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+import importlib
+import sys
+
+
+class LazyModule(object):
+    """
+    Stand-in for a module that is imported the first time one of its
+    attributes is used, so that importing a mortar.luigi module does not
+    pay for backends (boto, requests, pymongo, the Mortar API client)
+    that are never used.
+
+    Use it in place of a module-level import:
+
+    ::s3 = lazyimport.LazyModule('luigi.s3')
+    ::...
+    ::target = s3.S3Target(path)
+
+    Attributes of the stand-in can be patched in tests like those of a module.
+    """
+
+    def __init__(self, name):
+        """
+        :type name: str
+        :param name: full name of the module, e.g. luigi.s3
+        """
+        self._lazy_name = name
+
+    def __getattr__(self, attr):
+        return getattr(importlib.import_module(self._lazy_name), attr)
+
+    def __repr__(self):
+        return '<lazy module %r>' % self._lazy_name
+
+
+def is_instance(obj, module_name, class_name):
+    """
+    isinstance check against a class that does not import its module.
+    Nothing can be an instance of a class whose module has not been
+    imported, so the check is False until it is.
+
+    :type module_name: str
+    :param module_name: full name of the class's module, e.g. luigi.s3
+
+    :type class_name: str
+    :param class_name: name of the class, e.g. S3Target
+
+    :rtype: bool:
+    :returns: True if obj is an instance of the class
+    """
+    module = sys.modules.get(module_name)
+    return module is not None and isinstance(obj, getattr(module, class_name))
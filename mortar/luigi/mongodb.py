@@ -16,9 +16,10 @@ import abc
 
 import luigi
 import logging
+from mortar.luigi import lazyimport
 from mortar.luigi import target_factory
 
-from pymongo import MongoClient
+pymongo = lazyimport.LazyModule('pymongo')
 
 logger = logging.getLogger('luigi-interface')
 
@@ -135,7 +136,7 @@ class SanityTestMongoDBCollection(MongoDBTask):
         mongo_conn = luigi.configuration.get_config().get('mongodb', 'mongo_conn')
         mongo_db = luigi.configuration.get_config().get('mongodb', 'mongo_db')
 
-        mc = MongoClient("%s/%s" % (mongo_conn, mongo_db))
+        mc = pymongo.MongoClient("%s/%s" % (mongo_conn, mongo_db))
         db = mc[mongo_db]
         return db[self.collection_name()]
 
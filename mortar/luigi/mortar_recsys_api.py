@@ -16,13 +16,14 @@ import abc
 import json
 from luigi import Task, configuration
 import luigi
-from luigi.s3 import S3Target
-import requests
-from requests.auth import HTTPBasicAuth
 
 import logging
+from mortar.luigi import lazyimport
 from mortar.luigi import target_factory
 
+requests = lazyimport.LazyModule('requests')
+s3 = lazyimport.LazyModule('luigi.s3')
+
 logger = logging.getLogger('luigi-interface')
 
 
@@ -35,7 +36,7 @@ class VerifyApi(Task):
     result_length = luigi.IntParameter(5)
 
     def output(self):
-        return [S3Target(self.output_path(self.__class__.__name__))]
+        return [s3.S3Target(self.output_path(self.__class__.__name__))]
 
     def headers(self):
         return {'Accept': 'application/json',
@@ -44,7 +45,7 @@ class VerifyApi(Task):
                    'User-Agent': 'mortar-luigi'}
 
     def auth(self):
-        return HTTPBasicAuth(configuration.get_config().get('recsys', 'email'),
+        return requests.auth.HTTPBasicAuth(configuration.get_config().get('recsys', 'email'),
                              configuration.get_config().get('recsys', 'password'))
 
     def run(self):
@@ -137,7 +138,7 @@ class PromoteDynamoDBTablesToAPI(Task):
         raise RuntimeError("Must provide a dictionary of table names to set")
 
     def output(self):
-        return [S3Target(self.output_path(self.__class__.__name__))]
+        return [s3.S3Target(self.output_path(self.__class__.__name__))]
 
     def run(self):
         self._set_tables()
@@ -156,7 +157,7 @@ class PromoteDynamoDBTablesToAPI(Task):
         url = self._client_update_endpoint()
         body = {'ii_table': self.table_names()['ii_table'],
                 'ui_table': self.table_names()['ui_table']}
-        auth = HTTPBasicAuth(configuration.get_config().get('recsys', 'email'),
+        auth = requests.auth.HTTPBasicAuth(configuration.get_config().get('recsys', 'email'),
                              configuration.get_config().get('recsys', 'password'))
         logger.info('Setting new tables to %s at %s' % (body, url))
         response = requests.put(url, data=json.dumps(body), auth=auth, headers=headers)
@@ -0,0 +1,134 @@
+# Copyright (c) 2014 Mortar Data
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+import json
+import os
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from mortar.api.v2.api import API, retry_with_backoff
+
+# Default maximum number of connections kept open to the Mortar API
+# by each pooled client.
+DEFAULT_POOL_SIZE = 10
+
+
+class PooledAPI(API):
+    """
+    Mortar API client that sends every request over one
+    keep-alive HTTP session with a bounded connection pool.
+
+    A single instance is safe to share across luigi worker threads;
+    callers block when all pooled connections are in use rather than
+    opening new ones. Use :py:func:`get_api` to get the shared instance
+    for an account rather than constructing one directly.
+    """
+
+    def __init__(self, email, api_key, host=None, pool_size=DEFAULT_POOL_SIZE):
+        """
+        :type email: str
+        :param email: Mortar user email address
+
+        :type api_key: str
+        :param api_key: Mortar api_key
+
+        :type host: str
+        :param host: Mortar API hostname. Default: the mortar-api-python default.
+
+        :type pool_size: int
+        :param pool_size: maximum number of open connections to the API
+        """
+        if host:
+            super(PooledAPI, self).__init__(email, api_key, host=host)
+        else:
+            super(PooledAPI, self).__init__(email, api_key)
+        self.api_key = api_key
+        self.pool_size = pool_size
+        self.session = requests.Session()
+        self.session.auth = self.auth
+        self.session.headers.update(API.HEADERS)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=True)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    # Each override keeps the base client's retries on transient errors
+
+    @retry_with_backoff
+    def post(self, path, payload):
+        return self._request('POST', path, data=json.dumps(payload))
+
+    @retry_with_backoff
+    def get(self, path, params=None):
+        return self._request('GET', path, params=params)
+
+    @retry_with_backoff
+    def put(self, path, payload):
+        return self._request('PUT', path, data=json.dumps(payload))
+
+    @retry_with_backoff
+    def delete(self, path):
+        self._request('DELETE', path, parse_response=False)
+
+    @retry_with_backoff
+    def delete_with_payload(self, path, payload):
+        self._request('DELETE', path, parse_response=False, data=json.dumps(payload))
+
+    def get_once(self, path, params=None):
+        """
+        Get from the API without retrying on failure, for callers
+        that schedule their own retries.
+
+        :raises: requests.exception.HTTPError: if a 40x or 50x error occurs
+
+        :rtype: str:
+        :returns: json response
+        """
+        return self._request('GET', path, params=params)
+
+    def _request(self, method, path, parse_response=True, **kwargs):
+        response = self.session.request(method, self.url(path), **kwargs)
+        self.raise_for_status(response)
+        if parse_response:
+            return response.json()
+
+
+_apis = {}
+_apis_lock = threading.Lock()
+_apis_pid = os.getpid()
+
+def get_api(email, api_key, host=None, pool_size=DEFAULT_POOL_SIZE):
+    """
+    Get the shared :py:class:`PooledAPI` for a Mortar account in this process,
+    creating it on first use. Clients are keyed by (email, host, pool_size);
+    a client is replaced if the account's api_key changes.
+
+    Pooled connections are not shared across a fork: a forked process
+    gets new clients.
+
+    :rtype: :py:class:`PooledAPI`:
+    :returns: pooled API client for the account
+    """
+    global _apis_pid
+    with _apis_lock:
+        if _apis_pid != os.getpid():
+            _apis.clear()
+            _apis_pid = os.getpid()
+        cache_key = (email, host, pool_size)
+        api = _apis.get(cache_key)
+        if api is None or api.api_key != api_key:
+            api = PooledAPI(email, api_key, host=host, pool_size=pool_size)
+            _apis[cache_key] = api
+        return api
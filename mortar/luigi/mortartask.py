@@ -13,28 +13,40 @@
 # the License.
 
 import abc
+import hashlib
+import json
 import os
+import Queue
 import subprocess
 import tempfile
+import threading
 import time
+import urlparse
+from multiprocessing.pool import ThreadPool
 
 import luigi
 
 
-from mortar.api.v2 import API
-from mortar.api.v2 import clusters
-from mortar.api.v2 import jobs
-
 import logging
+from mortar.luigi import autosize
+from mortar.luigi import cleanup
+from mortar.luigi import clustercache
+from mortar.luigi import idlepolicy
+from mortar.luigi import joblogs
+from mortar.luigi import jobpoller
+from mortar.luigi import lazyimport
+from mortar.luigi import placement
+from mortar.luigi import straggler
+from mortar.luigi.placement import NUM_MAP_SLOTS_PER_MACHINE, NUM_REDUCE_SLOTS_PER_MACHINE
 from mortar.luigi import target_factory
+from mortar.luigi import timing
 
-logger = logging.getLogger('luigi-interface')
-
-# Number of map task slots per m1.xlarge instance
-NUM_MAP_SLOTS_PER_MACHINE = 8
+# The Mortar API client (and requests) are only imported once a task talks to Mortar
+clusters = lazyimport.LazyModule('mortar.api.v2.clusters')
+jobs = lazyimport.LazyModule('mortar.api.v2.jobs')
+mortarapi = lazyimport.LazyModule('mortar.luigi.mortarapi')
 
-# Number of reduce task slots per m1.xlarge instance
-NUM_REDUCE_SLOTS_PER_MACHINE = 3
+logger = logging.getLogger('luigi-interface')
 
 # flag to indicate that no git_ref has been passed to a mortar task method
 NO_GIT_REF_FLAG = "not-set-flag"
@@ -56,14 +68,26 @@ class MortarTask(luigi.Task):
     """
 
     def _get_api(self):
+        """
+        Get the API client for the configured Mortar account. Clients are
+        pooled per process and reused across tasks, so their HTTP connections
+        stay open between calls. The pool size can be set with the
+        optional `api_pool_size` option in the [mortar] section.
+        """
         config = luigi.configuration.get_config()
         email = config.get('mortar', 'email')
         api_key = config.get('mortar', 'api_key')
-        if config.has_option('mortar', 'host'):
-            host = config.get('mortar', 'host')
-            return API(email, api_key, host=host)
-        else:
-            return API(email, api_key)
+        host = config.get('mortar', 'host') if config.has_option('mortar', 'host') else None
+        pool_size = config.getint('mortar', 'api_pool_size') \
+            if config.has_option('mortar', 'api_pool_size') else mortarapi.DEFAULT_POOL_SIZE
+        return mortarapi.get_api(email, api_key, host=host, pool_size=pool_size)
+
+    def _get_pipeline_job_id(self):
+        """
+        Get the job_id for the parent luigi pipeline 
+        that executed this Pig job, if applicable.
+        """
+        return os.environ.get('PIPELINE_JOB_ID')
 
 class MortarProjectTask(MortarTask):
     """
@@ -120,15 +144,84 @@ class MortarProjectTask(MortarTask):
     # of this Mortar job.
     notify_on_job_finish = luigi.BooleanParameter(default=False)
 
-    # Internval (in seconds) to poll for job status.
+    # Internval (in seconds) to poll for job status when the
+    # polling policy has no better estimate.
     job_polling_interval = luigi.IntParameter(default=5)
 
+    # Longest interval (in seconds) the polling policy will wait
+    # between polls for job status.
+    max_job_polling_interval = luigi.IntParameter(default=60)
+
+    # Interval (in seconds) to poll for job status while the job
+    # waits for its cluster to start.
+    cluster_starting_polling_interval = luigi.IntParameter(default=30)
+
     # Number of retries before giving up on polling.
     num_polling_retries = luigi.IntParameter(default=3)
 
+    # Maximum age (in seconds) of the shared list of running clusters
+    # to use when choosing a cluster.  Jobs submitted from this process
+    # are reflected in the list immediately.  Set to 0 to always
+    # fetch clusters from the Mortar API.
+    cluster_cache_ttl = luigi.IntParameter(default=15)
+
     # Version of Pig to use.
     pig_version = luigi.Parameter(default='0.12')
 
+    # If True, the success token is keyed on a fingerprint of the job's
+    # inputs (project, script, git ref, parameters and pig version) rather
+    # than on the class name.  The task is then skipped only when an identical
+    # job has already succeeded, and reruns whenever any input changes.
+    use_fingerprint = luigi.BooleanParameter(default=False)
+
+    # If True, the size of the cluster the job runs on is chosen when the
+    # task runs from the total bytes of its inputs (see `input_paths`), between min_cluster_size
+    # and max_cluster_size.  Each node is assumed to handle bytes_per_node
+    # bytes in target_job_seconds until enough past runs have been recorded
+    # to fit that from their timings.  Does not apply in local mode
+    # (cluster_size = 0).
+    auto_cluster_size = luigi.BooleanParameter(default=False)
+    min_cluster_size = luigi.IntParameter(default=2)
+    max_cluster_size = luigi.IntParameter(default=50)
+    bytes_per_node = luigi.IntParameter(default=autosize.DEFAULT_BYTES_PER_NODE)
+    target_job_seconds = luigi.IntParameter(default=3600)
+
+    # Maximum number of script_output targets removed at once
+    # when the job fails.
+    cleanup_threads = luigi.IntParameter(default=cleanup.DEFAULT_CLEANUP_THREADS)
+
+    # If True, script_output is removed in the background when the job
+    # fails, so the failure is reported immediately.  The process does
+    # not exit until the removal finishes.
+    background_cleanup = luigi.BooleanParameter(default=False)
+
+    # If True, the job's log is read into the luigi log while it runs,
+    # and the timings of its Pig stages are reported when it finishes.
+    # Requires a job_log_url configuration item (see `job_log_source`).
+    tail_job_logs = luigi.BooleanParameter(default=False)
+
+    # Interval (in seconds) between reads of the job's log.
+    job_log_interval = luigi.IntParameter(default=30)
+
+    # If True, compare the progress of the running job with past runs
+    # of the same script, and warn when it falls far behind.
+    detect_stragglers = luigi.BooleanParameter(default=False)
+
+    # How many times slower than past runs a job must be to be
+    # considered a straggler.
+    straggler_slowdown = luigi.FloatParameter(default=3.0)
+
+    # Jobs running for less than this many seconds are never
+    # considered stragglers.
+    min_straggler_seconds = luigi.IntParameter(default=600)
+
+    # If True (and detect_stragglers is True), a straggling job is
+    # resubmitted on a new cluster, and whichever attempt finishes
+    # first is used.  The other attempt is stopped.  Only done if the
+    # API can stop jobs (see `job_stop_supported`) and the attempts don't
+    # share output locations (see `speculative_parameters`).
+    speculative_resubmit = luigi.BooleanParameter(default=False)
+
     def project(self):
         """
         Override this method to provide the name of 
@@ -197,6 +290,10 @@ class MortarProjectTask(MortarTask):
         to use an S3 path (e.g. s3://my-bucket/my-token-path), 
         ensuring that tokens will be available from any machine.
 
+        To keep every token in one place rather than one file per token, use
+        a token store path instead (e.g. s3tokens://my-bucket/my-pipeline.tokens
+        or sqlite:///var/luigi/tokens.db). See :py:mod:`mortar.luigi.tokenstore`.
+
         :rtype: str:
         :returns: default token path on file system - file://tempdirectory
         """
@@ -232,7 +329,7 @@ class MortarProjectTask(MortarTask):
         :rtype: Target:
         :returns: Target for the token that indicates job is running.
         """
-        return target_factory.get_target('%s/%s-%s' % (self.token_path(), self.__class__.__name__, 'Running'))
+        return target_factory.get_token_target('%s/%s-%s' % (self.token_path(), self.__class__.__name__, 'Running'))
 
     def success_token(self):
         """
@@ -251,7 +348,43 @@ class MortarProjectTask(MortarTask):
         :rtype: Target:
         :returns: Target for the token that indicates that this Task has succeeded.
         """
-        return target_factory.get_target('%s/%s' % (self.token_path(), self.__class__.__name__))
+        if self.use_fingerprint:
+            return self.fingerprint_token()
+        return target_factory.get_token_target('%s/%s' % (self.token_path(), self.__class__.__name__))
+
+    def fingerprint(self):
+        """
+        A content hash of everything that determines what this job computes:
+        `project`, `script`, the resolved git ref, `parameters` and `pig_version`.
+
+        :rtype: str:
+        :returns: hex SHA-1 fingerprint of the job's inputs
+        """
+        return hashlib.sha1(self._fingerprint_inputs()).hexdigest()
+
+    def fingerprint_token(self):
+        """
+        Token indicating that a job with this task's `fingerprint` has finished
+        successfully. Fingerprint tokens are indexed by fingerprint underneath
+        the `token_path`, e.g.:
+
+        `s3://my-bucket/my-folder/fingerprints/0beec7b5ea3f0fdbc95d0dd47f3c5bc275da8a33`
+
+        The token contains the inputs that produced the fingerprint.
+
+        :rtype: Target:
+        :returns: Target for the fingerprint token
+        """
+        return target_factory.get_token_target('%s/fingerprints/%s' % (self.token_path(), self.fingerprint()))
+
+    def _fingerprint_inputs(self):
+        return json.dumps({
+            'project': self.project(),
+            'script': self.script(),
+            'git_ref': self._git_ref(),
+            'parameters': self.parameters(),
+            'pig_version': self.pig_version,
+        }, sort_keys=True, default=str)
 
     def run(self):
         """
@@ -267,23 +400,81 @@ class MortarProjectTask(MortarTask):
           If this token exists, Luigi will not rerun the task.
         """
         api = self._get_api()
-        if self.running_token().exists():
-            job_id = self.running_token().open().read().strip()
-        else:
-            job_id = self._run_job(api)
-            # to guarantee idempotence, record that the job is running
-            target_factory.write_file(self.running_token(), text=job_id)
+        self._complete_job(api, self._start_job(api))
+
+    def _start_job(self, api):
+        """
+        First half of running the job: choose a cluster size if
+        `auto_cluster_size` is set, then submit the job or pick up
+        the one already running.
+
+        :rtype: tuple:
+        :returns: (job_id, sizing model and input bytes or None, start time),
+                  to pass to `_complete_job`
+        """
+        sizing = None
+        if self.auto_cluster_size and self.cluster_size > 0:
+            sizing = self._choose_cluster_size()
+        start_time = time.time()
+        return (self._submit_job(api), sizing, start_time)
+
+    def _complete_job(self, api, started):
+        """
+        Second half of running the job: wait for it to complete, tailing its
+        logs and watching for stragglers if requested, then record its outcome.
+
+        :type started: tuple
+        :param started: as returned by `_start_job`
+        """
+        (job_id, sizing, start_time) = started
         job = self._poll_job_completion(api, job_id)
+        self._finish_job(job_id, job)
+        if sizing:
+            self._record_sizing(sizing, time.time() - start_time)
+
+    def _submit_job(self, api):
+        """
+        Submit the job, or pick up the job recorded in the running token.
+
+        :rtype: str:
+        :returns: job_id of the running job
+        """
+        # check the token itself rather than a listing that may be stale
+        running_token = target_factory.get_target(self.running_token().path)
+        with timing.timed('token_read', task=self.task_id, token=running_token.path):
+            target_factory.refresh(running_token)
+            if running_token.exists():
+                return running_token.open().read().split()[0]
+        job_id = self._run_job(api)
+        # to guarantee idempotence, record that the job is running
+        with timing.timed('token_write', task=self.task_id, token=self.running_token().path):
+            target_factory.write_file(self.running_token(), text=job_id)
+        return job_id
+
+    def _finish_job(self, job_id, job):
+        """
+        Record the outcome of a completed job, clearing script output
+        and raising an exception if it failed.
+        """
         final_job_status_code = job.get('status_code')
         # record that the job has finished
-        self.running_token().remove()
+        with timing.timed('token_remove', task=self.task_id, token=self.running_token().path):
+            self.running_token().remove()
         if final_job_status_code != jobs.STATUS_SUCCESS:
-            for out in self.script_output():
+            outputs = self.script_output()
+            for out in outputs:
                 logger.info('Mortar script failed: removing incomplete data in %s' % out)
-                out.remove()
+            if self.background_cleanup:
+                cleanup.remove_targets_in_background(outputs, max_threads=self.cleanup_threads)
+            else:
+                cleanup.remove_targets(outputs, max_threads=self.cleanup_threads)
             raise Exception('Mortar job_id [%s] failed with status_code: [%s], error details: %s' % (job_id, final_job_status_code, job.get('error')))
         else:
-            target_factory.write_file(self.success_token())
+            with timing.timed('token_write', task=self.task_id, token=self.success_token().path):
+                if self.use_fingerprint:
+                    target_factory.write_file(self.success_token(), text=self._fingerprint_inputs())
+                else:
+                    target_factory.write_file(self.success_token())
             logger.info('Mortar job_id [%s] completed successfully' % job_id)
 
     def _git_ref(self):
@@ -309,36 +500,83 @@ class MortarProjectTask(MortarTask):
         cluster_type = clusters.CLUSTER_TYPE_SINGLE_JOB if self.run_on_single_use_cluster \
             else clusters.CLUSTER_TYPE_PERSISTENT
         cluster_id = None
-        if self.cluster_size == 0:
+        claim = None
+        if self._job_cluster_size() == 0:
             # Use local cluster
             cluster_id = clusters.LOCAL_CLUSTER_ID
         elif not self.run_on_single_use_cluster:
-            # search for a suitable cluster
-            usable_clusters = self._get_usable_clusters(api, min_size=self.cluster_size)
-            if usable_clusters:
-                # grab the largest usable cluster
-                largest_cluster = sorted(usable_clusters, key=lambda c: int(c['size']), reverse=True)[0]
-                logger.info('Using largest running usable cluster with cluster_id [%s], size [%s]' % \
-                    (largest_cluster['cluster_id'], largest_cluster['size']))
-                cluster_id = largest_cluster['cluster_id']
-
-
-        if cluster_id:
-            job_id = jobs.post_job_existing_cluster(api, self.project(), self.script(), cluster_id,
-                git_ref=self._git_ref(), parameters=self.parameters(),
-                notify_on_job_finish=self.notify_on_job_finish, is_control_script=self.is_control_script(),
-                pig_version=self.pig_version, pipeline_job_id=self._get_pipeline_job_id())
-        else:
-            job_id = jobs.post_job_new_cluster(api, self.project(), self.script(), self.cluster_size,
-                cluster_type=cluster_type, git_ref=self._git_ref(), parameters=self.parameters(),
-                notify_on_job_finish=self.notify_on_job_finish, is_control_script=self.is_control_script(),
-                pig_version=self.pig_version, use_spot_instances=self.use_spot_instances, 
-                pipeline_job_id=self._get_pipeline_job_id())
+            cluster_id, claim = self._claim_usable_cluster(api)
+
+        cache = clustercache.get_cluster_cache()
+        try:
+            with timing.timed('job_submit', task=self.task_id, cluster_id=cluster_id) as event:
+                if cluster_id:
+                    job_id = jobs.post_job_existing_cluster(api, self.project(), self.script(), cluster_id,
+                        git_ref=self._git_ref(), parameters=self.parameters(),
+                        notify_on_job_finish=self.notify_on_job_finish, is_control_script=self.is_control_script(),
+                        pig_version=self.pig_version, pipeline_job_id=self._get_pipeline_job_id())
+                else:
+                    job_id = self._post_job_new_cluster(api, cluster_type)
+                event['job_id'] = job_id
+        finally:
+            if claim:
+                cache.forget_job(api, cluster_id, claim)
+        if claim:
+            cache.record_job(api, cluster_id, job_id, placement.JobDemand(self._job_cluster_size()))
         logger.info('Submitted new job to mortar with job_id [%s]' % job_id)
         return job_id
 
+    def _post_job_new_cluster(self, api, cluster_type, parameters=None):
+        return jobs.post_job_new_cluster(api, self.project(), self.script(), self._job_cluster_size(),
+            cluster_type=cluster_type, git_ref=self._git_ref(),
+            parameters=self.parameters() if parameters is None else parameters,
+            notify_on_job_finish=self.notify_on_job_finish, is_control_script=self.is_control_script(),
+            pig_version=self.pig_version, use_spot_instances=self.use_spot_instances,
+            pipeline_job_id=self._get_pipeline_job_id())
+
+    def placement_strategy(self):
+        """
+        The strategy used to choose which running cluster this job is placed on.
+        By default, the job is placed on the cluster whose free map and reduce
+        slots it fits most tightly, keeping large clusters free for large jobs.
+
+        Override this method to return
+        `mortar.luigi.placement.LargestClusterStrategy(self.share_running_cluster)`
+        to always use the largest usable cluster instead.
+
+        :rtype: :py:class:`mortar.luigi.placement.PlacementStrategy`:
+        :returns: placement strategy for this job
+        """
+        return placement.BestFitStrategy()
+
+    def _claim_usable_cluster(self, api):
+        """
+        Pick a running cluster for this job and record a placeholder job
+        on it in the shared cluster cache, so that tasks submitting at the
+        same time see each other's placements.
+
+        :rtype: tuple:
+        :returns: (cluster_id, placeholder job_id), or (None, None) if no cluster is usable
+        """
+        cache = clustercache.get_cluster_cache()
+        demand = placement.JobDemand(self._job_cluster_size())
+        with cache.lock:
+            # search for a suitable cluster
+            usable_clusters = self._get_usable_clusters(api, min_size=self._job_cluster_size())
+            job_demands = cache.job_demands()
+            candidates = [placement.ClusterSlots.from_cluster(c, job_demands) for c in usable_clusters]
+            chosen = self.placement_strategy().choose(candidates, demand)
+            if not chosen:
+                return (None, None)
+            logger.info('Using running usable cluster with cluster_id [%s], size [%s], free map slots [%s]' % \
+                (chosen.cluster_id, chosen.size, chosen.free_map_slots))
+            claim = 'pending-%s' % self.task_id
+            cache.record_job(api, chosen.cluster_id, claim, demand)
+            return (chosen.cluster_id, claim)
+
     def _get_usable_clusters(self, api, min_size=0):
-        return [cluster for cluster in clusters.get_clusters(api)['clusters'] \
+        cluster_list = clustercache.get_cluster_cache().get_clusters(api, ttl=self.cluster_cache_ttl)
+        return [cluster for cluster in cluster_list \
             if (    (cluster.get('status_code') == clusters.CLUSTER_STATUS_RUNNING)
                 and (cluster.get('cluster_type_code') != clusters.CLUSTER_TYPE_SINGLE_JOB)
                 and (int(cluster.get('size')) >= min_size)
@@ -347,59 +585,326 @@ class MortarProjectTask(MortarTask):
                )]
 
     def _poll_job_completion(self, api, job_id):
+        """
+        Block until the job completes. Polling is handled by the
+        process-wide :py:class:`mortar.luigi.jobpoller.JobPoller`, so
+        concurrent tasks share a single polling loop.
+        """
+        tailer = self._job_log_tailer(api)
+        if self.detect_stragglers:
+            return self._poll_job_attempts(api, job_id, tailer)
+        watch = jobpoller.get_job_poller().watch(api, job_id,
+            num_polling_retries=self.num_polling_retries,
+            policy=self.polling_policy())
+        watch.add_done_callback(self._record_job_finished)
+        if tailer is None:
+            return watch.wait()
+        try:
+            job = None
+            while job is None:
+                job = watch.wait(timeout=self.job_log_interval)
+                tailer.tail(job_id, force=True)
+            return job
+        finally:
+            self._report_stage_timings(tailer, job_id)
+
+    def job_log_source(self, api):
+        """
+        Where to read this job's log from when `tail_job_logs` is set.
+        By default, logs are read from the job_log_url configuration
+        item, if there is one. The Mortar API credentials are sent with
+        each request only if the URL is on the Mortar API host.
 
-        current_job_status = None
-        current_progress = None
+        Override this method to return another
+        :py:class:`mortar.luigi.joblogs.LogSource`.
 
-        exception_count = 0
-        while True:
-            try:
-                # fetch job
-                job = jobs.get_job(api, job_id)
-                new_job_status = job.get('status_code')
+        :rtype: :py:class:`mortar.luigi.joblogs.LogSource`:
+        :returns: source of job logs, or None if logs can't be read
+        """
+        config = luigi.configuration.get_config()
+        if config.has_option('mortar', 'job_log_url'):
+            url = config.get('mortar', 'job_log_url')
+            same_host = urlparse.urlsplit(url).hostname == getattr(api, 'host', None)
+            return joblogs.UrlLogSource(url, auth=getattr(api, 'auth', None) if same_host else None)
+        return None
 
+    def pig_stage_timings(self):
+        """
+        Timings of the Pig stages of this task's last job, parsed from its
+        log when `tail_job_logs` is set.
 
+        :rtype: list of dict:
+        :returns: stage timings, as returned by
+                  :py:meth:`mortar.luigi.joblogs.PigStageParser.stages`
+        """
+        return getattr(self, '_pig_stage_timings', [])
+
+    def _job_log_tailer(self, api):
+        if not self.tail_job_logs:
+            return None
+        source = self.job_log_source(api)
+        if source is None:
+            logger.warning('tail_job_logs is set, but there is no job_log_url configured')
+            return None
+        return joblogs.JobLogTailer(source, interval=self.job_log_interval)
+
+    def _report_stage_timings(self, tailer, job_id):
+        tailer.finish(job_id)
+        self._pig_stage_timings = tailer.stage_timings(job_id)
+        for stage in self._pig_stage_timings:
+            logger.info('Mortar job_id [%s] Pig stage %s (aliases %s) took %s seconds' % \
+                (job_id, stage['hadoop_job_id'], stage['aliases'], stage['duration_seconds']))
+            timing.emit('pig_stage', task=self.task_id, job_id=job_id, **stage)
+
+    def progress_history(self):
+        """
+        Target where the progress curves of past successful runs of this
+        task's script are kept, for straggler detection. By default, it is
+        stored underneath the path provided by the `token_path` method, e.g.:
 
-                # check for updated status
-                if new_job_status != current_job_status:
-                    current_job_status = new_job_status
-                    logger.info('Mortar job_id [%s] switched to status_code [%s], description: %s' % \
-                        (job_id, new_job_status, self._get_job_status_description(job)))
+        `s3://my-bucket/my-folder/progress/my_pig_script`
 
-                # check for updated progress on running job
-                if (new_job_status == jobs.STATUS_RUNNING) and (job.get('progress') != current_progress):
-                    current_progress = job.get('progress')
-                    logger.info('Mortar job_id [%s] progress: [%s%%]' % (job_id, current_progress))
+        :rtype: Target:
+        :returns: Target for the script's progress history
+        """
+        return target_factory.get_target('%s/progress/%s' % (self.token_path(), self.script()))
 
-                # final state
-                if current_job_status in jobs.COMPLETE_STATUSES:
+    def input_paths(self):
+        """
+        Paths of the data this job reads, used to choose a cluster size
+        when `auto_cluster_size` is set. Defaults to the paths of this
+        Task's inputs (the outputs of the Tasks it requires).
+
+        :rtype: list of str:
+        :returns: s3 or file URLs, or local paths, of the job's input data
+        """
+        return [t.path for t in luigi.task.flatten(self.input()) if hasattr(t, 'path')]
+
+    def sizing_history(self):
+        """
+        Target where the input sizes and timings of past successful runs of
+        this task's script are kept, for choosing a cluster size. By default,
+        it is stored underneath the path provided by the `token_path` method, e.g.:
+
+        `s3://my-bucket/my-folder/sizing/my_pig_script`
+
+        :rtype: Target:
+        :returns: Target for the script's sizing history
+        """
+        return target_factory.get_target('%s/sizing/%s' % (self.token_path(), self.script()))
+
+    def _job_cluster_size(self):
+        """
+        :rtype: int:
+        :returns: size of the cluster to run the job on: the size chosen
+                  when `auto_cluster_size` is set, else `cluster_size`
+        """
+        return getattr(self, '_chosen_cluster_size', None) or self.cluster_size
+
+    def _choose_cluster_size(self):
+        """
+        Choose the size of the cluster to run the job on from the total
+        bytes of the job's inputs. The `cluster_size` parameter is left
+        unchanged, so the task's identity is too.
+
+        :rtype: tuple:
+        :returns: (sizing model, input bytes) to record the run with
+        """
+        total_bytes = sum(autosize.input_bytes(path) for path in self.input_paths())
+        model = autosize.ClusterSizeModel.load(self.sizing_history(), bytes_per_node=self.bytes_per_node,
+                                               target_seconds=self.target_job_seconds)
+        self._chosen_cluster_size = model.cluster_size(total_bytes, min_size=self.min_cluster_size,
+                                                       max_size=self.max_cluster_size)
+        logger.info('Using cluster_size [%s] for %s bytes of input at %.0f bytes per node' % \
+            (self._chosen_cluster_size, total_bytes, model.fitted_bytes_per_node()))
+        return (model, total_bytes)
+
+    def _record_sizing(self, sizing, seconds):
+        (model, total_bytes) = sizing
+        model.add_run(total_bytes, self._job_cluster_size(), seconds)
+        try:
+            model.save(self.sizing_history())
+        except Exception:
+            logger.exception('Unable to save sizing history for %s' % self.script())
+
+    def _poll_job_attempts(self, api, job_id, tailer=None):
+        """
+        Wait for the job while watching for it to straggle, resubmitting it
+        if `speculative_resubmit` is set. Every attempt's job_id is recorded in
+        the running token, so a restarted task picks up all of them.
+
+        :rtype: dict:
+        :returns: final job details of the first attempt to succeed, or of
+                  the last attempt to fail
+        """
+        poller = jobpoller.get_job_poller()
+        model = straggler.ProgressModel.load(self.progress_history())
+        running_token = target_factory.get_target(self.running_token().path)
+        attempts = running_token.open().read().split() if running_token.exists() else [job_id]
+        finished = threading.Event()
+        watches = []
+
+        def watch(attempt_id):
+            w = poller.watch(api, attempt_id, num_polling_retries=self.num_polling_retries,
+                             policy=self.polling_policy())
+            w.add_done_callback(self._record_job_finished)
+            w.add_done_callback(lambda _: finished.set())
+            watches.append(w)
+
+        for attempt_id in attempts:
+            watch(attempt_id)
+        flagged = False
+        while True:
+            finished.clear()
+            for w in [w for w in watches if w.done()]:
+                watches.remove(w)
+                try:
+                    job = w.wait()
+                except Exception:
+                    if not watches:
+                        raise
+                    logger.exception('Failed to poll Mortar job_id [%s]: waiting on other attempts' % w.job_id)
+                    continue
+                if job.get('status_code') == jobs.STATUS_SUCCESS or not watches:
+                    self._stop_jobs(api, watches)
+                    if tailer:
+                        self._report_stage_timings(tailer, w.job_id)
+                    if job.get('status_code') == jobs.STATUS_SUCCESS:
+                        self._record_progress_history(model, w)
                     return job
-                else:
-                    # reset exception count on successful loop
-                    exception_count = 0
-
-                    # sleep and continue polling
-                    time.sleep(self.job_polling_interval)
-            except Exception, e:
-                if exception_count < self.num_polling_retries:
-                    exception_count += 1
-                    logger.info('Failure to get job status for job %s: %s' % (job_id, str(e)))
-                    time.sleep(self.job_polling_interval)
-                else:
-                    raise
+                logger.info('Mortar job_id [%s] failed: waiting on other attempts' % w.job_id)
+
+            first = watches[0]
+            if not flagged and first.running_since is not None:
+                elapsed = time.time() - first.running_since
+                # the API may report progress as a string
+                progress = int(float(first.current_progress or 0))
+                if model.is_straggling(elapsed, progress, slowdown=self.straggler_slowdown,
+                                       min_elapsed=self.min_straggler_seconds):
+                    flagged = True
+                    expected = model.expected_elapsed(min(100, progress + 1))
+                    logger.warning('Mortar job_id [%s] is straggling: %s%% complete after %.0fs, past runs took %.0fs' % \
+                        (first.job_id, progress, elapsed, expected))
+                    timing.emit('job_straggling', task=self.task_id, job_id=first.job_id,
+                                progress=progress, elapsed_seconds=elapsed,
+                                expected_seconds=expected)
+                    if self.speculative_resubmit and self._job_cluster_size() > 0 and len(attempts) == 1 \
+                            and self._can_resubmit():
+                        attempt_id = self._run_speculative_job(api)
+                        attempts.append(attempt_id)
+                        # to guarantee idempotence, record every running attempt
+                        target_factory.write_file(self.running_token(), text='\n'.join(attempts))
+                        watch(attempt_id)
+            if tailer:
+                for w in watches:
+                    tailer.tail(w.job_id)
+            finished.wait(jobpoller.WAIT_SLICE_SECONDS)
+
+    def job_stop_supported(self):
+        """
+        Whether the Mortar API can stop a running job, which `speculative_resubmit`
+        relies on to stop the slower attempt. The Mortar v2 API client has no call
+        to stop a job, so this is False unless the optional `job_stop_supported`
+        option in the [mortar] section is set to true.
+
+        :rtype: bool:
+        :returns: whether DELETE jobs/<job_id> stops a job
+        """
+        config = luigi.configuration.get_config()
+        return config.has_option('mortar', 'job_stop_supported') \
+            and config.getboolean('mortar', 'job_stop_supported')
 
-    def _get_job_status_description(self, job):
-        desc = job.get('status_description')
-        if job.get('status_details'):
-            desc += ' - %s' % job.get('status_details')
-        return desc
+    def speculative_parameters(self):
+        """
+        Parameters to pass to a speculative attempt of a straggling job.
+        Both attempts would otherwise write to the same `script_output`, so
+        a task with script output is only resubmitted if this method is
+        overridden to give the attempt its own output location.
 
-    def _get_pipeline_job_id(self):
+        :rtype: dict:
+        :returns: parameters for the speculative attempt, or None to use
+                  `parameters`. Default: None
         """
-        Get the job_id for the parent luigi pipeline 
-        that executed this Pig job, if applicable.
+        return None
+
+    def _can_resubmit(self):
+        if not self.job_stop_supported():
+            logger.warning('Not resubmitting straggling job: the Mortar API is not known to stop jobs. ' + \
+                'Set job_stop_supported in the [mortar] section if it does.')
+            return False
+        if self.script_output() and self.speculative_parameters() is None:
+            logger.warning('Not resubmitting straggling job: both attempts would write to %s. ' % \
+                ', '.join(str(getattr(out, 'path', out)) for out in self.script_output()) + \
+                'Override speculative_parameters to give the attempt its own output location.')
+            return False
+        return True
+
+    def _run_speculative_job(self, api):
+        cluster_type = clusters.CLUSTER_TYPE_SINGLE_JOB if self.run_on_single_use_cluster \
+            else clusters.CLUSTER_TYPE_PERSISTENT
+        job_id = self._post_job_new_cluster(api, cluster_type, parameters=self.speculative_parameters())
+        logger.info('Resubmitted straggling job to a new cluster with job_id [%s]' % job_id)
+        return job_id
+
+    def _stop_jobs(self, api, watches):
         """
-        return os.environ.get('PIPELINE_JOB_ID')
+        Stop the attempts still running once another has finished. The
+        Mortar v2 API client has no call to stop a job, so this sends
+        DELETE jobs/<job_id> (see `job_stop_supported`). An attempt that
+        could not be stopped is still running and may still write output,
+        so it is waited for before returning.
+        """
+        unstopped = []
+        for w in watches:
+            logger.info('Stopping Mortar job_id [%s]: another attempt finished first' % w.job_id)
+            try:
+                api.delete('jobs/%s' % w.job_id)
+            except Exception:
+                logger.exception('Failed to stop Mortar job_id [%s]' % w.job_id)
+                unstopped.append(w)
+        for w in unstopped:
+            logger.warning('Waiting for Mortar job_id [%s] to finish, as it could not be stopped' % w.job_id)
+            try:
+                w.wait()
+            except Exception:
+                logger.exception('Failed to poll Mortar job_id [%s]' % w.job_id)
+
+    def _record_job_finished(self, watch):
+        # the cluster is idle from now, not from when it was started
+        cluster_id = (watch.job or {}).get('cluster_id')
+        if cluster_id and cluster_id != clusters.LOCAL_CLUSTER_ID:
+            clustercache.get_cluster_cache().record_job_finished(cluster_id)
+
+    def _record_progress_history(self, model, watch):
+        if watch.running_since is None:
+            return
+        model.add_run(watch.progress_curve() + [(time.time() - watch.running_since, 100)])
+        try:
+            model.save(self.progress_history())
+        except Exception:
+            logger.exception('Unable to save progress history for %s' % self.script())
+
+    def polling_policy(self):
+        """
+        The schedule used to poll the Mortar API for this job's status.
+        By default, polls slowly while a cluster starts up and then
+        based on the job's progress rate. Local mode jobs (cluster_size = 0)
+        never wait on a cluster, so they are polled more eagerly.
+
+        Override this method to return a :py:class:`mortar.luigi.jobpoller.FixedPollingPolicy`
+        to poll every `job_polling_interval` seconds instead.
+
+        :rtype: :py:class:`mortar.luigi.jobpoller.AdaptivePollingPolicy` or
+                :py:class:`mortar.luigi.jobpoller.FixedPollingPolicy`:
+        :returns: polling policy for this job: an AdaptivePollingPolicy
+                  unless overridden
+        """
+        if self.cluster_size == 0:
+            return jobpoller.AdaptivePollingPolicy(interval=1, min_interval=1,
+                max_interval=self.job_polling_interval, starting_interval=1)
+        return jobpoller.AdaptivePollingPolicy(interval=self.job_polling_interval, min_interval=1,
+            max_interval=self.max_job_polling_interval,
+            starting_interval=self.cluster_starting_polling_interval)
 
 
 class MortarProjectPigscriptTask(MortarProjectTask):
@@ -432,6 +937,116 @@ class MortarProjectControlscriptTask(MortarProjectTask):
     def is_control_script(self):
         return True
 
+def run_concurrently(tasks, max_submit_threads=8):
+    """
+    Run many MortarProjectTasks from a single thread of control.
+
+    Jobs are submitted concurrently from a small thread pool, then their
+    completion is awaited through the shared job poller; each task is
+    finished as soon as its own job completes. Every task goes through the
+    same steps as `MortarProjectTask.run`: cluster sizing, the running/success
+    token protocol, log tailing, straggler detection and sizing history.
+    Waiting takes a thread per job, blocked until the shared poller
+    reports on it.
+
+    :type tasks: list of :py:class:`MortarProjectTask`
+    :param tasks: tasks to run
+
+    :type max_submit_threads: int
+    :param max_submit_threads: maximum number of jobs being submitted at once
+
+    :raises: Exception if any task failed, after all tasks have finished
+    """
+    completed = Queue.Queue()
+    failures = []
+
+    def start(task):
+        api = task._get_api()
+        return (api, task._start_job(api))
+
+    def complete(task, api, started):
+        try:
+            task._complete_job(api, started)
+            completed.put((task, None))
+        except Exception as e:
+            logger.exception('Mortar job for %s failed' % task)
+            completed.put((task, e))
+
+    pool = ThreadPool(max(1, min(max_submit_threads, len(tasks))))
+    try:
+        submissions = [(task, pool.apply_async(start, (task,))) for task in tasks]
+        outstanding = 0
+        for (task, submission) in submissions:
+            try:
+                (api, started) = submission.get()
+            except Exception as e:
+                logger.exception('Failed to submit Mortar job for %s' % task)
+                failures.append((task, e))
+                continue
+            waiter = threading.Thread(target=complete, args=(task, api, started),
+                                      name='mortar-job-%s' % started[0])
+            waiter.daemon = True
+            waiter.start()
+            outstanding += 1
+    finally:
+        pool.close()
+
+    while outstanding:
+        try:
+            (task, error) = completed.get(timeout=jobpoller.WAIT_SLICE_SECONDS)
+        except Queue.Empty:
+            continue
+        outstanding -= 1
+        if error is not None:
+            failures.append((task, error))
+
+    if failures:
+        raise Exception('%s of %s Mortar tasks failed: %s' % \
+            (len(failures), len(tasks), ', '.join('%s: %s' % (t, e) for (t, e) in failures)))
+
+class MortarProjectTaskGroup(luigi.Task):
+    """
+    Luigi Task that drives a group of MortarProjectTasks at once
+    from a single luigi worker, rather than occupying one worker
+    per running Mortar job.
+
+    To use this class, create a subclass that overrides the `tasks`
+    method. The group requires everything its tasks require, and is
+    complete once all of its tasks are complete.
+    """
+
+    # Maximum number of jobs being submitted to Mortar at once.
+    max_submit_threads = luigi.IntParameter(default=8)
+
+    @abc.abstractmethod
+    def tasks(self):
+        """
+        Override this method to provide the tasks to run together.
+
+        :rtype: list of MortarProjectTask:
+        :returns: tasks to run
+        """
+        raise RuntimeError("Please implement the tasks method")
+
+    def requires(self):
+        return luigi.task.flatten([task.requires() for task in self.tasks()])
+
+    def output(self):
+        """
+        The output for this Task: the outputs of all of its tasks.
+
+        :rtype: list of Target:
+        :returns: outputs of every task in the group
+        """
+        return [task.output() for task in self.tasks()]
+
+    def run(self):
+        """
+        Run every incomplete task in the group concurrently.
+        """
+        run_concurrently([task for task in self.tasks() if not task.complete()],
+                         max_submit_threads=self.max_submit_threads)
+
 class MortarRTask(luigi.Task):
     """
     Luigi Task to run an R script.
@@ -456,7 +1071,7 @@ class MortarRTask(luigi.Task):
         :rtype: Target:
         :returns: Target for Task completion token
         """
-        return target_factory.get_target('%s/%s' % (self.token_path, self.__class__.__name__))
+        return target_factory.get_token_target('%s/%s' % (self.token_path, self.__class__.__name__))
 
     def output(self):
         """
@@ -527,21 +1142,258 @@ class MortarClusterShutdownTask(MortarTask):
     Luigi Task to shuts down all running clusters 
     without active jobs for the specified user.
 
+    Clusters are stopped concurrently. By default every idle cluster is
+    stopped; the parameters below keep recently used clusters warm for
+    the next wave of jobs while capping spend.
+
     seealso:: https://help.mortardata.com/technologies/luigi/cluster_management_tasks
     """
 
-    def _get_running_idle_clusters(self, api):
-        return [c for c in clusters.get_clusters(api).get('clusters') if not c.get('running_jobs')
-            and c.get('status_code') == clusters.CLUSTER_STATUS_RUNNING]
+    # Maximum number of clusters being stopped at once.
+    max_stop_threads = luigi.IntParameter(default=5)
+
+    # Minimum time (in seconds) a cluster must have been idle
+    # before it is stopped.
+    min_idle_seconds = luigi.IntParameter(default=0)
+
+    # Number of idle clusters of keep_warm_cluster_size to keep running.
+    keep_warm_clusters = luigi.IntParameter(default=0)
+
+    # Size of the idle clusters to keep warm.
+    keep_warm_cluster_size = luigi.IntParameter(default=2)
+
+    # Ceiling on the hourly cost of all running clusters. When running
+    # clusters cost more, idle clusters are stopped regardless of
+    # min_idle_seconds and keep_warm_clusters.  Default: no ceiling.
+    max_hourly_cost = luigi.FloatParameter(default=None)
+
+    # Hourly cost of one cluster node, used with max_hourly_cost.
+    node_hourly_cost = luigi.FloatParameter(default=idlepolicy.DEFAULT_NODE_HOURLY_COST)
+
+    def idle_policy(self):
+        """
+        The policy deciding which idle clusters to stop.
+
+        :rtype: :py:class:`mortar.luigi.idlepolicy.IdleClusterPolicy`:
+        :returns: idle cluster policy
+        """
+        return idlepolicy.IdleClusterPolicy(min_idle_seconds=self.min_idle_seconds,
+            keep_warm={self.keep_warm_cluster_size: self.keep_warm_clusters},
+            max_hourly_cost=self.max_hourly_cost, node_hourly_cost=self.node_hourly_cost)
+
+    def _get_running_clusters(self, api):
+        return [c for c in clusters.get_clusters(api).get('clusters')
+            if c.get('status_code') == clusters.CLUSTER_STATUS_RUNNING]
+
+    def _idle_since(self, cluster):
+        """
+        When a cluster became idle: the last time this process saw it
+        busy, otherwise when the cluster was started.
+        """
+        last_busy = clustercache.get_cluster_cache().last_busy(cluster.get('cluster_id'))
+        if last_busy is not None:
+            return last_busy
+        return idlepolicy.parse_timestamp(cluster.get('start_timestamp'))
 
     def run(self):
         """
-        Shut down all running clusters without active jobs.
+        Shut down the running clusters without active jobs chosen by the `idle_policy`.
         """
         api = self._get_api()
-        active_clusters = self._get_running_idle_clusters(api)
-        for c in active_clusters:
-            logger.info('Stopping idle cluster %s' % c.get('cluster_id'))
-            clusters.stop_cluster(api, c.get('cluster_id'))
+        running_clusters = self._get_running_clusters(api)
+        to_stop = self.idle_policy().clusters_to_stop(running_clusters, self._idle_since)
+        kept = len([c for c in running_clusters if not c.get('running_jobs')]) - len(to_stop)
+        if kept:
+            logger.info('Keeping %s idle clusters running' % kept)
+
+        def stop(cluster):
+            logger.info('Stopping idle cluster %s' % cluster.get('cluster_id'))
+            try:
+                clusters.stop_cluster(api, cluster.get('cluster_id'))
+            except Exception as e:
+                logger.exception('Failed to stop cluster %s' % cluster.get('cluster_id'))
+                return (cluster.get('cluster_id'), e)
+
+        failures = []
+        if to_stop:
+            pool = ThreadPool(max(1, min(self.max_stop_threads, len(to_stop))))
+            try:
+                failures = [f for f in pool.map(stop, to_stop) if f]
+            finally:
+                pool.close()
+        # stopped clusters must not be offered to new jobs
+        clustercache.get_cluster_cache().invalidate(api)
+        if failures:
+            raise Exception('Failed to stop %s of %s clusters: %s' % \
+                (len(failures), len(to_stop), ', '.join('%s: %s' % f for f in failures)))
+
+def pending_cluster_demands(tasks):
+    """
+    Find the incomplete MortarProjectTasks in the dependency graphs of
+    `tasks` that will need a Hadoop cluster of their own choosing: those
+    that neither run in local mode nor on a single use cluster.
+    Completed tasks are not searched further. Tasks with `auto_cluster_size`
+    set are sized from the inputs present when this is called.
+
+    :type tasks: list of luigi.Task
+    :param tasks: root tasks of the pipeline
+
+    :rtype: list of :py:class:`mortar.luigi.placement.JobDemand`:
+    :returns: slots needed by each pending job
+    """
+    demands = []
+    seen = set()
+    to_visit = list(tasks)
+    while to_visit:
+        task = to_visit.pop()
+        if task.task_id in seen:
+            continue
+        seen.add(task.task_id)
+        if task.complete():
+            continue
+        if isinstance(task, MortarProjectTask) and task.cluster_size > 0 \
+                and not task.run_on_single_use_cluster:
+            if task.auto_cluster_size:
+                try:
+                    task._choose_cluster_size()
+                except Exception:
+                    logger.exception('Unable to choose a cluster size for %s: using cluster_size' % task)
+            demands.append(placement.JobDemand(task._job_cluster_size()))
+        to_visit.extend(luigi.task.flatten(task.requires()))
+    return demands
+
+class MortarClusterWarmUpTask(MortarTask):
+    """
+    Luigi Task that starts persistent clusters ahead of need for the
+    pending MortarProjectTasks of a pipeline, so that cluster boot time
+    overlaps with upstream work (e.g. data extraction) instead of
+    delaying the first Mortar job.
+
+    The task looks at the incomplete MortarProjectTasks in the dependency
+    graph of `pipeline_tasks`, matches them to clusters that are already
+    running or starting, and starts a cluster of the needed cluster_size
+    for each job left over, up to `max_clusters`. Each cluster is started by
+    running the `warm_up_script` on a new persistent cluster, which stays
+    up for later jobs once the script finishes.
+
+    The task is complete once no cluster needs starting: every pending
+    job fits on a cluster that is running or starting.
+
+    Schedule this task alongside the pipeline rather than as a
+    dependency of it, e.g. from a WrapperTask that requires both.
+    """
+
+    # Maximum number of clusters to start.
+    max_clusters = luigi.IntParameter(default=4)
+
+    # Whether started clusters take advantage of AWS Spot Pricing.
+    use_spot_instances = luigi.BooleanParameter(True)
+
+    # Version of Pig to use for the warm up script.
+    pig_version = luigi.Parameter(default='0.12')
+
+    # Maximum age (in seconds) of a launch plan to reuse, so that
+    # repeated calls to complete() while luigi schedules the pipeline
+    # don't walk its graph and list clusters every time.  Set to 0
+    # to plan on every call.
+    plan_ttl = luigi.IntParameter(default=60)
 
+    @abc.abstractmethod
+    def pipeline_tasks(self):
+        """
+        Override this method to provide the root tasks of the
+        pipeline to start clusters for.
+
+        :rtype: list of luigi.Task:
+        :returns: pipeline root tasks
+        """
+        raise RuntimeError("Please implement the pipeline_tasks method")
+
+    @abc.abstractmethod
+    def warm_up_script(self):
+        """
+        Override this method to provide the name of the script run to
+        start each cluster. It should do as little work as possible.
 
+        :rtype: str:
+        :returns: Script name, e.g. warm_up_cluster
+        """
+        raise RuntimeError("Please implement the warm_up_script method")
+
+    def project(self):
+        """
+        Name of the Mortar Project containing the `warm_up_script`.
+        Defaults to the project_name configuration item.
+
+        :rtype: str:
+        :returns: Your project name, e.g. my-mortar-recsys
+        """
+        if luigi.configuration.get_config().has_option('mortar', 'project_name'):
+            return luigi.configuration.get_config().get('mortar', 'project_name')
+        raise RuntimeError("Please implement the project method or provide a project_name configuration item to return your project name")
+
+    def complete(self):
+        """
+        Complete once every pending job fits on a cluster that is
+        running or starting, so no cluster needs to be started.
+        """
+        return not self._planned_launches(self._get_api())
+
+    def run(self):
+        """
+        Start clusters for pending jobs that no running or starting cluster can take.
+        """
+        api = self._get_api()
+        sizes = self._planned_launches(api)
+        cache = clustercache.get_cluster_cache()
+        for size in sizes:
+            job_id = jobs.post_job_new_cluster(api, self.project(), self.warm_up_script(), size,
+                cluster_type=clusters.CLUSTER_TYPE_PERSISTENT, notify_on_job_finish=False,
+                pig_version=self.pig_version, use_spot_instances=self.use_spot_instances,
+                pipeline_job_id=self._get_pipeline_job_id())
+            logger.info('Starting cluster of size [%s] with warm up job_id [%s]' % (size, job_id))
+        # the started clusters are all this run plans for
+        self._plan = (time.time(), [])
+        if sizes:
+            # starting clusters should be seen by the next cluster lookup
+            cache.invalidate(api)
+
+    def _planned_launches(self, api):
+        """
+        The launch plan made within the last `plan_ttl` seconds, or a new one.
+        """
+        plan = getattr(self, '_plan', None)
+        if plan is None or time.time() - plan[0] >= self.plan_ttl:
+            plan = (time.time(), self._plan_launches(api))
+            self._plan = plan
+        return plan[1]
+
+    def _plan_launches(self, api):
+        """
+        :rtype: list of int:
+        :returns: size of each cluster to start, at most `max_clusters`
+        """
+        demands = pending_cluster_demands(self.pipeline_tasks())
+        cache = clustercache.get_cluster_cache()
+        candidates = self._get_warm_clusters(cache.get_clusters(api, ttl=0), cache.job_demands())
+        sizes = placement.plan_cluster_launches(placement.BestFitStrategy(), candidates, demands,
+                                                max_launches=self.max_clusters)
+        logger.info('%s pending Mortar jobs need a cluster, %s clusters running or starting: %s clusters to start' % \
+            (len(demands), len(candidates), len(sizes)))
+        return sizes
+
+    def _get_warm_clusters(self, cluster_list, job_demands):
+        """
+        Slot models of the reusable clusters that are running or starting.
+        Starting clusters are counted as free: the only job on them is
+        expected to be a warm up script.
+        """
+        candidates = []
+        for c in cluster_list:
+            if c.get('cluster_type_code') == clusters.CLUSTER_TYPE_SINGLE_JOB:
+                continue
+            if c.get('status_code') == clusters.CLUSTER_STATUS_RUNNING:
+                candidates.append(placement.ClusterSlots.from_cluster(c, job_demands))
+            elif c.get('status_code') in (clusters.CLUSTER_STATUS_PENDING, clusters.CLUSTER_STATUS_STARTING):
+                candidates.append(placement.ClusterSlots(c.get('cluster_id'), int(c.get('size'))))
+        return candidates
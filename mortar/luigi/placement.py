@@ -0,0 +1,284 @@
+# Copyright (c) 2014 Mortar Data
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+import abc
+import heapq
+
+# Number of map task slots per m1.xlarge instance
+NUM_MAP_SLOTS_PER_MACHINE = 8
+
+# Number of reduce task slots per m1.xlarge instance
+NUM_REDUCE_SLOTS_PER_MACHINE = 3
+
+# Running jobs on a cluster that were not placed by this process
+# are assumed to need the slots of a job of this cluster_size.
+DEFAULT_JOB_CLUSTER_SIZE = 2
+
+
+class JobDemand(object):
+    """
+    Slots a Mortar job needs: the map and reduce slots
+    of a cluster of the job's `cluster_size`.
+    """
+
+    def __init__(self, cluster_size):
+        self.cluster_size = cluster_size
+        self.map_slots = cluster_size * NUM_MAP_SLOTS_PER_MACHINE
+        self.reduce_slots = cluster_size * NUM_REDUCE_SLOTS_PER_MACHINE
+
+    def __repr__(self):
+        return 'JobDemand(%s)' % self.cluster_size
+
+
+class ClusterSlots(object):
+    """
+    Model of the free map and reduce slots on a running cluster.
+    """
+
+    def __init__(self, cluster_id, size, free_map_slots=None, free_reduce_slots=None):
+        self.cluster_id = cluster_id
+        self.size = size
+        self.map_slots = size * NUM_MAP_SLOTS_PER_MACHINE
+        self.reduce_slots = size * NUM_REDUCE_SLOTS_PER_MACHINE
+        self.free_map_slots = self.map_slots if free_map_slots is None else free_map_slots
+        self.free_reduce_slots = self.reduce_slots if free_reduce_slots is None else free_reduce_slots
+
+    @classmethod
+    def from_cluster(cls, cluster, job_demands=None):
+        """
+        Build a slot model from cluster details returned by the Mortar API.
+
+        :type cluster: dict
+        :param cluster: cluster details, as returned by `clusters.get_clusters`
+
+        :type job_demands: dict
+        :param job_demands: known :py:class:`JobDemand` of running jobs, by job_id.
+                            Other running jobs are assumed to need the slots of a
+                            job of `DEFAULT_JOB_CLUSTER_SIZE`.
+
+        :rtype: :py:class:`ClusterSlots`:
+        :returns: slot model for the cluster
+        """
+        job_demands = job_demands or {}
+        slots = cls(cluster.get('cluster_id'), int(cluster.get('size')))
+        for job_id in cluster.get('running_jobs') or []:
+            slots.allocate(job_demands.get(job_id) or JobDemand(DEFAULT_JOB_CLUSTER_SIZE))
+        return slots
+
+    def fits(self, demand):
+        """
+        Whether a job can be placed on this cluster: the cluster must be
+        at least the job's cluster_size and have enough free slots.
+
+        :rtype: bool:
+        :returns: True if the job fits
+        """
+        return self.size >= demand.cluster_size \
+            and self.free_map_slots >= demand.map_slots \
+            and self.free_reduce_slots >= demand.reduce_slots
+
+    def idle(self):
+        """
+        :rtype: bool:
+        :returns: True if no job is running on this cluster
+        """
+        return self.free_map_slots == self.map_slots and self.free_reduce_slots == self.reduce_slots
+
+    def allocate(self, demand):
+        self.free_map_slots -= demand.map_slots
+        self.free_reduce_slots -= demand.reduce_slots
+
+    def release(self, demand):
+        self.free_map_slots += demand.map_slots
+        self.free_reduce_slots += demand.reduce_slots
+
+    def __repr__(self):
+        return 'ClusterSlots(%s, size=%s, free_map_slots=%s, free_reduce_slots=%s)' % \
+            (self.cluster_id, self.size, self.free_map_slots, self.free_reduce_slots)
+
+
+class PlacementStrategy(object):
+    """
+    Superclass for strategies that choose which running
+    cluster a Mortar job should be placed on.
+    """
+
+    @abc.abstractmethod
+    def choose(self, candidates, demand):
+        """
+        Choose a cluster for a job.
+
+        :type candidates: list of :py:class:`ClusterSlots`
+        :param candidates: running clusters the job may use
+
+        :type demand: :py:class:`JobDemand`
+        :param demand: slots needed by the job
+
+        :rtype: :py:class:`ClusterSlots`:
+        :returns: the chosen cluster, or None to start a new cluster
+        """
+        raise RuntimeError("Please implement the choose method")
+
+    def place_all(self, candidates, demands):
+        """
+        Place several pending jobs at once, allocating slots on the
+        chosen clusters as each job is placed.
+
+        :type candidates: list of :py:class:`ClusterSlots`
+        :param candidates: running clusters the jobs may use
+
+        :type demands: list of :py:class:`JobDemand`
+        :param demands: slots needed by each pending job
+
+        :rtype: list of :py:class:`ClusterSlots`:
+        :returns: the chosen cluster (or None) for each demand, in the order given
+        """
+        placements = [None] * len(demands)
+        for i in self._placement_order(demands):
+            chosen = self.choose(candidates, demands[i])
+            if chosen:
+                chosen.allocate(demands[i])
+                placements[i] = chosen
+        return placements
+
+    def _placement_order(self, demands):
+        return range(len(demands))
+
+
+class LargestClusterStrategy(PlacementStrategy):
+    """
+    Place each job on the largest cluster at least its cluster_size,
+    whatever its free slots: the selection made before slots were
+    modeled. Only idle clusters are used unless `share_running_cluster`.
+    """
+
+    def __init__(self, share_running_cluster=False):
+        """
+        :type share_running_cluster: bool
+        :param share_running_cluster: whether jobs may be placed on
+                                      clusters already running jobs
+        """
+        self.share_running_cluster = share_running_cluster
+
+    def choose(self, candidates, demand):
+        usable = [c for c in candidates if c.size >= demand.cluster_size
+                  and (self.share_running_cluster or c.idle())]
+        if not usable:
+            return None
+        return sorted(usable, key=lambda c: c.size, reverse=True)[0]
+
+
+class BestFitStrategy(PlacementStrategy):
+    """
+    Place each job on the cluster it fits on most tightly, leaving the
+    fewest free slots behind. Small jobs fill small clusters and
+    large clusters stay free for large jobs. When placing several jobs
+    at once the largest are placed first (best-fit decreasing).
+    """
+
+    def choose(self, candidates, demand):
+        fitting = [c for c in candidates if c.fits(demand)]
+        if not fitting:
+            return None
+        return sorted(fitting, key=lambda c: (c.free_map_slots - demand.map_slots,
+                                              c.free_reduce_slots - demand.reduce_slots,
+                                              c.size))[0]
+
+    def _placement_order(self, demands):
+        return sorted(range(len(demands)), key=lambda i: demands[i].cluster_size, reverse=True)
+
+
+def simulate(strategy, cluster_sizes, jobs):
+    """
+    Simulate running a workload on a fixed set of clusters and report
+    its makespan. Jobs that don't fit anywhere wait until running jobs
+    free up enough slots.
+
+    :type strategy: :py:class:`PlacementStrategy`
+    :param strategy: placement strategy to simulate
+
+    :type cluster_sizes: list of int
+    :param cluster_sizes: size of each available cluster
+
+    :type jobs: list of tuple
+    :param jobs: (submit_time, cluster_size, duration) for each job
+
+    :rtype: float:
+    :returns: time at which the last job finishes
+    """
+    candidates = [ClusterSlots('cluster-%s' % i, size) for (i, size) in enumerate(cluster_sizes)]
+    largest = max(cluster_sizes)
+    for (_, cluster_size, _) in jobs:
+        if cluster_size > largest:
+            raise ValueError('No cluster is large enough for a job of cluster_size %s' % cluster_size)
+
+    pending = sorted(jobs)
+    queued = []
+    running = []
+    now = 0
+    makespan = 0
+    while pending or queued or running:
+        while pending and pending[0][0] <= now:
+            queued.append(pending.pop(0))
+
+        placements = strategy.place_all(candidates, [JobDemand(j[1]) for j in queued])
+        waiting = []
+        for (job, chosen) in zip(queued, placements):
+            if chosen:
+                heapq.heappush(running, (now + job[2], id(job), JobDemand(job[1]), chosen))
+            else:
+                waiting.append(job)
+        queued = waiting
+
+        next_times = []
+        if pending:
+            next_times.append(pending[0][0])
+        if running:
+            next_times.append(running[0][0])
+        now = min(next_times)
+        while running and running[0][0] <= now:
+            (end_time, _, demand, cluster) = heapq.heappop(running)
+            cluster.release(demand)
+            makespan = max(makespan, end_time)
+    return makespan
+
+
+def plan_cluster_launches(strategy, candidates, demands, max_launches=None):
+    """
+    Decide which new clusters to start ahead of need for a set of
+    pending jobs. Pending jobs are first placed on the `candidates`
+    (running or starting clusters); a cluster of its own cluster_size
+    is planned for each job left over, largest first.
+
+    :type strategy: :py:class:`PlacementStrategy`
+    :param strategy: placement strategy used to match jobs to existing clusters
+
+    :type candidates: list of :py:class:`ClusterSlots`
+    :param candidates: clusters that are running or already starting
+
+    :type demands: list of :py:class:`JobDemand`
+    :param demands: slots needed by each pending job
+
+    :type max_launches: int
+    :param max_launches: maximum number of clusters to plan, or None for no limit
+
+    :rtype: list of int:
+    :returns: size of each cluster to start
+    """
+    placements = strategy.place_all(candidates, demands)
+    sizes = sorted([d.cluster_size for (d, chosen) in zip(demands, placements) if not chosen],
+                   reverse=True)
+    if max_launches is not None:
+        sizes = sizes[:max_launches]
+    return sizes
@@ -18,7 +18,8 @@ import logging
 
 import luigi
 from luigi.contrib import redshift
-from luigi.s3 import S3Client
+
+from mortar.luigi import target_factory
 
 logger = logging.getLogger('luigi-interface')
 
@@ -74,14 +75,14 @@ class CopyPigOutputToRedshiftTask(redshift.S3CopyToTable):
         self.columns = redshift_schema;
 
     def _read_schema_file(self):
-        s3Client = S3Client()
-        if not s3Client.exists(self.s3_schema_path()):
-            raise Exception("No schema file located at %s.  Can not set Redshift columns." % s3_schema_path)
+        # read through target_factory so repeated reads can be served from the S3 cache
+        schema_target = target_factory.get_target(self.s3_schema_path())
+        if not schema_target.exists():
+            raise Exception("No schema file located at %s.  Can not set Redshift columns." % self.s3_schema_path())
         else:
             logger.info("Found schema file %s" % self.s3_schema_path())
 
-        schema_key = s3Client.get_key(self.s3_schema_path())
-        return schema_key.get_contents_as_string()
+        return schema_target.open('r').read()
 
 
 # Pig Type values defined here: https://github.com/apache/pig/blob/trunk/src/org/apache/pig/data/DataType.java#L60
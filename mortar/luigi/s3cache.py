@@ -0,0 +1,192 @@
+# Copyright (c) 2014 Mortar Data
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+import glob
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+
+from luigi.format import FileWrapper
+from luigi.s3 import FileNotFoundException, S3Target
+
+logger = logging.getLogger('luigi-interface')
+
+# Default maximum size of the cache on disk
+DEFAULT_MAX_BYTES = 1024 ** 3
+
+_TMP_PREFIX = '.tmp-'
+
+
+class DiskCache(object):
+    """
+    Size-bounded local disk cache of S3 objects, keyed by S3 path and ETag.
+
+    An entry is only used while the object's ETag is unchanged, so
+    overwritten objects are never served stale. When the cache grows
+    past `max_bytes`, the least recently used entries are removed. The
+    cache directory may be shared by several processes and kept across runs.
+    """
+
+    def __init__(self, directory, max_bytes=DEFAULT_MAX_BYTES):
+        """
+        :type directory: str
+        :param directory: local directory holding cached objects
+
+        :type max_bytes: int
+        :param max_bytes: maximum total size of cached objects
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def get(self, path, etag):
+        """
+        :rtype: str:
+        :returns: local path of the cached object, or None if it is not cached
+        """
+        entry = self._entry_path(path, etag)
+        try:
+            # mark as recently used
+            os.utime(entry, None)
+        except OSError:
+            with self.lock:
+                self.misses += 1
+            return None
+        with self.lock:
+            self.hits += 1
+        return entry
+
+    def put(self, path, etag, download):
+        """
+        Add an object to the cache, replacing any other version of it.
+
+        :type download: function
+        :param download: called with a local path, writes the object there
+
+        :rtype: str:
+        :returns: local path of the cached object
+        """
+        entry = self._entry_path(path, etag)
+        (fd, tmp_path) = tempfile.mkstemp(prefix=_TMP_PREFIX, dir=self.directory)
+        os.close(fd)
+        try:
+            download(tmp_path)
+            os.rename(tmp_path, entry)
+        except:
+            os.remove(tmp_path)
+            raise
+        for stale in glob.glob(self._entry_path(path, '*')):
+            if stale != entry:
+                _remove_quietly(stale)
+        self.evict(keep=entry)
+        return entry
+
+    def evict(self, keep=None):
+        """
+        Remove the least recently used entries until the cache fits in `max_bytes`.
+
+        :type keep: str
+        :param keep: local path of an entry never to remove
+        """
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.startswith(_TMP_PREFIX):
+                continue
+            entry = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(entry)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, entry, stat.st_size))
+        total = sum(size for (_, _, size) in entries)
+        for (_, entry, size) in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if entry != keep:
+                _remove_quietly(entry)
+                total -= size
+
+    def _entry_path(self, path, etag):
+        return os.path.join(self.directory, '%s-%s' % (hashlib.sha1(path).hexdigest(), etag.strip('"')))
+
+
+def _remove_quietly(path):
+    try:
+        os.remove(path)
+    except OSError:
+        # already removed, e.g. by another process
+        pass
+
+
+class CachedS3Target(S3Target):
+    """
+    S3Target whose reads are served from a :py:class:`DiskCache`. Each
+    read checks the object's ETag with one HEAD request and downloads
+    it only if that version is not cached. Objects larger than the
+    whole cache are read directly from S3.
+    """
+
+    def __init__(self, path, cache, format=None, client=None):
+        """
+        :type cache: :py:class:`DiskCache`
+        :param cache: cache to read through
+        """
+        super(CachedS3Target, self).__init__(path, format=format, client=client)
+        self.cache = cache
+
+    def open(self, mode='r'):
+        if mode != 'r':
+            return super(CachedS3Target, self).open(mode)
+        (bucket_name, key_name) = self.fs._path_to_bucket_and_key(self.path)
+        key = self.fs.s3.get_bucket(bucket_name, validate=False).get_key(key_name)
+        if key is None:
+            raise FileNotFoundException("Could not find file at %s" % self.path)
+        if key.size > self.cache.max_bytes:
+            return super(CachedS3Target, self).open(mode)
+        local_path = self.cache.get(self.path, key.etag)
+        if local_path is None:
+            local_path = self.cache.put(self.path, key.etag, key.get_contents_to_filename)
+        try:
+            fileobj = FileWrapper(open(local_path, 'r'))
+        except IOError:
+            # evicted by another process since
+            fileobj = FileWrapper(open(self.cache.put(self.path, key.etag, key.get_contents_to_filename), 'r'))
+        if self.format:
+            return self.format.pipe_reader(fileobj)
+        return fileobj
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+def get_disk_cache(directory, max_bytes=DEFAULT_MAX_BYTES):
+    """
+    Get the shared :py:class:`DiskCache` for a directory in this process.
+
+    :rtype: :py:class:`DiskCache`:
+    :returns: cache for the directory
+    """
+    with _caches_lock:
+        cache = _caches.get(directory)
+        if cache is None:
+            cache = DiskCache(directory, max_bytes)
+            _caches[directory] = cache
+        cache.max_bytes = max_bytes
+        return cache
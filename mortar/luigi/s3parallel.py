@@ -0,0 +1,492 @@
+# Copyright (c) 2014 Mortar Data
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+import base64
+import hashlib
+import logging
+import mmap
+import os
+import tempfile
+import time
+from multiprocessing.pool import ThreadPool
+
+from mortar.luigi import checksum
+from mortar.luigi import lazyimport
+from mortar.luigi import timing
+
+boto_exception = lazyimport.LazyModule('boto.exception')
+boto_s3_key = lazyimport.LazyModule('boto.s3.key')
+
+logger = logging.getLogger('luigi-interface')
+
+# Default size of each byte range fetched by a parallel download,
+# and largest part size chosen for an upload within MAX_PARTS
+DEFAULT_PART_SIZE = 64 * 1024 ** 2
+
+# Default number of byte ranges fetched at once
+DEFAULT_THREADS = 8
+
+# S3 limits on multipart uploads
+MIN_PART_SIZE = 5 * 1024 ** 2
+MAX_PART_SIZE = 5 * 1024 ** 3
+MAX_PARTS = 10000
+
+# Smallest part size chosen for an upload; smaller files are uploaded in one request
+MIN_AUTO_PART_SIZE = 8 * 1024 ** 2
+
+
+def part_ranges(size, part_size):
+    """
+    Split an object into byte ranges.
+
+    :type size: int
+    :param size: object size in bytes
+
+    :type part_size: int
+    :param part_size: size of each range in bytes; the last may be smaller
+
+    :rtype: list of tuple:
+    :returns: (first byte, last byte) of each range, inclusive
+    """
+    return [(start, min(start + part_size, size) - 1) for start in range(0, size, part_size)]
+
+def download(key, local_path, part_size=DEFAULT_PART_SIZE, max_threads=DEFAULT_THREADS, verify=True):
+    """
+    Download an S3 object by fetching byte ranges of it in parallel and
+    writing each at its offset in a preallocated temporary file, which
+    is renamed to `local_path` once every range has been written.
+
+    Every range is fetched with the ETag of `key` as a precondition, so
+    an object overwritten mid-download fails the download rather than
+    producing a mix of versions. When the ETag can be computed from the
+    content, the download is checked against it: ranges are split at the
+    boundaries of the parts the object was uploaded in, so a range that
+    covers a whole uploaded part is verified with the MD5 boto computes
+    as it streams, and only uploaded parts split over several ranges are
+    hashed again from the downloaded file.
+
+    :type key: :py:class:`boto.s3.key.Key`
+    :param key: S3 object to download, as returned by `bucket.get_key`
+
+    :type local_path: str
+    :param local_path: where to write the object
+
+    :type part_size: int
+    :param part_size: size of each byte range
+
+    :type max_threads: int
+    :param max_threads: maximum number of byte ranges fetched at once
+
+    :type verify: bool
+    :param verify: whether to check the download against the ETag
+    """
+    size = key.size
+    layout = checksum.etag_part_size(key, part_size) if verify else None
+    if verify and layout is None:
+        logger.warning('Cannot verify download of s3://%s/%s: ETag %s is not computable from its content' % \
+            (key.bucket.name, key.name, key.etag))
+    directory = os.path.dirname(os.path.abspath(local_path))
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    (fd, tmp_path) = tempfile.mkstemp(prefix='.%s-' % os.path.basename(local_path),
+                                      suffix='.download', dir=directory)
+    try:
+        try:
+            os.ftruncate(fd, size)
+        finally:
+            os.close(fd)
+        # the parts the object was uploaded in, or the whole object
+        uploaded_parts = part_ranges(size, (layout and layout[0]) or max(size, 1))
+        ranges = [(part_start + start, part_start + end)
+                  for (part_start, part_end) in uploaded_parts
+                  for (start, end) in part_ranges(part_end - part_start + 1, part_size)]
+
+        def fetch(byte_range):
+            (start, end) = byte_range
+            # Keys are not thread-safe; fetch each range through its own
+            part = boto_s3_key.Key(key.bucket, key.name)
+            headers = {'Range': 'bytes=%d-%d' % (start, end)}
+            if key.etag:
+                headers['If-Match'] = key.etag
+            with open(tmp_path, 'r+b') as f:
+                f.seek(start)
+                part.get_contents_to_file(f, headers=headers)
+                if f.tell() != end + 1:
+                    raise IOError('Short read of bytes %s-%s of s3://%s/%s: got %s bytes' % \
+                        (start, end, key.bucket.name, key.name, f.tell() - start))
+            return part.local_hashes.get('md5')
+
+        def hash_part(uploaded_part):
+            (start, end) = uploaded_part
+            if uploaded_part in streamed:
+                return streamed[uploaded_part]
+            md5 = hashlib.md5()
+            with open(tmp_path, 'rb') as f:
+                f.seek(start)
+                remaining = end - start + 1
+                while remaining:
+                    data = f.read(min(checksum.READ_SIZE, remaining))
+                    if not data:
+                        break
+                    md5.update(data)
+                    remaining -= len(data)
+            return md5.digest()
+
+        start_time = time.time()
+        with timing.timed('s3_download', path='s3://%s/%s' % (key.bucket.name, key.name),
+                          bytes=size, parts=len(ranges)):
+            digests = []
+            if ranges:
+                pool = ThreadPool(max(1, min(max_threads, len(ranges))))
+                try:
+                    streamed = dict(zip(ranges, pool.map(fetch, ranges)))
+                    if layout:
+                        digests = pool.map(hash_part, uploaded_parts)
+                finally:
+                    pool.close()
+            verified = layout and _verify_download(key, layout, digests)
+            os.rename(tmp_path, local_path)
+            if verified:
+                # spare complete() checks from reading the file again
+                checksum.remember_file_etag(local_path, layout[0], key.etag)
+        elapsed = time.time() - start_time
+        logger.info('Downloaded %s bytes to %s in %s parts (%.1f MB/s)' % \
+            (size, local_path, len(ranges), size / (1024.0 ** 2) / max(elapsed, 1e-6)))
+    except:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def _verify_download(key, layout, digests):
+    (upload_part_size, recorded) = layout
+    if upload_part_size:
+        etag = checksum.multipart_etag(digests)
+    else:
+        etag = '"%s"' % (digests[0] if digests else hashlib.md5().digest()).encode('hex')
+    if checksum.etags_equal(etag, key.etag):
+        return True
+    if recorded:
+        raise IOError('Checksum mismatch downloading s3://%s/%s: expected ETag %s, got %s' % \
+            (key.bucket.name, key.name, key.etag, etag))
+    # the part size was assumed, so a mismatch may only mean a wrong guess
+    logger.warning('Cannot verify download of s3://%s/%s: ETag %s does not match %s-byte parts' % \
+        (key.bucket.name, key.name, key.etag, upload_part_size))
+    return False
+
+def choose_part_size(size, max_threads=DEFAULT_THREADS):
+    """
+    Choose the part size for uploading a file: small enough to keep
+    `max_threads` parts in flight, but at least MIN_AUTO_PART_SIZE, so
+    small files are uploaded in one request, and at most
+    DEFAULT_PART_SIZE unless larger parts are needed to stay within
+    MAX_PARTS. Rounded up to a whole MB.
+
+    :type size: int
+    :param size: file size in bytes
+
+    :type max_threads: int
+    :param max_threads: maximum number of parts uploaded at once
+
+    :rtype: int:
+    :returns: part size in bytes
+    """
+    part_size = min(max(_ceil_div(size, max_threads), MIN_AUTO_PART_SIZE), DEFAULT_PART_SIZE)
+    part_size = max(part_size, _ceil_div(size, MAX_PARTS))
+    return _fit_part_size(size, _ceil_div(part_size, 1024 ** 2) * 1024 ** 2)
+
+def _fit_part_size(size, part_size):
+    # raise the part size into S3's limits on part size and count
+    fitted = max(part_size, _ceil_div(size, MAX_PARTS))
+    if size > fitted:
+        fitted = max(fitted, MIN_PART_SIZE)
+    return min(fitted, MAX_PART_SIZE)
+
+def _ceil_div(n, d):
+    return (n + d - 1) / d
+
+def upload(client, local_path, s3_path, part_size=None, max_threads=DEFAULT_THREADS):
+    """
+    Upload a local file to S3, in parts uploaded concurrently if it is
+    larger than one part. Parts are sent from memory-mapped slices of the
+    file, so they are never copied whole into strings. Each part's MD5
+    is both sent for S3 to check the part against and combined into the
+    expected ETag of the object, which must match the ETag S3 returns.
+    The part size is recorded in the object's metadata so downloads can
+    verify it.
+
+    :type client: :py:class:`luigi.s3.S3Client`
+    :param client: S3 client
+
+    :type local_path: str
+    :param local_path: file to upload
+
+    :type s3_path: str
+    :param s3_path: where to upload the file
+
+    :type part_size: int
+    :param part_size: size of each part of a multipart upload. Default:
+                      chosen from the file size by :py:func:`choose_part_size`.
+
+    :type max_threads: int
+    :param max_threads: maximum number of parts uploaded at once
+
+    :rtype: str:
+    :returns: ETag of the uploaded object
+    """
+    (bucket_name, key_name) = client._path_to_bucket_and_key(s3_path)
+    bucket = client.s3.get_bucket(bucket_name, validate=False)
+    size = os.path.getsize(local_path)
+    if part_size:
+        fitted = _fit_part_size(size, part_size)
+        if fitted != part_size:
+            logger.warning('Using %s-byte parts to upload %s within S3 limits' % (fitted, local_path))
+        part_size = fitted
+    else:
+        part_size = choose_part_size(size, max_threads)
+    ranges = part_ranges(size, part_size)
+    stat = os.stat(local_path)
+    start_time = time.time()
+    with timing.timed('s3_upload', path=s3_path, bytes=size, parts=len(ranges), part_size=part_size):
+        with open(local_path, 'rb') as f:
+            # an empty file cannot be mapped
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else ''
+        try:
+            if size <= part_size:
+                body = _MappedPart(mapped, 0, size)
+                md5 = body.md5()
+                key = bucket.new_key(key_name)
+                try:
+                    key.set_contents_from_file(body, md5=_md5_pair(md5))
+                    etag = key.etag
+                except boto_exception.S3DataError:
+                    # boto expects the ETag to be the MD5, which it isn't for SSE-KMS
+                    # objects; S3 has checked the content against Content-MD5
+                    uploaded = bucket.get_key(key_name)
+                    if uploaded is None or checksum.parse_etag(uploaded.etag) is not None:
+                        raise
+                    etag = uploaded.etag
+                expected = '"%s"' % md5.hexdigest()
+            else:
+                (expected, etag) = _upload_parts(bucket, key_name, mapped, ranges, part_size, max_threads)
+        finally:
+            if size:
+                mapped.close()
+    if checksum.parse_etag(etag) is None:
+        # e.g. encrypted with SSE-KMS: the ETag is not an MD5 to check against
+        logger.info('Cannot verify upload of %s to %s: ETag %s is not computable from its content' % \
+            (local_path, s3_path, etag))
+    elif not checksum.etags_equal(expected, etag):
+        raise IOError('Checksum mismatch uploading %s to %s: expected ETag %s, got %s' % \
+            (local_path, s3_path, expected, etag))
+    else:
+        # spare complete() checks from reading the file again
+        checksum.remember_file_etag(local_path, 0 if size <= part_size else part_size, etag, stat)
+    elapsed = time.time() - start_time
+    logger.info('Uploaded %s bytes to %s in %s parts (%.1f MB/s)' % \
+        (size, s3_path, len(ranges), size / (1024.0 ** 2) / max(elapsed, 1e-6)))
+    return etag
+
+def _upload_parts(bucket, key_name, mapped, ranges, part_size, max_threads):
+    multipart = bucket.initiate_multipart_upload(
+        key_name, metadata={checksum.PART_SIZE_METADATA: str(part_size)})
+
+    def send(part):
+        (part_num, (start, end)) = part
+        body = _MappedPart(mapped, start, end - start + 1)
+        md5 = body.md5()
+        multipart.upload_part_from_file(body, part_num, md5=_md5_pair(md5), size=end - start + 1)
+        return md5.digest()
+
+    try:
+        pool = ThreadPool(max(1, min(max_threads, len(ranges))))
+        try:
+            digests = pool.map(send, list(enumerate(ranges, 1)))
+        finally:
+            pool.close()
+        etag = multipart.complete_upload().etag
+    except BaseException:
+        logger.info('Canceling multipart upload to s3://%s/%s' % (bucket.name, key_name))
+        multipart.cancel_upload()
+        raise
+    return (checksum.multipart_etag(digests), etag)
+
+
+class _MappedPart(object):
+    """
+    Read-only file-like view of one part of a memory-mapped file, with
+    its own position, so parts can be sent from several threads at once.
+    """
+
+    def __init__(self, mapped, start, size):
+        self.mapped = mapped
+        self.start = start
+        self.size = size
+        self.position = 0
+
+    def read(self, size=-1):
+        if size < 0 or size > self.size - self.position:
+            size = self.size - self.position
+        offset = self.start + self.position
+        self.position += size
+        return self.mapped[offset:offset + size]
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        base = {os.SEEK_SET: 0, os.SEEK_CUR: self.position, os.SEEK_END: self.size}[whence]
+        self.position = max(0, min(self.size, base + offset))
+
+    def tell(self):
+        return self.position
+
+    def md5(self):
+        # hash the mapped pages directly, without copying them into a string
+        return hashlib.md5(buffer(self.mapped, self.start, self.size))
+
+def _md5_pair(md5):
+    # (hex, base64) digests, as boto takes a precomputed MD5
+    return (md5.hexdigest(), base64.b64encode(md5.digest()))
+
+
+def list_s3_prefix(client, s3_path):
+    """
+    List every object under an S3 prefix with a single listing.
+
+    :type client: :py:class:`luigi.s3.S3Client`
+    :param client: S3 client
+
+    :type s3_path: str
+    :param s3_path: S3 path of the prefix, e.g. s3://my-bucket/my-output
+
+    :rtype: dict:
+    :returns: boto Key of each object, by path relative to the prefix
+    """
+    (bucket_name, _, prefix) = s3_path[len('s3://'):].partition('/')
+    prefix = prefix.strip('/') + '/' if prefix.strip('/') else ''
+    bucket = client.s3.get_bucket(bucket_name, validate=False)
+    return dict((key.name[len(prefix):], key) for key in bucket.list(prefix=prefix)
+                if not key.name.endswith('/'))
+
+def list_local_dir(path):
+    """
+    List every file under a local directory.
+
+    :rtype: dict:
+    :returns: os.stat of each file, by path relative to the directory
+    """
+    files = {}
+    for (dirpath, _, filenames) in os.walk(path):
+        for name in filenames:
+            full_path = os.path.join(dirpath, name)
+            files[os.path.relpath(full_path, path).replace(os.sep, '/')] = os.stat(full_path)
+    return files
+
+def needs_download(key, local_path, part_size=DEFAULT_PART_SIZE):
+    """
+    Whether a local copy of an S3 object found by listing is missing or
+    differs from it, by size or else by ETag; see :py:func:`listed_key_matches`.
+
+    :type part_size: int
+    :param part_size: part size to assume for a multipart upload that
+                      did not record its part size
+    """
+    return not listed_key_matches(local_path, key, part_size)
+
+def needs_upload(local_path, key, part_size=DEFAULT_PART_SIZE):
+    """
+    Whether the S3 copy of a local file, found by listing, is missing or
+    differs from it, by size or else by ETag; see :py:func:`listed_key_matches`.
+
+    :type key: :py:class:`boto.s3.key.Key`
+    :param key: the S3 copy, or None if there is none
+    """
+    return key is None or not listed_key_matches(local_path, key, part_size)
+
+def listed_key_matches(local_path, key, part_size=DEFAULT_PART_SIZE):
+    """
+    Whether a local file has the same content as an S3 object found by
+    listing. Listings omit metadata, so a multipart upload whose part size
+    isn't evident from its ETag is fetched again with a HEAD request for
+    its recorded part size. If the ETag still can't be computed from local
+    data (SSE-KMS encryption, or parts of an unrecorded size), a file of
+    the same size is taken to match.
+
+    :type key: :py:class:`boto.s3.key.Key`
+    :param key: S3 object, as listed
+
+    :type part_size: int
+    :param part_size: part size to assume for a multipart upload that
+                      did not record its part size
+
+    :rtype: bool:
+    :returns: True if the contents match, or are assumed to
+    """
+    if not os.path.isfile(local_path) or os.path.getsize(local_path) != key.size:
+        return False
+    layout = checksum.etag_part_size(key, part_size)
+    if layout is not None and checksum.etags_equal(checksum.file_etag(local_path, layout[0]), key.etag):
+        return True
+    if layout is not None and layout[1]:
+        return False
+    if checksum.parse_etag(key.etag) is not None:
+        key = key.bucket.get_key(key.name)
+        if key is None:
+            return False
+    return checksum.file_matches_key(local_path, key, part_size)
+
+def run_transfers(transfers, max_workers=DEFAULT_THREADS, event_type='s3_transfer'):
+    """
+    Run file transfers, up to `max_workers` at once, and report their
+    aggregate throughput. Every transfer is attempted; if any fail, an
+    IOError summarizing the failures is raised once all have finished.
+
+    :type transfers: list of tuple
+    :param transfers: (name, bytes, function) of each transfer, where
+                      calling function() performs it
+
+    :type max_workers: int
+    :param max_workers: maximum number of transfers at once
+
+    :type event_type: str
+    :param event_type: type of the timing event emitted for the transfers
+
+    :rtype: int:
+    :returns: bytes transferred
+    """
+    def run(transfer):
+        (name, _, function) = transfer
+        try:
+            function()
+        except Exception as e:
+            logger.exception('Failed to transfer %s' % name)
+            return (name, e)
+
+    total_bytes = sum(size for (_, size, _) in transfers)
+    start_time = time.time()
+    failures = []
+    with timing.timed(event_type, files=len(transfers), bytes=total_bytes) as extra:
+        if transfers:
+            pool = ThreadPool(max(1, min(max_workers, len(transfers))))
+            try:
+                failures = [f for f in pool.map(run, transfers) if f]
+            finally:
+                pool.close()
+        extra['failures'] = len(failures)
+    elapsed = time.time() - start_time
+    logger.info('Transferred %s files (%s bytes) in %.1f seconds (%.1f MB/s)' % \
+        (len(transfers) - len(failures), total_bytes, elapsed,
+         total_bytes / (1024.0 ** 2) / max(elapsed, 1e-6)))
+    if failures:
+        raise IOError('Failed to transfer %s of %s files, e.g. %s: %s' % \
+            (len(failures), len(transfers), failures[0][0], failures[0][1]))
+    return total_bytes
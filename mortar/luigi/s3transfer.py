@@ -15,21 +15,27 @@
 import abc
 import datetime
 import logging
+import os
 
 import luigi
 from luigi import configuration, LocalTarget
 from luigi.parameter import Parameter
-from luigi.s3 import S3Target, S3PathTask, S3Client
 
+from mortar.luigi import checksum
+from mortar.luigi import lazyimport
+from mortar.luigi import s3parallel
 from mortar.luigi import target_factory
 
+s3 = lazyimport.LazyModule('luigi.s3')
+
 logger = logging.getLogger('luigi-interface')
 
 class S3TransferTask(luigi.Task):
     """
     Superclass Luigi Task to move data between S3 and local file
     systems. Don't instantiate this directly, but rather use
-    :py:class:`LocalToS3Task` or :py:class:`S3ToLocalTask`.
+    :py:class:`LocalToS3Task`, :py:class:`S3ToLocalTask`,
+    :py:class:`LocalDirToS3Task` or :py:class:`S3PrefixToLocalTask`.
     """
 
     def output(self):
@@ -53,7 +59,7 @@ class S3TransferTask(luigi.Task):
     def _get_s3_client(self):
         if not hasattr(self, "client"):
             self.client = \
-                S3Client(
+                s3.S3Client(
                     luigi.configuration.get_config().get('s3', 'aws_access_key_id'), 
                     luigi.configuration.get_config().get('s3', 'aws_secret_access_key'))
         return self.client
@@ -61,7 +67,8 @@ class S3TransferTask(luigi.Task):
 
 class LocalToS3Task(S3TransferTask):
     """
-    Copy a file from local disk to S3.
+    Copy a file from local disk to S3. Files larger than one part are
+    uploaded in parts sized from the file size, several at once.
 
     To use this class, define the following section in your Luigi 
     client configuration file:
@@ -83,11 +90,30 @@ class LocalToS3Task(S3TransferTask):
     # S3 URL for the file destination (including file name)
     s3_path = Parameter()
 
+    # size in bytes of each part of a multipart upload; 0 to choose from the file size
+    part_size = luigi.IntParameter(default=0)
+
+    # maximum number of parts uploaded at once
+    max_threads = luigi.IntParameter(default=s3parallel.DEFAULT_THREADS)
+
     def input_target(self):
         return LocalTarget(self.local_path)
 
     def output_target(self):
-        return S3Target(self.s3_path, client=self._get_s3_client())
+        return s3.S3Target(self.s3_path, client=self._get_s3_client())
+
+    def complete(self):
+        """
+        The copy is complete only if the S3 file has the same content as
+        the local file, compared by size and ETag, so a truncated earlier
+        upload or a changed local file is uploaded again. The local file is
+        hashed only when the sizes match, and at most once while unchanged.
+        """
+        if not os.path.isfile(self.local_path):
+            return super(LocalToS3Task, self).complete()
+        key = self._get_s3_client().get_key(self.s3_path)
+        part_size = self.part_size or s3parallel.choose_part_size(os.path.getsize(self.local_path), self.max_threads)
+        return key is not None and checksum.file_matches_key(self.local_path, key, part_size)
 
     def run(self):
         """
@@ -97,9 +123,14 @@ class LocalToS3Task(S3TransferTask):
         output_path = self.output_target().path
         s3_client = self._get_s3_client()
         logger.info('Uploading [%s] to [%s]' % (input_path, output_path))
-        s3_client.put_multipart(input_path, output_path)
+        s3parallel.upload(s3_client, input_path, output_path, part_size=self.part_size,
+                          max_threads=self.max_threads)
 
 class S3ToLocalTask(S3TransferTask):
+    """
+    Copy a file from S3 to local disk, fetching byte ranges of it
+    in parallel. The file appears at local_path only once complete.
+    """
 
     # S3 URL for the file to copy
     s3_path = Parameter()
@@ -107,12 +138,30 @@ class S3ToLocalTask(S3TransferTask):
     # full (absolute) target local path for the file (including file name)
     local_path = Parameter()
 
+    # size in bytes of each byte range fetched
+    part_size = luigi.IntParameter(default=s3parallel.DEFAULT_PART_SIZE)
+
+    # maximum number of byte ranges fetched at once
+    max_threads = luigi.IntParameter(default=s3parallel.DEFAULT_THREADS)
+
     def input_target(self):
-        return S3Target(self.s3_path, client=self._get_s3_client())
+        return s3.S3Target(self.s3_path, client=self._get_s3_client())
 
     def output_target(self):
         return LocalTarget(self.local_path)
 
+    def complete(self):
+        """
+        The copy is complete only if the local file has the same content
+        as the S3 file, compared by size and ETag, so a truncated earlier
+        download or a changed S3 file is downloaded again. The local file is
+        hashed only when the sizes match, and at most once while unchanged.
+        """
+        key = self._get_s3_client().get_key(self.s3_path)
+        if key is None:
+            return super(S3ToLocalTask, self).complete()
+        return checksum.file_matches_key(self.local_path, key, self.part_size)
+
     def run(self):
         """
         Transfer data from S3 file to local file.
@@ -122,4 +171,157 @@ class S3ToLocalTask(S3TransferTask):
         s3_client = self._get_s3_client()
         logger.info('Downloading [%s] to [%s]' % (input_path, output_path))
         key = s3_client.get_key(input_path)
-        key.get_contents_to_filename(output_path)
+        s3parallel.download(key, output_path, part_size=self.part_size, max_threads=self.max_threads)
+
+
+class S3PrefixToLocalTask(S3TransferTask):
+    """
+    Copy every file under an S3 prefix, e.g. a Pig output directory, to a
+    local directory. The prefix is listed once, and only files missing
+    locally or differing from S3, by size or else by ETag, are
+    downloaded, up to max_workers at once. Objects whose ETag can't be
+    computed locally, e.g. those encrypted with SSE-KMS, are compared by
+    size only. A flag file is written to
+    the local directory once every file has been copied.
+
+    To use this class, define the following section in your Luigi
+    client configuration file:
+
+    ::[s3]
+    ::aws_access_key_id: ${AWS_ACCESS_KEY_ID}
+    ::aws_secret_access_key: ${AWS_SECRET_ACCESS_KEY}
+
+    Example usage:
+
+    ::    # copy s3://my-bucket/my-output/part-* to /mnt/tmp/my-output/
+    ::    S3PrefixToLocalTask(s3_path='s3://my-bucket/my-output',
+    ::                        local_path='/mnt/tmp/my-output')
+    """
+
+    # S3 URL of the prefix to copy
+    s3_path = Parameter()
+
+    # full (absolute) local path of the destination directory
+    local_path = Parameter()
+
+    # maximum number of files copied at once
+    max_workers = luigi.IntParameter(default=s3parallel.DEFAULT_THREADS)
+
+    # size in bytes of each byte range fetched
+    part_size = luigi.IntParameter(default=s3parallel.DEFAULT_PART_SIZE)
+
+    # maximum number of byte ranges of one file fetched at once
+    part_threads = luigi.IntParameter(default=1)
+
+    # name of the file written once the copy is complete; not copied from S3
+    flag = Parameter(default='_SUCCESS')
+
+    def input_target(self):
+        return s3.S3Target(self.s3_path, client=self._get_s3_client())
+
+    def output_target(self):
+        return LocalTarget(os.path.join(self.local_path, self.flag))
+
+    def run(self):
+        """
+        Download the missing and changed files.
+        """
+        s3_client = self._get_s3_client()
+        keys = s3parallel.list_s3_prefix(s3_client, self.s3_path)
+        keys.pop(self.flag, None)
+        changed = [(name, key) for (name, key) in sorted(keys.items())
+                   if s3parallel.needs_download(key, self._local_file(name), self.part_size)]
+        logger.info('Downloading %s of %s files from [%s] to [%s]' % \
+            (len(changed), len(keys), self.s3_path, self.local_path))
+        s3parallel.run_transfers(
+            [(key.name, key.size, self._download_function(key, name)) for (name, key) in changed],
+            max_workers=self.max_workers, event_type='s3_prefix_download')
+        target_factory.write_file(self.output_target())
+
+    def _local_file(self, name):
+        return os.path.join(self.local_path, *name.split('/'))
+
+    def _download_function(self, key, name):
+        def download():
+            # listings omit metadata, including the part size needed to verify the download
+            head = key.bucket.get_key(key.name)
+            if head is None:
+                raise IOError('s3://%s/%s was deleted during the copy' % (key.bucket.name, key.name))
+            s3parallel.download(head, self._local_file(name), part_size=self.part_size,
+                                max_threads=self.part_threads)
+        return download
+
+
+class LocalDirToS3Task(S3TransferTask):
+    """
+    Copy every file under a local directory to an S3 prefix. The prefix
+    is listed once, and only files missing in S3 or differing from it,
+    by size or else by ETag, are uploaded, up to max_workers at once. A
+    flag file is written under the prefix once every file has been copied.
+
+    To use this class, define the following section in your Luigi
+    client configuration file:
+
+    ::[s3]
+    ::aws_access_key_id: ${AWS_ACCESS_KEY_ID}
+    ::aws_secret_access_key: ${AWS_SECRET_ACCESS_KEY}
+
+    Example usage:
+
+    ::    # copy /mnt/tmp/my-output/* to s3://my-bucket/my-output/
+    ::    LocalDirToS3Task(local_path='/mnt/tmp/my-output',
+    ::                     s3_path='s3://my-bucket/my-output')
+    """
+
+    # full (absolute) local path of the directory to copy
+    local_path = Parameter()
+
+    # S3 URL of the destination prefix
+    s3_path = Parameter()
+
+    # maximum number of files copied at once
+    max_workers = luigi.IntParameter(default=s3parallel.DEFAULT_THREADS)
+
+    # size in bytes of each part of a multipart upload; 0 to choose from each file's size
+    part_size = luigi.IntParameter(default=0)
+
+    # maximum number of parts of one file uploaded at once
+    part_threads = luigi.IntParameter(default=1)
+
+    # name of the file written once the copy is complete; not copied from local disk
+    flag = Parameter(default='_SUCCESS')
+
+    def input_target(self):
+        return LocalTarget(self.local_path)
+
+    def output_target(self):
+        return s3.S3Target('%s/%s' % (self.s3_path.rstrip('/'), self.flag), client=self._get_s3_client())
+
+    def run(self):
+        """
+        Upload the missing and changed files.
+        """
+        s3_client = self._get_s3_client()
+        local_files = s3parallel.list_local_dir(self.local_path)
+        local_files.pop(self.flag, None)
+        keys = s3parallel.list_s3_prefix(s3_client, self.s3_path)
+        changed = [(name, stat) for (name, stat) in sorted(local_files.items())
+                   if s3parallel.needs_upload(self._local_file(name), keys.get(name),
+                                              self._part_size(stat.st_size))]
+        logger.info('Uploading %s of %s files from [%s] to [%s]' % \
+            (len(changed), len(local_files), self.local_path, self.s3_path))
+        s3parallel.run_transfers(
+            [(name, stat.st_size, self._upload_function(name)) for (name, stat) in changed],
+            max_workers=self.max_workers, event_type='local_dir_upload')
+        target_factory.write_file(self.output_target())
+
+    def _local_file(self, name):
+        return os.path.join(self.local_path, *name.split('/'))
+
+    def _part_size(self, size):
+        return self.part_size or s3parallel.choose_part_size(size, self.part_threads)
+
+    def _upload_function(self, name):
+        s3_path = '%s/%s' % (self.s3_path.rstrip('/'), name)
+        return lambda: s3parallel.upload(self._get_s3_client(), self._local_file(name), s3_path,
+                                         part_size=self.part_size, max_threads=self.part_threads)
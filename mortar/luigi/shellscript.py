@@ -39,7 +39,7 @@ class ShellScriptTask(luigi.Task):
         :rtype: Target:
         :returns: Target for Task completion token
         """
-        return target_factory.get_target('%s/%s' % (self.token_path, self.__class__.__name__))
+        return target_factory.get_token_target('%s/%s' % (self.token_path, self.__class__.__name__))
 
     def output(self):
         """
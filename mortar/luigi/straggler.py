@@ -0,0 +1,140 @@
+# Copyright (c) 2014 Mortar Data
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+import json
+import logging
+
+from mortar.luigi import target_factory
+
+logger = logging.getLogger('luigi-interface')
+
+
+def _time_to_reach(curve, progress):
+    """
+    Seconds a run took to reach `progress`, interpolating
+    linearly between its samples.
+    """
+    (prev_time, prev_progress) = (0.0, 0.0)
+    for (t, p) in curve:
+        if p >= progress:
+            if p == prev_progress:
+                return t
+            return prev_time + (t - prev_time) * (progress - prev_progress) / (p - prev_progress)
+        (prev_time, prev_progress) = (t, p)
+    return None
+
+def _median(values):
+    values = sorted(values)
+    middle = len(values) / 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+class ProgressModel(object):
+    """
+    Expected progress curve of a script, built from the progress
+    curves of its past successful runs.
+
+    A running job is straggling when it has taken `slowdown` times
+    longer than the median past run to get where it is.
+    """
+
+    def __init__(self, runs=None, max_runs=10, min_runs=3):
+        """
+        :type runs: list
+        :param runs: progress curve of each past run, as a list of
+                     (seconds since running, percent complete)
+
+        :type max_runs: int
+        :param max_runs: number of most recent runs to keep
+
+        :type min_runs: int
+        :param min_runs: number of runs needed before any job is flagged
+        """
+        self.runs = runs or []
+        self.max_runs = max_runs
+        self.min_runs = min_runs
+
+    @classmethod
+    def load(cls, target, **kwargs):
+        """
+        Load the model saved at a target, or an empty model if none has been saved.
+
+        :type target: Target
+        :param target: where the model is saved
+
+        :rtype: :py:class:`ProgressModel`:
+        :returns: the saved model
+        """
+        if not target.exists():
+            return cls(**kwargs)
+        try:
+            runs = json.loads(target.open('r').read())['runs']
+        except (ValueError, KeyError) as e:
+            logger.warning('Ignoring unreadable progress history at %s: %s' % (target.path, e))
+            runs = []
+        return cls(runs=[[tuple(sample) for sample in run] for run in runs], **kwargs)
+
+    def save(self, target):
+        target_factory.write_file(target, text=json.dumps({'runs': self.runs}))
+
+    def add_run(self, curve):
+        """
+        Add the progress curve of a successful run.
+
+        :type curve: list of tuple
+        :param curve: (seconds since running, percent complete) samples
+        """
+        if curve:
+            self.runs = (self.runs + [list(curve)])[-self.max_runs:]
+
+    def expected_elapsed(self, progress):
+        """
+        :rtype: float:
+        :returns: median seconds past runs took to reach `progress`,
+                  or None if there are too few runs
+        """
+        if len(self.runs) < self.min_runs:
+            return None
+        times = [t for t in (_time_to_reach(run, progress) for run in self.runs) if t is not None]
+        if len(times) < self.min_runs:
+            return None
+        return _median(times)
+
+    def is_straggling(self, elapsed, progress, slowdown=3.0, min_elapsed=0):
+        """
+        Whether a running job has fallen far behind the expected curve:
+        it has been running `slowdown` times longer than past runs took
+        to get past its current progress.
+
+        :type elapsed: float
+        :param elapsed: seconds the job has been running
+
+        :type progress: float
+        :param progress: the job's percent complete
+
+        :type slowdown: float
+        :param slowdown: how many times slower than expected a job must be
+
+        :type min_elapsed: float
+        :param min_elapsed: jobs running for less time are never flagged
+
+        :rtype: bool:
+        :returns: True if the job is straggling
+        """
+        expected = self.expected_elapsed(min(100, (progress or 0) + 1))
+        if expected is None:
+            return False
+        return elapsed >= min_elapsed and elapsed > slowdown * expected
@@ -12,36 +12,235 @@
 # License for the specific language governing permissions and limitations under
 # the License.
 
+import collections
 import datetime
-from luigi.s3 import S3Target
+import os
+import threading
+
+import luigi
 from luigi.target import FileSystemTarget
 from luigi import LocalTarget
+from mortar.luigi import compression as compressions
+from mortar.luigi import lazyimport
+
+s3 = lazyimport.LazyModule('luigi.s3')
+s3cache = lazyimport.LazyModule('mortar.luigi.s3cache')
+tokenindex = lazyimport.LazyModule('mortar.luigi.tokenindex')
+tokenstore = lazyimport.LazyModule('mortar.luigi.tokenstore')
+
+# Maximum number of Targets kept for reuse in each process
+MAX_INTERNED_TARGETS = 10000
+
+# (path prefix, Target factory), longest prefix first
+_schemes = []
+_schemes_lock = threading.Lock()
+
+# (kind, normalized path) -> Target, least recently used first
+_targets = collections.OrderedDict()
+_targets_lock = threading.Lock()
+_targets_pid = os.getpid()
+
+_s3_client = None
+_s3_client_lock = threading.Lock()
+_s3_client_pid = os.getpid()
+
+def register_scheme(prefix, factory):
+    """
+    Register a factory for Targets whose paths start with a prefix, e.g.
+    'hdfs://' or 'memory://'. The factory for the longest matching prefix
+    is used; registering a prefix again replaces its factory.
+
+    :type prefix: str
+    :param prefix: path prefix handled by the factory
+
+    :type factory: function
+    :param factory: called with a path and the :py:class:`luigi.format.Format`
+                    to stream its data through (None for uncompressed data),
+                    returns a Target for it
+    """
+    with _schemes_lock:
+        _schemes[:] = sorted([s for s in _schemes if s[0] != prefix] + [(prefix, factory)],
+                             key=lambda s: -len(s[0]))
+    clear_cache()
+
+def unregister_scheme(prefix):
+    """
+    Stop handling paths that start with a prefix registered with
+    :py:func:`register_scheme`.
+    """
+    with _schemes_lock:
+        _schemes[:] = [s for s in _schemes if s[0] != prefix]
+    clear_cache()
 
-def get_target(path):
+def get_target(path, compression=None):
     """
     Factory method to create a Luigi Target from a path string.
 
-    Supports the following Target types:
+    Supports the following Target types, plus any registered
+    with :py:func:`register_scheme`:
 
     * S3Target: s3://my-bucket/my-path
     * LocalTarget: /path/to/file or file:///path/to/file
+    * Token in a SQLite token store: sqlite:///path/to/tokens.db/MyTask
+    * Token in an S3 token store: s3tokens://my-bucket/my-path/pipeline.tokens/MyTask
+
+    Token stores keep many tokens in one place rather than one file per
+    token; see :py:mod:`mortar.luigi.tokenstore`. To use one, point a
+    task's token_path into it.
+
+    Data at paths ending in .gz, .bz2 or .zst is compressed as it is
+    written and decompressed as it is read, streaming through the gzip,
+    bzip2 or zstd command-line tool; see :py:mod:`mortar.luigi.compression`.
+
+    Targets are reused within a process: getting the same path twice
+    returns the same Target, and S3 Targets share one S3 client.
+
+    To serve repeated reads of unchanged S3 objects from local disk,
+    within and across runs, define the following in your Luigi client
+    configuration file (s3_cache_max_bytes defaults to 1GB):
+
+    ::[mortar]
+    ::s3_cache_dir: /var/cache/mortar-luigi
+    ::s3_cache_max_bytes: 1073741824
 
     :type path: str
     :param path: s3 or file URL, or local path
 
+    :type compression: str
+    :param compression: gzip, bzip2, zstd, or none for uncompressed data.
+                        Default: chosen from the path's suffix.
+
     :rtype: Target:
     :returns: Target for path string
     """
-    if path.startswith('s3:'):
-        return S3Target(path)
-    elif path.startswith('/'):
-        return LocalTarget(path)
-    elif path.startswith('file://'):
-        # remove the file portion
-        actual_path = path[7:]
-        return LocalTarget(actual_path)
-    else:
-        raise RuntimeError("Unknown scheme for path: %s" % path)
+    name = compressions.compression_for(path, compression)
+    factory = _scheme_factory(path)
+    return _intern('target:%s' % name, path,
+                   lambda p: factory(p, compressions.FORMATS[name] if name else None))
+
+def get_s3_client():
+    """
+    Get the S3 client shared by the S3 Targets of this process,
+    creating it on first use. A forked process gets a new client.
+
+    :rtype: :py:class:`luigi.s3.S3Client`:
+    :returns: shared S3 client
+    """
+    global _s3_client, _s3_client_pid
+    with _s3_client_lock:
+        if _s3_client is None or _s3_client_pid != os.getpid():
+            _s3_client = s3.S3Client()
+            _s3_client_pid = os.getpid()
+        return _s3_client
+
+def clear_cache():
+    """
+    Forget the Targets and S3 client kept for reuse, e.g. after
+    changing S3 credentials.
+    """
+    global _s3_client
+    with _targets_lock:
+        _targets.clear()
+    with _s3_client_lock:
+        _s3_client = None
+
+def normalize_path(path):
+    """
+    Normalize a path so that equivalent paths to the same local file,
+    e.g. file:///tmp/a and /tmp/./a, compare equal. Other paths are
+    returned unchanged.
+
+    :rtype: str:
+    :returns: normalized path
+    """
+    if path.startswith('file://'):
+        path = path[len('file://'):]
+    if path.startswith('/'):
+        return os.path.normpath(path)
+    return path
+
+def _scheme_factory(path):
+    with _schemes_lock:
+        for (prefix, factory) in _schemes:
+            if path.startswith(prefix):
+                return factory
+    raise RuntimeError("Unknown scheme for path: %s" % path)
+
+def _intern(kind, path, factory):
+    global _targets_pid
+    key = (kind, normalize_path(path))
+    with _targets_lock:
+        if _targets_pid != os.getpid():
+            _targets.clear()
+            _targets_pid = os.getpid()
+        target = _targets.pop(key, None)
+        if target is not None:
+            _targets[key] = target
+            return target
+    target = factory(path)
+    with _targets_lock:
+        target = _targets.setdefault(key, target)
+        while len(_targets) > MAX_INTERNED_TARGETS:
+            _targets.popitem(last=False)
+    return target
+
+def _s3_target(path, format=None):
+    config = luigi.configuration.get_config()
+    if config.has_option('mortar', 's3_cache_dir'):
+        max_bytes = config.getint('mortar', 's3_cache_max_bytes') \
+            if config.has_option('mortar', 's3_cache_max_bytes') else s3cache.DEFAULT_MAX_BYTES
+        cache = s3cache.get_disk_cache(config.get('mortar', 's3_cache_dir'), max_bytes)
+        return s3cache.CachedS3Target(path, cache, format=format, client=get_s3_client())
+    return s3.S3Target(path, format=format, client=get_s3_client())
+
+def _local_target(path, format=None):
+    return LocalTarget(path, format=format)
+
+def _file_url_target(path, format=None):
+    # remove the file portion
+    return LocalTarget(path[len('file://'):], format=format)
+
+def _sqlite_token_target(path, format=None):
+    _check_uncompressed(path, format)
+    return tokenstore.sqlite_target(path)
+
+def _s3_segment_token_target(path, format=None):
+    _check_uncompressed(path, format)
+    return tokenstore.s3_segment_target(path)
+
+def _check_uncompressed(path, format):
+    if format is not None:
+        raise RuntimeError('Tokens in a token store cannot be compressed: %s' % path)
+
+def get_token_target(path):
+    """
+    Factory method to create a Luigi Target for a token file from a path string.
+
+    Existence checks for S3 tokens are answered from the shared
+    :py:class:`mortar.luigi.tokenindex.TokenIndex`, which lists each
+    token directory once rather than checking every token separately.
+    To check each S3 token separately instead, define the following in
+    your Luigi client configuration file:
+
+    ::[mortar]
+    ::token_index: false
+
+    :type path: str
+    :param path: s3 or file URL, or local path
+
+    :rtype: Target:
+    :returns: Target for token path string
+    """
+    if path.startswith('s3:') and _use_token_index():
+        return _intern('indexed_token', path,
+                       lambda p: tokenindex.IndexedS3Target(p, client=get_s3_client()))
+    return get_target(path)
+
+def _use_token_index():
+    config = luigi.configuration.get_config()
+    if config.has_option('mortar', 'token_index'):
+        return config.getboolean('mortar', 'token_index')
+    return True
 
 def write_file(out_target, text=None):
     """
@@ -58,3 +257,23 @@ def write_file(out_target, text=None):
             token_file.write('%s\n' % text)
         else:
             token_file.write('%s' % datetime.datetime.utcnow().isoformat())
+    if lazyimport.is_instance(out_target, 'luigi.s3', 'S3Target'):
+        tokenindex.get_token_index().add(out_target.path)
+
+def refresh(target):
+    """
+    Make a Target reflect writes made by other processes since it was
+    first read. Targets in an S3 token store answer from a listing taken
+    on first use; other Targets always read their storage directly.
+
+    :type target: Target
+    :param target: Target about to be checked
+    """
+    if lazyimport.is_instance(target, 'mortar.luigi.tokenstore', 'TokenStoreTarget'):
+        target.store.refresh()
+
+register_scheme('s3:', _s3_target)
+register_scheme('/', _local_target)
+register_scheme('file://', _file_url_target)
+register_scheme('sqlite://', _sqlite_token_target)
+register_scheme('s3tokens://', _s3_segment_token_target)
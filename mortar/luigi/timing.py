@@ -0,0 +1,138 @@
+# Copyright (c) 2014 Mortar Data
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+import abc
+import contextlib
+import json
+import logging
+import threading
+import time
+
+import luigi
+
+logger = logging.getLogger('luigi-interface')
+
+
+class TimingSink(object):
+    """
+    Superclass for destinations of timing events: structured records of
+    Mortar job submit latency, time spent in each job status_code,
+    progress over time, and token read/write latency. Each event is a
+    dict with at least `event` and `timestamp` keys.
+    """
+
+    @abc.abstractmethod
+    def emit(self, event):
+        """
+        Record a timing event. Called from multiple threads.
+
+        :type event: dict
+        :param event: JSON-serializable event
+        """
+        raise RuntimeError("Please implement the emit method")
+
+
+class NullTimingSink(TimingSink):
+    """
+    Discards all timing events.
+    """
+
+    def emit(self, event):
+        pass
+
+
+class JsonLinesTimingSink(TimingSink):
+    """
+    Appends each timing event to a file as one line of JSON.
+
+    To send timing events to this sink, define the following in your
+    Luigi client configuration file:
+
+    ::[mortar]
+    ::timing_log: /path/to/timing.jsonl
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def emit(self, event):
+        line = json.dumps(event, sort_keys=True, default=str)
+        with self._lock:
+            with open(self.path, 'a') as f:
+                f.write(line + '\n')
+
+
+_sink = None
+_sink_lock = threading.Lock()
+
+def set_sink(sink):
+    """
+    Send all subsequent timing events in this process to `sink`.
+
+    :type sink: :py:class:`TimingSink`
+    :param sink: destination for timing events, or None to reconfigure
+                 from the Luigi configuration on next use
+    """
+    global _sink
+    with _sink_lock:
+        _sink = sink
+
+def get_sink():
+    """
+    :rtype: :py:class:`TimingSink`:
+    :returns: the sink timing events are sent to
+    """
+    global _sink
+    with _sink_lock:
+        if _sink is None:
+            config = luigi.configuration.get_config()
+            if config.has_option('mortar', 'timing_log'):
+                _sink = JsonLinesTimingSink(config.get('mortar', 'timing_log'))
+            else:
+                _sink = NullTimingSink()
+        return _sink
+
+def emit(event_type, **fields):
+    """
+    Emit a timing event. Failures to record the event are logged,
+    never raised.
+
+    :type event_type: str
+    :param event_type: kind of event, e.g. job_status
+    """
+    event = dict(fields)
+    event['event'] = event_type
+    event['timestamp'] = time.time()
+    try:
+        get_sink().emit(event)
+    except Exception:
+        logger.exception('Unable to record timing event %s' % event_type)
+
+@contextlib.contextmanager
+def timed(event_type, **fields):
+    """
+    Context manager that emits an event with the `duration_seconds`
+    of its block, whether or not the block raises.
+
+    Fields can be added to the event from within the block through
+    the yielded dict.
+    """
+    start = time.time()
+    extra = {}
+    try:
+        yield extra
+    finally:
+        fields.update(extra)
+        emit(event_type, duration_seconds=time.time() - start, **fields)
@@ -0,0 +1,202 @@
+# Copyright (c) 2014 Mortar Data
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+import logging
+import os
+import threading
+import time
+
+import luigi
+from luigi.s3 import S3Client, S3Target
+
+logger = logging.getLogger('luigi-interface')
+
+# Seconds a directory listing is trusted before the directory is
+# listed again, to pick up tokens written or removed by other processes
+DEFAULT_LISTING_TTL = 60
+
+
+def _split(path):
+    (prefix, _, name) = path.rstrip('/').rpartition('/')
+    return (prefix, name)
+
+
+class TokenIndex(object):
+    """
+    Process-wide index of the S3 tokens that exist under each token directory.
+
+    The first existence check for a token lists the keys and subdirectories
+    directly under the token's directory in one request; later checks for
+    tokens in the same directory are answered from that listing until it is
+    `ttl` seconds old. Tokens written with `target_factory.write_file` or
+    removed through an indexed target update the index. Use
+    :py:func:`get_token_index` to get the shared instance rather than
+    constructing one directly.
+    """
+
+    def __init__(self, ttl=DEFAULT_LISTING_TTL):
+        """
+        :type ttl: float
+        :param ttl: seconds a directory listing is trusted
+        """
+        self.lock = threading.Lock()
+        self.ttl = ttl
+        # token directory -> (names of keys and subdirectories in it, time listed)
+        self._prefixes = {}
+        # token directory -> changes ('add' or 'discard', name) made
+        # while it is being listed, and the number of listings under way
+        self._changes = {}
+        self.listings = 0
+        self.pid = os.getpid()
+
+    def exists(self, path, client=None):
+        """
+        Whether a token exists, listing its directory if it hasn't
+        been listed in the last `ttl` seconds.
+
+        :type path: str
+        :param path: S3 path of the token
+
+        :type client: :py:class:`luigi.s3.S3Client`
+        :param client: S3 client to list with. Default: a new client.
+
+        :rtype: bool:
+        :returns: True if the token exists
+        """
+        (prefix, name) = _split(path)
+        return name in self._names(prefix, client)
+
+    def exists_many(self, paths, client=None):
+        """
+        Check the existence of many tokens at once, listing
+        each of their directories at most once.
+
+        :type paths: list of str
+        :param paths: S3 paths of the tokens
+
+        :rtype: dict:
+        :returns: whether each token exists, by path
+        """
+        return dict((path, self.exists(path, client)) for path in paths)
+
+    def add(self, path):
+        """
+        Record that a token was written.
+        """
+        self._change(path, 'add')
+
+    def discard(self, path):
+        """
+        Record that a token was removed.
+        """
+        self._change(path, 'discard')
+
+    def invalidate(self, path=None):
+        """
+        Forget the listing of one token's directory, or of every
+        directory if no path is given.
+        """
+        with self.lock:
+            if path is None:
+                self._prefixes.clear()
+            else:
+                self._prefixes.pop(_split(path)[0], None)
+
+    def _change(self, path, change):
+        (prefix, name) = _split(path)
+        with self.lock:
+            if prefix in self._prefixes:
+                getattr(self._prefixes[prefix][0], change)(name)
+            if prefix in self._changes:
+                self._changes[prefix][0].append((change, name))
+
+    def _names(self, prefix, client):
+        with self.lock:
+            (names, listed_at) = self._prefixes.get(prefix, (None, None))
+            if names is not None and time.time() - listed_at < self.ttl:
+                return names
+            # list without holding the lock, remembering changes made meanwhile
+            (changes, listing) = self._changes.get(prefix, ([], 0))
+            self._changes[prefix] = (changes, listing + 1)
+            start = len(changes)
+        listed_at = time.time()
+        try:
+            names = self._list(prefix, client or S3Client())
+        except Exception:
+            with self.lock:
+                self._end_listing(prefix)
+            raise
+        with self.lock:
+            for (change, name) in self._end_listing(prefix)[start:]:
+                getattr(names, change)(name)
+            self._prefixes[prefix] = (names, listed_at)
+            self.listings += 1
+        return names
+
+    def _end_listing(self, prefix):
+        (changes, listing) = self._changes.pop(prefix)
+        if listing > 1:
+            self._changes[prefix] = (changes, listing - 1)
+        return changes
+
+    def _list(self, prefix, client):
+        (bucket_name, key) = client._path_to_bucket_and_key(prefix)
+        bucket = client.s3.get_bucket(bucket_name, validate=False)
+        key = key + '/' if key else ''
+        names = set()
+        # only the level below the prefix: keys and subdirectories in it
+        for item in bucket.list(prefix=key, delimiter='/'):
+            names.add(item.name[len(key):].rstrip('/'))
+        logger.debug('Listed %s tokens under %s' % (len(names), prefix))
+        return names
+
+
+_token_index = None
+_token_index_lock = threading.Lock()
+
+def get_token_index():
+    """
+    Get the shared :py:class:`TokenIndex` for this process.
+
+    To change how long directory listings are trusted, define the
+    following in your Luigi client configuration file:
+
+    ::[mortar]
+    ::token_index_ttl_seconds: 60
+
+    :rtype: :py:class:`TokenIndex`:
+    :returns: the process-wide token index
+    """
+    global _token_index
+    with _token_index_lock:
+        if _token_index is None or _token_index.pid != os.getpid():
+            config = luigi.configuration.get_config()
+            ttl = config.getfloat('mortar', 'token_index_ttl_seconds') \
+                if config.has_option('mortar', 'token_index_ttl_seconds') else DEFAULT_LISTING_TTL
+            _token_index = TokenIndex(ttl)
+        return _token_index
+
+
+class IndexedS3Target(S3Target):
+    """
+    S3Target for a token whose existence is checked through
+    the shared :py:class:`TokenIndex`.
+    """
+
+    def exists(self):
+        return get_token_index().exists(self.path, self.fs)
+
+    def remove(self):
+        super(IndexedS3Target, self).remove()
+        get_token_index().discard(self.path)
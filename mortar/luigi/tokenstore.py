@@ -0,0 +1,561 @@
+# Copyright (c) 2014 Mortar Data
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+import abc
+import calendar
+import contextlib
+import json
+import logging
+import os
+import sqlite3
+import StringIO
+import threading
+import time
+import uuid
+
+import luigi
+
+from mortar.luigi import lazyimport
+
+s3 = lazyimport.LazyModule('luigi.s3')
+boto_utils = lazyimport.LazyModule('boto.utils')
+target_factory = lazyimport.LazyModule('mortar.luigi.target_factory')
+
+logger = logging.getLogger('luigi-interface')
+
+# A SQLite token store is named by a path component ending in this suffix:
+# sqlite:///var/luigi/tokens.db/MyTask
+SQLITE_STORE_SUFFIX = '.db'
+
+# An S3 token store is named by a path component ending in this suffix:
+# s3tokens://my-bucket/luigi/pipeline.tokens/MyTask
+S3_STORE_SUFFIX = '.tokens'
+
+# Segments merged by a compaction are deleted only once the compacted
+# segment is this old (in seconds), so readers that listed the old
+# segments before the compaction can still read them
+DEFAULT_COMPACTION_GRACE_SECONDS = 3600
+
+# Default number of seconds a listing of S3 token segments
+# is trusted before checks list the segments again
+DEFAULT_LISTING_TTL = 60
+
+# Maximum number of variables SQLite binds in one statement
+_SQLITE_MAX_VARIABLES = 999
+
+
+def split_store_path(path, scheme, suffix):
+    """
+    Split a token path into the root of its token store and the token's name.
+
+    :type path: str
+    :param path: token path, e.g. sqlite:///var/luigi/tokens.db/MyTask
+
+    :type scheme: str
+    :param scheme: scheme of the path, e.g. sqlite://
+
+    :type suffix: str
+    :param suffix: suffix of the path component naming the store, e.g. .db
+
+    :rtype: tuple:
+    :returns: (store root, token name), e.g. ('/var/luigi/tokens.db', 'MyTask')
+    """
+    components = path[len(scheme):].split('/')
+    for (i, component) in enumerate(components):
+        if component.endswith(suffix):
+            name = '/'.join(components[i + 1:]).strip('/')
+            if not name:
+                break
+            return ('/'.join(components[:i + 1]), name)
+    raise RuntimeError('Token path %s does not name a token in a %s store' % (path, suffix))
+
+
+class TokenStore(object):
+    """
+    Superclass for stores that keep many tokens in one place rather
+    than one file per token. Tokens are appended to a log; writing or
+    removing a token adds an entry, and the latest entry for a name wins.
+    """
+
+    @abc.abstractmethod
+    def exists_many(self, names):
+        """
+        Check the existence of many tokens at once.
+
+        :type names: list of str
+        :param names: token names
+
+        :rtype: dict:
+        :returns: whether each token exists, by name
+        """
+        raise RuntimeError("Please implement the exists_many method")
+
+    @abc.abstractmethod
+    def read(self, name):
+        """
+        :rtype: str:
+        :returns: text of a token, or None if it does not exist
+        """
+        raise RuntimeError("Please implement the read method")
+
+    @abc.abstractmethod
+    def append(self, entries):
+        """
+        Atomically write and remove tokens: either every entry is
+        recorded or none is.
+
+        :type entries: list of tuple
+        :param entries: (name, text) to write a token, or (name, None) to remove one
+        """
+        raise RuntimeError("Please implement the append method")
+
+    def exists(self, name):
+        return self.exists_many([name])[name]
+
+    def write(self, name, text):
+        self.append([(name, text)])
+
+    def remove(self, name):
+        self.append([(name, None)])
+
+    def refresh(self):
+        """
+        Pick up tokens written by other processes, for stores that
+        answer checks from memory.
+        """
+        pass
+
+
+class SqliteTokenStore(TokenStore):
+    """
+    Token store in a local SQLite database, safe to share across threads
+    and processes. Each operation uses its own connection and transaction.
+    """
+
+    def __init__(self, db_path, timeout=30.0):
+        """
+        :type db_path: str
+        :param db_path: path of the SQLite database file, created if missing
+
+        :type timeout: float
+        :param timeout: seconds to wait for another writer to finish
+        """
+        self.db_path = db_path
+        self.timeout = timeout
+        directory = os.path.dirname(db_path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        with self._transaction() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS tokens '
+                         '(seq INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT NOT NULL, '
+                         'text TEXT, written_at REAL NOT NULL)')
+            conn.execute('CREATE INDEX IF NOT EXISTS tokens_by_name ON tokens (name, seq)')
+
+    def exists_many(self, names):
+        latest = self._latest(names)
+        return dict((name, latest.get(name) is not None) for name in names)
+
+    def read(self, name):
+        return self._latest([name]).get(name)
+
+    def append(self, entries):
+        now = time.time()
+        with self._transaction() as conn:
+            conn.executemany('INSERT INTO tokens (name, text, written_at) VALUES (?, ?, ?)',
+                             [(name, text, now) for (name, text) in entries])
+
+    def compact(self):
+        """
+        Delete log entries superseded by a later entry for the same token,
+        and entries for removed tokens.
+        """
+        with self._transaction() as conn:
+            conn.execute('DELETE FROM tokens WHERE seq NOT IN '
+                         '(SELECT MAX(seq) FROM tokens GROUP BY name) OR text IS NULL')
+
+    def _latest(self, names):
+        names = list(set(names))
+        latest = {}
+        conn = self._connect()
+        try:
+            for start in range(0, len(names), _SQLITE_MAX_VARIABLES):
+                batch = names[start:start + _SQLITE_MAX_VARIABLES]
+                rows = conn.execute(
+                    'SELECT name, text FROM tokens WHERE seq IN '
+                    '(SELECT MAX(seq) FROM tokens WHERE name IN (%s) GROUP BY name)' % \
+                    ','.join('?' * len(batch)), batch)
+                latest.update(rows)
+        finally:
+            conn.close()
+        return latest
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=self.timeout)
+        conn.text_factory = str
+        return conn
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        conn = self._connect()
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+
+class S3SegmentTokenStore(TokenStore):
+    """
+    Token store in S3, kept as immutable segment objects under one prefix.
+    Each append writes one new segment, so appends are atomic and never
+    conflict. Segments are numbered in sequence: an append lists the
+    store first and takes the next number, so its segment sorts after
+    every segment its writer had seen, whatever the clocks of the hosts
+    involved. Later segments take precedence.
+
+    The first check in a process lists the segments and reads them all;
+    later checks are answered from memory, kept up to date with this
+    process's own appends, until the listing is `ttl` seconds old. Checks
+    then list the segments again, reading only those not seen before.
+    Call :py:meth:`refresh` to read segments written by other processes
+    sooner, and :py:meth:`compact` to merge segments.
+    """
+
+    def __init__(self, root, client=None, ttl=DEFAULT_LISTING_TTL):
+        """
+        :type root: str
+        :param root: S3 path under which segments are kept
+
+        :type client: :py:class:`luigi.s3.S3Client`
+        :param client: S3 client. Default: the client shared by S3 Targets.
+
+        :type ttl: float
+        :param ttl: seconds a listing of the segments is trusted
+        """
+        self.root = root.rstrip('/')
+        self.client = client
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        # segment name -> its (name, text) entries
+        self._segments = None
+        # compacted segment name -> names of the segments it merged
+        self._merged = {}
+        # segment name -> last modified time, as listed
+        self._modified = {}
+        self._tokens = {}
+        self._listed_at = 0
+        self.segment_reads = 0
+
+    def exists_many(self, names):
+        tokens = self._load()
+        return dict((name, tokens.get(name) is not None) for name in names)
+
+    def read(self, name):
+        return self._load().get(name)
+
+    def append(self, entries):
+        with self.lock:
+            # list first, to number the segment after every one written so far
+            self._list_segments()
+            sequence = max([_segment_sequence(s) for s in self._segments] or [0]) + 1
+            segment = 'segment-%020d-%s' % (sequence, uuid.uuid4().hex)
+            self._put(segment, entries)
+            self._segments[segment] = list(entries)
+            self._apply()
+
+    def refresh(self):
+        """
+        Read segments written since the store was last listed.
+        """
+        with self.lock:
+            self._list_segments()
+
+    def compact(self, grace_seconds=DEFAULT_COMPACTION_GRACE_SECONDS):
+        """
+        Merge every segment into one, dropping removed tokens. The merged
+        segments are deleted only once the compacted segment is
+        `grace_seconds` old, by this or a later compaction, so readers
+        loading them meanwhile lose nothing. Segments appended while
+        compacting are left in place and still take precedence.
+
+        :type grace_seconds: float
+        :param grace_seconds: minimum age of a compacted segment before
+                              the segments it merged are deleted
+
+        :rtype: int:
+        :returns: number of segments merged
+        """
+        with self.lock:
+            self._list_segments()
+            pending = set(s for merged in self._merged.values() for s in merged)
+            merged = sorted((s for s in self._segments if s not in pending), key=_segment_order)
+            if len(merged) >= 2:
+                tokens = {}
+                for segment in merged:
+                    tokens.update(self._segments[segment])
+                entries = [(name, text) for (name, text) in sorted(tokens.items()) if text is not None]
+                # sorts before any segment appended after the last merged one
+                segment = 'segment-%020d-compacted-%s' % (_segment_sequence(merged[-1]), uuid.uuid4().hex)
+                self._put(segment, entries, merged)
+                self._segments[segment] = entries
+                self._merged[segment] = merged
+                logger.info('Compacted %s token segments under %s' % (len(merged), self.root))
+            else:
+                merged = []
+            self._delete_merged(grace_seconds)
+            self._apply()
+            return len(merged)
+
+    def _delete_merged(self, grace_seconds):
+        (bucket_name, _, prefix) = self.root[len('s3://'):].partition('/')
+        now = time.time()
+        for (compacted, merged) in self._merged.items():
+            modified = self._modified.get(compacted)
+            age = now - calendar.timegm(boto_utils.parse_ts(modified).timetuple()) if modified else 0
+            stale = [s for s in merged if s in self._segments]
+            if stale and age >= grace_seconds:
+                bucket = self._client().s3.get_bucket(bucket_name, validate=False)
+                bucket.delete_keys(['%s/%s' % (prefix, s) for s in stale], quiet=True)
+                for s in stale:
+                    del self._segments[s]
+
+    def _load(self):
+        with self.lock:
+            if self._segments is None or time.time() - self._listed_at >= self.ttl:
+                self._list_segments()
+            return self._tokens
+
+    def _list_segments(self):
+        listed_at = time.time()
+        known = dict(self._segments or {})
+        for _ in range(5):
+            listed = self._list_keys()
+            segments = dict((s, e) for (s, e) in known.items() if s in listed)
+            missing = False
+            for segment in set(listed) - set(segments):
+                try:
+                    text = s3.S3Target('%s/%s' % (self.root, segment), client=self._client()).open('r').read()
+                except Exception:
+                    # deleted by a compaction since it was listed; list
+                    # again to find the compacted segment holding its tokens
+                    logger.debug('Token segment %s/%s is gone' % (self.root, segment))
+                    missing = True
+                    break
+                self.segment_reads += 1
+                segments[segment] = known[segment] = self._parse(segment, text)
+            if not missing:
+                break
+        else:
+            logger.warning('Token segments under %s kept changing while being read' % self.root)
+        self._segments = segments
+        self._merged = dict((s, m) for (s, m) in self._merged.items() if s in segments)
+        self._modified = listed
+        self._listed_at = listed_at
+        self._apply()
+
+    def _list_keys(self):
+        (bucket_name, _, prefix) = self.root[len('s3://'):].partition('/')
+        bucket = self._client().s3.get_bucket(bucket_name, validate=False)
+        keys = {}
+        for key in bucket.list(prefix=prefix + '/', delimiter='/'):
+            segment = key.name[len(prefix) + 1:]
+            if segment.startswith('segment-'):
+                keys[segment] = key.last_modified
+        return keys
+
+    def _parse(self, segment, text):
+        entries = []
+        for line in text.splitlines():
+            if not line:
+                continue
+            entry = json.loads(line)
+            if 'merged' in entry:
+                self._merged[segment] = entry['merged']
+            else:
+                entries.append((entry['name'], entry['text']))
+        return entries
+
+    def _apply(self):
+        tokens = {}
+        for segment in sorted(self._segments, key=_segment_order):
+            tokens.update(self._segments[segment])
+        self._tokens = tokens
+
+    def _put(self, segment, entries, merged=None):
+        lines = [json.dumps({'merged': merged})] if merged else []
+        lines.extend(json.dumps({'name': name, 'text': text}) for (name, text) in entries)
+        with s3.S3Target('%s/%s' % (self.root, segment), client=self._client()).open('w') as f:
+            f.write('\n'.join(lines))
+
+    def _client(self):
+        if self.client is None:
+            self.client = target_factory.get_s3_client()
+        return self.client
+
+
+def _segment_sequence(segment):
+    return int(segment.split('-')[1])
+
+def _segment_order(segment):
+    # a compacted segment shares the number of the last segment it
+    # merged, and sorts before other segments with that number
+    compacted = segment.split('-')[2] == 'compacted'
+    return (_segment_sequence(segment), 0 if compacted else 1, segment)
+
+
+class TokenStoreTarget(luigi.Target):
+    """
+    Target for one token in a :py:class:`TokenStore`. Writing the
+    Target appends the token when the file is closed.
+    """
+
+    def __init__(self, path, store, name):
+        """
+        :type path: str
+        :param path: full token path
+
+        :type store: :py:class:`TokenStore`
+        :param store: store holding the token
+
+        :type name: str
+        :param name: token name within the store
+        """
+        self.path = path
+        self.store = store
+        self.name = name
+
+    def exists(self):
+        return self.store.exists(self.name)
+
+    def remove(self):
+        self.store.remove(self.name)
+
+    def open(self, mode='r'):
+        if mode == 'w':
+            return _TokenWriter(self.store, self.name)
+        if mode != 'r':
+            raise ValueError("Unsupported open mode '%s'" % mode)
+        text = self.store.read(self.name)
+        if text is None:
+            raise IOError('Token %s does not exist' % self.path)
+        return StringIO.StringIO(text)
+
+    def __str__(self):
+        return self.path
+
+
+class _TokenWriter(object):
+
+    def __init__(self, store, name):
+        self.store = store
+        self.name = name
+        self.buffer = StringIO.StringIO()
+
+    def write(self, data):
+        self.buffer.write(data)
+
+    def close(self):
+        if self.buffer is not None:
+            self.store.write(self.name, self.buffer.getvalue())
+            self.buffer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # nothing is appended if writing failed
+        if exc_type is None:
+            self.close()
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+_stores_pid = os.getpid()
+
+def get_store(kind, root):
+    """
+    Get the shared token store of a kind at a root in this process.
+    A forked process gets new stores.
+
+    To change how long a listing of S3 token segments is trusted,
+    define the following in your Luigi client configuration file:
+
+    ::[mortar]
+    ::token_store_ttl_seconds: 60
+
+    :type kind: str
+    :param kind: 'sqlite' or 's3'
+
+    :type root: str
+    :param root: SQLite database path, or S3 path of the segments
+
+    :rtype: :py:class:`TokenStore`:
+    :returns: the token store
+    """
+    global _stores_pid
+    with _stores_lock:
+        if _stores_pid != os.getpid():
+            _stores.clear()
+            _stores_pid = os.getpid()
+        store = _stores.get((kind, root))
+        if store is None:
+            if kind == 'sqlite':
+                store = SqliteTokenStore(root)
+            elif kind == 's3':
+                config = luigi.configuration.get_config()
+                ttl = config.getfloat('mortar', 'token_store_ttl_seconds') \
+                    if config.has_option('mortar', 'token_store_ttl_seconds') else DEFAULT_LISTING_TTL
+                store = S3SegmentTokenStore(root, ttl=ttl)
+            else:
+                raise RuntimeError('Unknown token store kind: %s' % kind)
+            _stores[(kind, root)] = store
+        return store
+
+def sqlite_target(path):
+    """
+    Target for a token in a SQLite token store, e.g.
+    sqlite:///var/luigi/tokens.db/MyTask
+    """
+    (root, name) = split_store_path(path, 'sqlite://', SQLITE_STORE_SUFFIX)
+    return TokenStoreTarget(path, get_store('sqlite', root), name)
+
+def s3_segment_target(path):
+    """
+    Target for a token in an S3 segment token store, e.g.
+    s3tokens://my-bucket/luigi/pipeline.tokens/MyTask
+    """
+    (root, name) = split_store_path(path, 's3tokens://', S3_STORE_SUFFIX)
+    return TokenStoreTarget(path, get_store('s3', 's3://' + root), name)
+
+def exists_many(targets):
+    """
+    Check the existence of many token targets, with one query
+    per token store for targets in a store.
+
+    :type targets: list of Target
+    :param targets: token targets
+
+    :rtype: list of bool:
+    :returns: whether each target exists, in order
+    """
+    by_store = {}
+    for target in targets:
+        if isinstance(target, TokenStoreTarget):
+            by_store.setdefault(id(target.store), (target.store, set()))[1].add(target.name)
+    found = {}
+    for (store, names) in by_store.values():
+        for (name, exists) in store.exists_many(list(names)).items():
+            found[(id(store), name)] = exists
+    return [found[(id(t.store), t.name)] if isinstance(t, TokenStoreTarget) else t.exists()
+            for t in targets]
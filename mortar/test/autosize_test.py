@@ -0,0 +1,81 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from luigi.s3 import S3Client
+from moto import mock_s3
+
+from mortar.luigi import autosize
+from mortar.luigi import target_factory
+from mortar.luigi.autosize import ClusterSizeModel
+
+AWS_ACCESS_KEY = "XXXXXX"
+AWS_SECRET_KEY = "XXXXXX"
+GB = 1024 ** 3
+
+
+class TestInputBytes(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    @mock_s3
+    def test_s3_prefix(self):
+        client = S3Client(AWS_ACCESS_KEY, AWS_SECRET_KEY)
+        client.s3.create_bucket('bucket')
+        client.put_string('a' * 10, 's3://bucket/input/part-00000')
+        client.put_string('b' * 5, 's3://bucket/input/day=1/part-00001')
+        client.put_string('c' * 100, 's3://bucket/other/part-00000')
+        client.put_string('d' * 1000, 's3://bucket/input-old/part-00000')
+        self.assertEquals(15, autosize.input_bytes('s3://bucket/input', client))
+        self.assertEquals(15, autosize.input_bytes('s3://bucket/input/', client))
+        self.assertEquals(15, autosize.input_bytes('s3n://bucket/input', client))
+
+    @mock_s3
+    def test_s3_key(self):
+        client = S3Client(AWS_ACCESS_KEY, AWS_SECRET_KEY)
+        client.s3.create_bucket('bucket')
+        client.put_string('a' * 10, 's3://bucket/input/part-00000')
+        client.put_string('b' * 5, 's3://bucket/input/part-00000.gz')
+        self.assertEquals(10, autosize.input_bytes('s3://bucket/input/part-00000', client))
+        self.assertEquals(0, autosize.input_bytes('s3://bucket/missing', client))
+
+    def test_local(self):
+        os.mkdir(os.path.join(self.tmp_dir, 'day=1'))
+        for (name, size) in [('part-00000', 10), ('day=1/part-00001', 5)]:
+            with open(os.path.join(self.tmp_dir, name), 'w') as f:
+                f.write('x' * size)
+        self.assertEquals(15, autosize.input_bytes(self.tmp_dir))
+        self.assertEquals(10, autosize.input_bytes('file://%s/part-00000' % self.tmp_dir))
+
+
+class TestClusterSizeModel(unittest.TestCase):
+
+    def test_default_bytes_per_node(self):
+        model = ClusterSizeModel(bytes_per_node=10 * GB)
+        self.assertEquals(2, model.cluster_size(1 * GB))
+        self.assertEquals(5, model.cluster_size(45 * GB))
+        self.assertEquals(4, model.cluster_size(45 * GB, max_size=4))
+
+    def test_fitted_from_runs(self):
+        model = ClusterSizeModel(bytes_per_node=10 * GB, target_seconds=3600)
+        # each node handled 1GB every 100 seconds: 36GB per hour
+        for (size, seconds) in [(2, 500), (5, 200), (10, 100)]:
+            model.add_run(10 * GB, size, seconds)
+        self.assertEquals(36 * GB, model.fitted_bytes_per_node())
+        self.assertEquals(3, model.cluster_size(100 * GB))
+
+    def test_save_and_load(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            target = target_factory.get_target('%s/sizing/my_script' % tmp_dir)
+            model = ClusterSizeModel()
+            model.add_run(GB, 2, 60)
+            model.save(target)
+            self.assertEquals([(GB, 2, 60)], ClusterSizeModel.load(target).runs)
+        finally:
+            shutil.rmtree(tmp_dir)
@@ -0,0 +1,85 @@
+import hashlib
+import os
+import tempfile
+import unittest
+
+import mock
+
+from mortar.luigi import checksum
+
+class TestChecksum(unittest.TestCase):
+
+    def setUp(self):
+        (fd, self.path) = tempfile.mkstemp()
+        self.data = ''.join(chr(i % 251) for i in range(2500))
+        os.write(fd, self.data)
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def _key(self, etag, size=None, metadata=None):
+        return mock.Mock(etag=etag, size=len(self.data) if size is None else size, metadata=metadata or {})
+
+    def test_parse_etag(self):
+        md5 = hashlib.md5('x').hexdigest()
+        self.assertEquals((md5, None), checksum.parse_etag('"%s"' % md5))
+        self.assertEquals((md5, 12), checksum.parse_etag('"%s-12"' % md5))
+        self.assertEquals(None, checksum.parse_etag('"not-an-md5"'))
+        self.assertEquals(None, checksum.parse_etag(None))
+
+    def test_part_hasher(self):
+        digests = [hashlib.md5(self.data[i:i + 1000]).digest() for i in range(0, len(self.data), 1000)]
+        hasher = checksum.PartHasher(1000)
+        # feed in chunks that straddle part boundaries
+        for i in range(0, len(self.data), 300):
+            hasher.update(self.data[i:i + 300])
+        self.assertEquals(checksum.multipart_etag(digests), hasher.etag())
+        self.assertTrue(hasher.etag().endswith('-3"'))
+
+        hasher = checksum.PartHasher()
+        hasher.update(self.data)
+        self.assertEquals('"%s"' % hashlib.md5(self.data).hexdigest(), hasher.etag())
+
+    def test_etag_part_size(self):
+        md5 = hashlib.md5('x').hexdigest()
+        self.assertEquals((0, True), checksum.etag_part_size(self._key('"%s"' % md5), 1000))
+        self.assertEquals((1000, False), checksum.etag_part_size(self._key('"%s-3"' % md5), 1000))
+        self.assertEquals((900, True), checksum.etag_part_size(
+            self._key('"%s-3"' % md5, metadata={checksum.PART_SIZE_METADATA: '900'}), 1000))
+        self.assertEquals(None, checksum.etag_part_size(self._key('"%s-2"' % md5), 1000))
+        self.assertEquals(None, checksum.etag_part_size(self._key('"kms"'), 1000))
+
+    def test_file_matches_key(self):
+        etag = checksum.file_etag(self.path, 1000)
+        self.assertTrue(checksum.file_matches_key(self.path, self._key(etag), 1000))
+        self.assertTrue(checksum.file_matches_key(
+            self.path, self._key('"%s"' % hashlib.md5(self.data).hexdigest()), 1000))
+        self.assertFalse(checksum.file_matches_key(self.path, self._key(etag, size=10), 1000))
+        self.assertFalse(checksum.file_matches_key(self.path + '.missing', self._key(etag), 1000))
+
+        # same size, different content
+        recorded = {checksum.PART_SIZE_METADATA: '1000'}
+        with open(self.path, 'w') as f:
+            f.write(self.data[::-1])
+        os.utime(self.path, (1, 1))
+        self.assertFalse(checksum.file_matches_key(self.path, self._key(etag, metadata=recorded), 1000))
+
+    def test_file_matches_key_by_size(self):
+        # the ETag of an SSE-KMS object is not derived from its content
+        self.assertTrue(checksum.file_matches_key(self.path, self._key('"kms"'), 1000))
+        self.assertFalse(checksum.file_matches_key(self.path, self._key('"kms"', size=10), 1000))
+        # uploaded elsewhere with an unrecorded part size
+        foreign = checksum.file_etag(self.path, 2000)
+        self.assertTrue(checksum.file_matches_key(self.path, self._key(foreign), 1000))
+        self.assertFalse(checksum.file_matches_key(self.path, self._key(foreign, size=10), 1000))
+
+    def test_remember_file_etag(self):
+        stat = os.stat(self.path)
+        checksum.remember_file_etag(self.path, 1000, '"remembered-3"', stat)
+        self.assertEquals('"remembered-3"', checksum.file_etag(self.path, 1000))
+        # a changed file is hashed again
+        os.utime(self.path, (stat.st_mtime + 10, stat.st_mtime + 10))
+        self.assertEquals(checksum.multipart_etag(
+            [hashlib.md5(self.data[i:i + 1000]).digest() for i in range(0, len(self.data), 1000)]),
+            checksum.file_etag(self.path, 1000))
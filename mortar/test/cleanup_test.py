@@ -0,0 +1,76 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+from luigi import LocalTarget
+from luigi.s3 import S3Client, S3Target
+from moto import mock_s3
+
+from mortar.luigi import cleanup
+
+AWS_ACCESS_KEY = "XXXXXX"
+AWS_SECRET_KEY = "XXXXXX"
+
+
+class TestCleanup(unittest.TestCase):
+
+    def _put(self, client, *paths):
+        for path in paths:
+            client.put_string('data', path)
+
+    def _keys(self, client):
+        return sorted(k.key for k in client.s3.get_bucket('bucket').list())
+
+    @mock_s3
+    def test_remove_s3_prefix_in_batches(self):
+        client = S3Client(AWS_ACCESS_KEY, AWS_SECRET_KEY)
+        client.s3.create_bucket('bucket')
+        self._put(client, *['s3://bucket/output/part-%05d' % i for i in range(5)])
+        self._put(client, 's3://bucket/output-other/part-00000', 's3://bucket/file')
+        bucket = client.s3.get_bucket('bucket')
+        with mock.patch.object(client.s3, 'get_bucket', return_value=bucket):
+            with mock.patch.object(bucket, 'delete_keys', wraps=bucket.delete_keys) as delete_keys:
+                self.assertEquals(5, cleanup.remove_s3_prefix(client, 's3://bucket/output', batch_size=2))
+                self.assertEquals(3, delete_keys.call_count)
+        self.assertEquals(1, cleanup.remove_s3_prefix(client, 's3://bucket/file'))
+        self.assertEquals(['output-other/part-00000'], self._keys(client))
+
+    @mock_s3
+    def test_remove_s3n_prefix(self):
+        client = S3Client(AWS_ACCESS_KEY, AWS_SECRET_KEY)
+        client.s3.create_bucket('bucket')
+        self._put(client, 's3://bucket/output/part-00000', 's3://bucket/output-other/part-00000')
+        self.assertEquals(1, cleanup.remove_s3_prefix(client, 's3n://bucket/output'))
+        self.assertEquals(['output-other/part-00000'], self._keys(client))
+
+    def test_refuses_bucket_root(self):
+        client = S3Client(AWS_ACCESS_KEY, AWS_SECRET_KEY)
+        self.assertRaises(RuntimeError, lambda: cleanup.remove_s3_prefix(client, 's3://bucket/'))
+        self.assertRaises(RuntimeError, lambda: cleanup.remove_s3_prefix(client, 's3n://bucket'))
+
+    @mock_s3
+    def test_remove_targets(self):
+        client = S3Client(AWS_ACCESS_KEY, AWS_SECRET_KEY)
+        client.s3.create_bucket('bucket')
+        self._put(client, 's3://bucket/a/part-00000', 's3://bucket/b/part-00000')
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            local_path = os.path.join(tmp_dir, 'output')
+            open(local_path, 'w').close()
+            failing = mock.Mock()
+            failing.remove.side_effect = IOError('boom')
+            targets = [S3Target('s3://bucket/a', client=client), failing,
+                       S3Target('s3://bucket/b', client=client), LocalTarget(local_path)]
+            failures = cleanup.remove_targets(targets, max_threads=2)
+            self.assertEquals([failing], [t for (t, _) in failures])
+            self.assertEquals([], self._keys(client))
+            self.assertFalse(os.path.exists(local_path))
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_remove_targets_in_background(self):
+        target = mock.Mock()
+        cleanup.remove_targets_in_background([target]).join()
+        target.remove.assert_called_once_with()
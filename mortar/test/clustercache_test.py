@@ -0,0 +1,63 @@
+import unittest
+
+import mock
+
+from mortar.api.v2 import clusters
+from mortar.luigi import clustercache
+
+
+class TestClusterCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = clustercache.ClusterCache()
+        self.api = mock.Mock()
+        self.api.host = 'api.mortardata.com'
+        self.api.auth.username = 'me@example.com'
+        self.api.get.return_value = {'clusters': [
+            {'cluster_id': 'c1', 'size': 5, 'running_jobs': [],
+             'status_code': clusters.CLUSTER_STATUS_RUNNING}]}
+
+    def test_hits_within_ttl(self):
+        self.cache.get_clusters(self.api, ttl=60)
+        self.cache.get_clusters(self.api, ttl=60)
+        self.assertEquals(1, self.api.get.call_count)
+        self.assertEquals({'hits': 1, 'misses': 1}, self.cache.stats())
+
+    def test_misses_when_expired(self):
+        self.cache.get_clusters(self.api, ttl=0)
+        self.cache.get_clusters(self.api, ttl=0)
+        self.assertEquals(2, self.api.get.call_count)
+        self.assertEquals({'hits': 0, 'misses': 2}, self.cache.stats())
+
+    def test_shared_across_api_instances_for_same_account(self):
+        other_api = mock.Mock()
+        other_api.host = self.api.host
+        other_api.auth.username = self.api.auth.username
+        self.cache.get_clusters(self.api, ttl=60)
+        self.cache.get_clusters(other_api, ttl=60)
+        self.assertEquals(0, other_api.get.call_count)
+
+    def test_record_and_forget_job(self):
+        self.cache.get_clusters(self.api, ttl=60)
+        self.cache.record_job(self.api, 'c1', 'job1')
+        self.assertEquals(['job1'], self.cache.get_clusters(self.api, ttl=60)[0]['running_jobs'])
+        self.cache.forget_job(self.api, 'c1', 'job1')
+        self.assertEquals([], self.cache.get_clusters(self.api, ttl=60)[0]['running_jobs'])
+        # the API response itself is never modified
+        self.assertEquals([], self.api.get.return_value['clusters'][0]['running_jobs'])
+
+    def test_invalidate(self):
+        self.cache.get_clusters(self.api, ttl=60)
+        self.cache.invalidate(self.api)
+        self.cache.get_clusters(self.api, ttl=60)
+        self.assertEquals(2, self.api.get.call_count)
+
+    def test_last_busy(self):
+        self.assertEquals(None, self.cache.last_busy('c1'))
+        self.api.get.return_value['clusters'][0]['running_jobs'] = ['job1']
+        self.cache.get_clusters(self.api, ttl=60)
+        self.assertTrue(self.cache.last_busy('c1') > 0)
+        self.cache.record_job(self.api, 'c2', 'job2')
+        self.assertTrue(self.cache.last_busy('c2') > 0)
+        self.cache.record_job_finished('c3')
+        self.assertTrue(self.cache.last_busy('c3') > 0)
@@ -1,5 +1,6 @@
 import ConfigParser
 import cStringIO as StringIO
+import gzip
 import os.path
 import tempfile
 import unittest
@@ -10,6 +11,7 @@ import mock
 
 
 from mortar.luigi import dbms
+from mortar.luigi import target_factory
 
 class TestExtractFromMySQL(unittest.TestCase):
     
@@ -42,4 +44,34 @@ class TestExtractFromMySQL(unittest.TestCase):
 
             os.remove(output_file)
 
+    @mock.patch("mortar.luigi.dbms.luigi.configuration")
+    def test_extract_gzip(self, mock_config):
+        """
+        Tests that extracting to a .gz path compresses the extracted rows.
+        """
+        output_file = os.path.join(tempfile.gettempdir(), 'extract-%s.txt.gz' % uuid.uuid4().hex)
+        conf = ConfigParser.ConfigParser()
+        conf.add_section('mysql')
+        for (option, value) in [('dbname', 'mydb'), ('host', 'myhost'), ('port', '3306'),
+                                ('user', 'myuser'), ('password', 'my_password')]:
+            conf.set('mysql', option, value)
+        mock_config.get_config.return_value = conf
 
+        def popen(cmd, stdout=None, **kwargs):
+            # the mysql CLI writes rows to the output file descriptor
+            os.write(stdout.fileno(), 'a\t1\nb\t2\n')
+            process = mock.Mock()
+            process.stderr = StringIO.StringIO()
+            process.communicate.return_value = (None, None)
+            process.returncode = 0
+            return process
+
+        with mock.patch("mortar.luigi.dbms.subprocess") as subprocess:
+            subprocess.Popen.side_effect = popen
+            t = dbms.ExtractFromMySQL(table='foo', output_path=output_file)
+            luigi.build([t], local_scheduler=True)
+        try:
+            self.assertEquals('a\t1\nb\t2\n', gzip.open(output_file).read())
+            self.assertEquals('a\t1\nb\t2\n', target_factory.get_target(output_file).open('r').read())
+        finally:
+            os.remove(output_file)
@@ -0,0 +1,253 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import luigi
+import mock
+from requests.exceptions import HTTPError
+
+from mortar.api.v2 import clusters
+from mortar.api.v2 import jobs
+from mortar.luigi import autosize
+from mortar.luigi import clustercache
+from mortar.luigi import jobpoller
+from mortar.luigi import target_factory
+from mortar.luigi.fakeapi import FakeMortarAPI
+from mortar.luigi.mortartask import MortarClusterShutdownTask, MortarProjectTask
+from mortar.luigi.straggler import ProgressModel
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+class TestFakeMortarAPI(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.api = FakeMortarAPI(job_duration=100, cluster_start_seconds=50, clock=self.clock)
+
+    def test_job_on_new_cluster(self):
+        job_id = jobs.post_job_new_cluster(self.api, 'project', 'script', 3)
+        self.assertEquals(jobs.STATUS_STARTING_CLUSTER, jobs.get_job(self.api, job_id)['status_code'])
+        self.assertEquals(clusters.CLUSTER_STATUS_STARTING,
+                          clusters.get_clusters(self.api)['clusters'][0]['status_code'])
+
+        self.clock.now += 100
+        job = jobs.get_job(self.api, job_id)
+        self.assertEquals(jobs.STATUS_RUNNING, job['status_code'])
+        self.assertEquals(50, job['progress'])
+        self.assertEquals([job_id], clusters.get_clusters(self.api)['clusters'][0]['running_jobs'])
+
+        self.clock.now += 100
+        self.assertEquals(jobs.STATUS_SUCCESS, jobs.get_job(self.api, job_id)['status_code'])
+        self.assertEquals([], clusters.get_clusters(self.api)['clusters'][0]['running_jobs'])
+        self.assertEquals({'POST jobs': 1, 'GET jobs': 3, 'GET clusters': 3}, self.api.calls)
+
+    def test_job_on_existing_cluster(self):
+        cluster_id = self.api.add_cluster(5)
+        job_id = jobs.post_job_existing_cluster(self.api, 'project', 'script', cluster_id)
+        self.assertEquals(jobs.STATUS_RUNNING, jobs.get_job(self.api, job_id)['status_code'])
+        clusters.stop_cluster(self.api, cluster_id)
+        self.assertRaises(HTTPError,
+            lambda: jobs.post_job_existing_cluster(self.api, 'project', 'script', cluster_id))
+
+    def test_single_job_cluster_stops_after_job(self):
+        jobs.post_job_new_cluster(self.api, 'project', 'script', 3,
+                                  cluster_type=clusters.CLUSTER_TYPE_SINGLE_JOB)
+        self.clock.now += 200
+        self.assertEquals(clusters.CLUSTER_STATUS_DESTROYED,
+                          clusters.get_clusters(self.api)['clusters'][0]['status_code'])
+
+    def test_failures(self):
+        api = FakeMortarAPI(failure_rate=1.0)
+        self.assertRaises(HTTPError, lambda: clusters.get_clusters(api))
+        api = FakeMortarAPI(job_duration=0, job_failure_rate=1.0)
+        job_id = jobs.post_job_existing_cluster(api, 'project', 'script', clusters.LOCAL_CLUSTER_ID)
+        self.assertEquals(jobs.STATUS_EXECUTION_ERROR, jobs.get_job(api, job_id)['status_code'])
+
+
+class FakeAPIMortarProjectTask(MortarProjectTask):
+    token_dir = luigi.Parameter()
+
+    def is_control_script(self):
+        return False
+
+    def project(self):
+        return 'project'
+
+    def script(self):
+        return 'script'
+
+    def script_output(self):
+        return []
+
+    def token_path(self):
+        return 'file://%s' % self.token_dir
+
+    def polling_policy(self):
+        return jobpoller.FixedPollingPolicy(0)
+
+class TestMortarProjectTaskWithFakeAPI(unittest.TestCase):
+
+    def setUp(self):
+        self.token_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.token_dir)
+
+    @mock.patch('mortar.luigi.mortartask.clustercache.get_cluster_cache')
+    @mock.patch('mortar.luigi.mortartask.MortarTask._get_api')
+    def test_run_on_running_cluster(self, get_api, get_cluster_cache):
+        get_cluster_cache.return_value = clustercache.ClusterCache()
+        api = FakeMortarAPI(job_duration=0.01)
+        cluster_id = api.add_cluster(3)
+        get_api.return_value = api
+        t = FakeAPIMortarProjectTask(token_dir=self.token_dir)
+        t.run()
+        self.assertTrue(t.complete())
+        self.assertEquals(cluster_id, api.jobs['job-1']['cluster_id'])
+        self.assertEquals(1, api.calls['POST jobs'])
+        self.assertEquals(1, api.calls['GET clusters'])
+
+    @mock.patch('mortar.luigi.mortartask.clustercache.get_cluster_cache')
+    @mock.patch('mortar.luigi.mortartask.MortarTask._get_api')
+    def test_finished_job_keeps_cluster_warm(self, get_api, get_cluster_cache):
+        get_cluster_cache.return_value = clustercache.ClusterCache()
+        api = FakeMortarAPI(job_duration=0.01)
+        cluster_id = api.add_cluster(3)
+        api.clusters[cluster_id]['start_timestamp'] = time.time() - 3600
+        get_api.return_value = api
+        # picked up from the running token, so never recorded at submission
+        job_id = jobs.post_job_existing_cluster(api, 'project', 'script', cluster_id)
+        t = FakeAPIMortarProjectTask(token_dir=self.token_dir)
+        target_factory.write_file(t.running_token(), text=job_id)
+        t.run()
+        self.assertTrue(t.complete())
+
+        MortarClusterShutdownTask(min_idle_seconds=600).run()
+        self.assertFalse(api.clusters[cluster_id]['stopped'])
+
+    @mock.patch('mortar.luigi.mortartask.MortarProjectTask.job_stop_supported', return_value=True)
+    @mock.patch('mortar.luigi.mortartask.clustercache.get_cluster_cache')
+    @mock.patch('mortar.luigi.mortartask.MortarTask._get_api')
+    def test_speculative_resubmit(self, get_api, get_cluster_cache, job_stop_supported):
+        get_cluster_cache.return_value = clustercache.ClusterCache()
+        durations = [1000, 0.5]
+        api = FakeMortarAPI(job_duration=lambda: durations.pop(0))
+        get_api.return_value = api
+        t = FakeAPIMortarProjectTask(token_dir=self.token_dir, detect_stragglers=True,
+                                     speculative_resubmit=True, min_straggler_seconds=0)
+        t.script_output = lambda: ['s3://bucket/output']
+        t.speculative_parameters = lambda: {'output': 's3://bucket/output-speculative'}
+        # past runs took a second
+        ProgressModel(runs=[[(1, 100)]] * 3).save(t.progress_history())
+
+        t.run()
+        self.assertTrue(t.complete())
+        self.assertFalse(t.running_token().exists())
+        self.assertEquals(2, api.calls['POST jobs'])
+        self.assertTrue(api.jobs['job-1']['stopped'])
+        self.assertEquals({'output': 's3://bucket/output-speculative'}, api.jobs['job-2']['parameters'])
+        self.assertEquals(4, len(ProgressModel.load(t.progress_history()).runs))
+
+    @mock.patch('mortar.luigi.mortartask.clustercache.get_cluster_cache')
+    @mock.patch('mortar.luigi.mortartask.MortarTask._get_api')
+    def test_no_resubmit_without_job_stop(self, get_api, get_cluster_cache):
+        get_cluster_cache.return_value = clustercache.ClusterCache()
+        api = FakeMortarAPI(job_duration=1.5)
+        get_api.return_value = api
+        t = FakeAPIMortarProjectTask(token_dir=self.token_dir, detect_stragglers=True, speculative_resubmit=True,
+                                     min_straggler_seconds=0, straggler_slowdown=0.5)
+        ProgressModel(runs=[[(1, 100)]] * 3).save(t.progress_history())
+
+        t.run()
+        self.assertTrue(t.complete())
+        self.assertEquals(1, api.calls['POST jobs'])
+
+    @mock.patch('mortar.luigi.mortartask.MortarProjectTask.job_stop_supported', return_value=True)
+    @mock.patch('mortar.luigi.mortartask.clustercache.get_cluster_cache')
+    @mock.patch('mortar.luigi.mortartask.MortarTask._get_api')
+    def test_no_resubmit_to_shared_output(self, get_api, get_cluster_cache, job_stop_supported):
+        get_cluster_cache.return_value = clustercache.ClusterCache()
+        api = FakeMortarAPI(job_duration=1.5)
+        get_api.return_value = api
+        t = FakeAPIMortarProjectTask(token_dir=self.token_dir, detect_stragglers=True, speculative_resubmit=True,
+                                     min_straggler_seconds=0, straggler_slowdown=0.5)
+        t.script_output = lambda: ['s3://bucket/output']
+        ProgressModel(runs=[[(1, 100)]] * 3).save(t.progress_history())
+
+        t.run()
+        self.assertTrue(t.complete())
+        self.assertEquals(1, api.calls['POST jobs'])
+
+    @mock.patch('mortar.luigi.mortartask.MortarProjectTask.job_stop_supported', return_value=True)
+    @mock.patch('mortar.luigi.mortartask.clustercache.get_cluster_cache')
+    @mock.patch('mortar.luigi.mortartask.MortarTask._get_api')
+    def test_unstopped_attempt_waited_for(self, get_api, get_cluster_cache, job_stop_supported):
+        get_cluster_cache.return_value = clustercache.ClusterCache()
+        durations = [2, 0.1]
+        api = FakeMortarAPI(job_duration=lambda: durations.pop(0), stop_jobs=False)
+        job_details = api._job_details
+        # as the API may report it
+        api._job_details = lambda job, now: dict(job_details(job, now), progress=str(job_details(job, now)['progress']))
+        get_api.return_value = api
+        t = FakeAPIMortarProjectTask(token_dir=self.token_dir, detect_stragglers=True, speculative_resubmit=True,
+                                     min_straggler_seconds=0, straggler_slowdown=0.5)
+        ProgressModel(runs=[[(1, 100)]] * 3).save(t.progress_history())
+
+        t.run()
+        self.assertTrue(t.complete())
+        self.assertEquals(2, api.calls['POST jobs'])
+        self.assertEquals(1, api.calls['DELETE jobs'])
+        # the first attempt could not be stopped, so it ran to the end
+        self.assertTrue(time.time() >= api.jobs['job-1']['end_time'])
+
+    @mock.patch('mortar.luigi.mortartask.clustercache.get_cluster_cache')
+    @mock.patch('mortar.luigi.mortartask.MortarTask._get_api')
+    def test_auto_cluster_size(self, get_api, get_cluster_cache):
+        get_cluster_cache.return_value = clustercache.ClusterCache()
+        api = FakeMortarAPI(job_duration=0.01)
+        get_api.return_value = api
+        input_path = '%s/input' % self.token_dir
+        with open(input_path, 'w') as f:
+            f.write('x' * 1000)
+        t = FakeAPIMortarProjectTask(token_dir=self.token_dir, auto_cluster_size=True, bytes_per_node=200)
+        t.input_paths = lambda: [input_path]
+        t.run()
+        self.assertEquals(5, api.clusters[api.jobs['job-1']['cluster_id']]['size'])
+        # the parameter, and so the task's identity, is unchanged
+        self.assertEquals(2, t.cluster_size)
+        self.assertEquals(1, len(autosize.ClusterSizeModel.load(t.sizing_history()).runs))
+
+    @mock.patch('mortar.luigi.mortartask.clustercache.get_cluster_cache')
+    @mock.patch('mortar.luigi.mortartask.MortarTask._get_api')
+    def test_tail_job_logs(self, get_api, get_cluster_cache):
+        get_cluster_cache.return_value = clustercache.ClusterCache()
+        api = FakeMortarAPI(job_duration=0.01)
+        get_api.return_value = api
+        source = mock.Mock()
+        source.read.side_effect = lambda job_id, offset: \
+            '2014-03-10 18:40:05,000 [main] INFO  MapReduceLauncher - HadoopJobId: job_1\n'[offset:]
+        t = FakeAPIMortarProjectTask(token_dir=self.token_dir, tail_job_logs=True)
+        t.job_log_source = lambda api: source
+        t.run()
+        self.assertEquals(['job_1'], [s['hadoop_job_id'] for s in t.pig_stage_timings()])
+
+    @mock.patch('mortar.luigi.mortartask.clustercache.get_cluster_cache')
+    @mock.patch('mortar.luigi.mortartask.MortarTask._get_api')
+    def test_run_with_token_store(self, get_api, get_cluster_cache):
+        get_cluster_cache.return_value = clustercache.ClusterCache()
+        get_api.return_value = FakeMortarAPI(job_duration=0.01)
+        t = FakeAPIMortarProjectTask(token_dir=self.token_dir)
+        t.token_path = lambda: 'sqlite://%s/tokens.db' % self.token_dir
+        self.assertFalse(t.complete())
+        t.run()
+        self.assertTrue(t.complete())
+        self.assertFalse(t.running_token().exists())
+        self.assertEquals(['tokens.db'], os.listdir(self.token_dir))
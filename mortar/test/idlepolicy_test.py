@@ -0,0 +1,51 @@
+import unittest
+
+from mortar.luigi import idlepolicy
+from mortar.luigi.idlepolicy import IdleClusterPolicy
+
+
+def _cluster(cluster_id, size=2, num_jobs=0):
+    return {'cluster_id': cluster_id, 'size': size,
+            'running_jobs': ['job-%s' % i for i in range(num_jobs)]}
+
+class TestIdleClusterPolicy(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 10000.0
+        # seconds each cluster has been idle
+        self.idle = {'old': 3600, 'recent': 60, 'newest': 10, 'big': 1800}
+        self.clusters = [_cluster('busy', size=10, num_jobs=1), _cluster('old'), _cluster('recent'),
+                         _cluster('newest'), _cluster('big', size=10)]
+
+    def _idle_since(self, cluster):
+        idle = self.idle[cluster['cluster_id']]
+        return None if idle is None else self.now - idle
+
+    def _stop(self, policy):
+        return [c['cluster_id'] for c in policy.clusters_to_stop(self.clusters, self._idle_since, now=self.now)]
+
+    def test_default_stops_all_idle(self):
+        self.assertEquals(['old', 'big', 'recent', 'newest'], self._stop(IdleClusterPolicy()))
+
+    def test_min_idle(self):
+        self.assertEquals(['old', 'big'], self._stop(IdleClusterPolicy(min_idle_seconds=600)))
+
+    def test_unknown_idle_time_counts_as_long_idle(self):
+        self.idle['old'] = None
+        self.assertEquals(['old'], self._stop(IdleClusterPolicy(min_idle_seconds=3000)))
+
+    def test_keep_warm_keeps_most_recently_used(self):
+        self.assertEquals(['old', 'big'], self._stop(IdleClusterPolicy(keep_warm={2: 2})))
+        self.assertEquals(['big'], self._stop(IdleClusterPolicy(keep_warm={2: 5})))
+
+    def test_cost_ceiling_overrides_keep_warm(self):
+        # 26 nodes at $1/hour; keeping 2 warm clusters leaves 22 nodes running
+        policy = IdleClusterPolicy(min_idle_seconds=600, keep_warm={2: 2},
+                                   max_hourly_cost=12, node_hourly_cost=1.0)
+        self.assertEquals(['old', 'big', 'recent'], self._stop(policy))
+
+    def test_parse_timestamp(self):
+        self.assertEquals(0.0, idlepolicy.parse_timestamp('1970-01-01T00:00:00.000000+00:00'))
+        self.assertEquals(12.5, idlepolicy.parse_timestamp(12.5))
+        self.assertEquals(None, idlepolicy.parse_timestamp('yesterday'))
+        self.assertEquals(None, idlepolicy.parse_timestamp(None))
@@ -0,0 +1,106 @@
+import unittest
+
+import mock
+
+from mortar.luigi import joblogs
+
+PIG_LOG = '''2014-03-10 18:40:00,000 [main] INFO  org.apache.pig.backend.hadoop.executionengine.mapReduceLayer.MapReduceLauncher - Processing aliases raw,filtered
+2014-03-10 18:40:05,000 [main] INFO  org.apache.pig.backend.hadoop.executionengine.mapReduceLayer.MapReduceLauncher - HadoopJobId: job_201403101843_0001
+2014-03-10 18:42:00,000 [main] INFO  org.apache.pig.backend.hadoop.executionengine.mapReduceLayer.MapReduceLauncher - 50% complete
+2014-03-10 18:45:05,000 [main] INFO  org.apache.pig.backend.hadoop.executionengine.mapReduceLayer.MapReduceLauncher - Processing aliases grouped
+2014-03-10 18:45:05,000 [main] INFO  org.apache.pig.backend.hadoop.executionengine.mapReduceLayer.MapReduceLauncher - HadoopJobId: job_201403101843_0002
+2014-03-10 18:55:05,000 [main] INFO  org.apache.pig.tools.pigstats.SimplePigStats - Script Statistics:
+
+Job Stats (time in seconds):
+JobId\tMaps\tReduces\tMaxMapTime\tMinMapTIme\tAvgMapTime\tMedianMapTime\tMaxReduceTime\tMinReduceTime\tAvgReduceTime\tMedianReducetime\tAlias\tFeature\tOutputs
+job_201403101843_0001\t10\t0\t120\t30\t60\t55\t0\t0\t0\t0\traw,filtered\tMAP_ONLY\t
+job_201403101843_0002\t5\t2\t40\t20\t30\t30\t400\t300\t350\t350\tgrouped\tGROUP_BY\ts3://bucket/out,
+
+Input(s):
+'''
+
+class FakeLogSource(joblogs.LogSource):
+
+    def __init__(self, log):
+        self.log = log
+        self.available = 0
+        self.reads = []
+
+    def read(self, job_id, offset):
+        self.reads.append(offset)
+        return self.log[offset:self.available]
+
+class TestPigStageParser(unittest.TestCase):
+
+    def test_stages(self):
+        parser = joblogs.PigStageParser()
+        for line in PIG_LOG.split('\n'):
+            parser.feed(line)
+        stages = parser.stages()
+        self.assertEquals(['job_201403101843_0001', 'job_201403101843_0002'],
+                          [s['hadoop_job_id'] for s in stages])
+        self.assertEquals('raw,filtered', stages[0]['aliases'])
+        self.assertEquals(300, stages[0]['duration_seconds'])
+        self.assertEquals(600, stages[1]['duration_seconds'])
+        self.assertEquals(120, stages[0]['max_map_seconds'])
+        self.assertEquals(350, stages[1]['avg_reduce_seconds'])
+
+    def test_running_stage_has_no_duration(self):
+        parser = joblogs.PigStageParser()
+        for line in PIG_LOG.split('\n')[:3]:
+            parser.feed(line)
+        self.assertEquals([None], [s['duration_seconds'] for s in parser.stages()])
+
+class TestJobLogTailer(unittest.TestCase):
+
+    def test_reads_only_new_bytes(self):
+        source = FakeLogSource(PIG_LOG)
+        tailer = joblogs.JobLogTailer(source, interval=0)
+        # stop halfway through a line
+        partial = PIG_LOG.index('HadoopJobId') + 5
+        source.available = partial
+        tailer.tail('job1')
+        self.assertEquals([], tailer.stage_timings('job1'))
+        source.available = len(PIG_LOG)
+        tailer.tail('job1')
+        tailer.tail('job1')
+        self.assertEquals([0, partial, len(PIG_LOG)], source.reads)
+        self.assertEquals(2, len(tailer.stage_timings('job1')))
+
+    def test_finish_reads_last_line(self):
+        source = FakeLogSource(PIG_LOG.split('\n')[1])
+        tailer = joblogs.JobLogTailer(source, interval=0)
+        source.available = len(source.log)
+        tailer.tail('job1')
+        self.assertEquals([], tailer.stage_timings('job1'))
+        tailer.finish('job1')
+        self.assertEquals(['job_201403101843_0001'], [s['hadoop_job_id'] for s in tailer.stage_timings('job1')])
+
+    def test_interval(self):
+        source = FakeLogSource(PIG_LOG)
+        tailer = joblogs.JobLogTailer(source, interval=60)
+        tailer.tail('job1')
+        tailer.tail('job1')
+        self.assertEquals(1, len(source.reads))
+        tailer.tail('job1', force=True)
+        self.assertEquals(2, len(source.reads))
+
+    def test_read_failures_are_not_raised(self):
+        source = mock.Mock()
+        source.read.side_effect = IOError('boom')
+        joblogs.JobLogTailer(source).tail('job1')
+
+class TestUrlLogSource(unittest.TestCase):
+
+    @mock.patch('mortar.luigi.joblogs.requests.get')
+    def test_range_requests(self, get):
+        source = joblogs.UrlLogSource('https://logs/jobs/{job_id}/log')
+        get.return_value = mock.Mock(status_code=206, content='new')
+        self.assertEquals('new', source.read('job1', 10))
+        get.assert_called_with('https://logs/jobs/job1/log', auth=None, headers={'Range': 'bytes=10-'})
+
+        get.return_value = mock.Mock(status_code=200, content='0123456789new')
+        self.assertEquals('new', source.read('job1', 10))
+
+        get.return_value = mock.Mock(status_code=416)
+        self.assertEquals('', source.read('job1', 10))
@@ -0,0 +1,191 @@
+import threading
+import unittest
+
+import mock
+
+from mortar.api.v2 import jobs
+from mortar.luigi import jobpoller
+from mortar.luigi import mortarapi
+
+
+def _job(status, progress=None):
+    return {'status_code': status,
+            'status_description': status,
+            'progress': progress}
+
+class TestJobPoller(unittest.TestCase):
+
+    def setUp(self):
+        self.poller = jobpoller.JobPoller()
+        self.api = mock.Mock()
+
+    @mock.patch('mortar.luigi.jobpoller.jobs.get_job')
+    def test_wait_until_complete(self, get_job):
+        get_job.side_effect = [_job(jobs.STATUS_STARTING),
+                               _job(jobs.STATUS_RUNNING, 50),
+                               _job(jobs.STATUS_SUCCESS, 100)]
+        job = self.poller.wait(self.api, 'job1', polling_interval=0)
+        self.assertEquals(jobs.STATUS_SUCCESS, job['status_code'])
+        self.assertEquals(3, get_job.call_count)
+        self.assertEquals([], self.poller.outstanding_job_ids())
+
+    @mock.patch('mortar.luigi.jobpoller.jobs.get_job')
+    def test_retries_then_raises(self, get_job):
+        get_job.side_effect = IOError('boom')
+        self.assertRaises(IOError,
+            lambda: self.poller.wait(self.api, 'job1', polling_interval=0, num_polling_retries=2))
+        # one initial attempt plus two retries
+        self.assertEquals(3, get_job.call_count)
+
+    @mock.patch('mortar.luigi.jobpoller.jobs.get_job')
+    def test_retry_count_resets_on_success(self, get_job):
+        get_job.side_effect = [IOError('boom'),
+                               _job(jobs.STATUS_RUNNING, 10),
+                               IOError('boom'),
+                               _job(jobs.STATUS_SUCCESS, 100)]
+        job = self.poller.wait(self.api, 'job1', polling_interval=0, num_polling_retries=1)
+        self.assertEquals(jobs.STATUS_SUCCESS, job['status_code'])
+
+    @mock.patch('mortar.luigi.jobpoller.jobs.get_job')
+    def test_processing_errors_count_as_retries(self, get_job):
+        get_job.return_value = _job(jobs.STATUS_RUNNING, 10)
+        policy = mock.Mock()
+        policy.next_interval.side_effect = ValueError('bad policy')
+        policy.retry_interval.return_value = 0
+        self.assertRaises(ValueError,
+            lambda: self.poller.wait(self.api, 'job1', num_polling_retries=2, policy=policy))
+        self.assertEquals(3, get_job.call_count)
+
+    @mock.patch('mortar.luigi.jobpoller.jobs.get_job')
+    def test_thread_survives_policy_errors(self, get_job):
+        get_job.side_effect = IOError('boom')
+        policy = mock.Mock()
+        policy.retry_interval.side_effect = ValueError('bad retry policy')
+        self.assertRaises(ValueError,
+            lambda: self.poller.wait(self.api, 'job1', num_polling_retries=2, policy=policy))
+        # the same thread keeps polling other jobs
+        thread = self.poller._thread
+        get_job.side_effect = None
+        get_job.return_value = _job(jobs.STATUS_SUCCESS, 100)
+        self.assertEquals(jobs.STATUS_SUCCESS,
+                          self.poller.wait(self.api, 'job2', polling_interval=0)['status_code'])
+        self.assertTrue(thread is self.poller._thread and thread.is_alive())
+
+    @mock.patch('mortar.luigi.jobpoller.jobs.get_job')
+    def test_waiters_share_a_watch(self, get_job):
+        release = threading.Event()
+        def get_job_blocking(api, job_id):
+            release.wait()
+            return _job(jobs.STATUS_SUCCESS, 100)
+        get_job.side_effect = get_job_blocking
+
+        first = self.poller.watch(self.api, 'job1', polling_interval=0)
+        second = self.poller.watch(self.api, 'job1', polling_interval=0)
+        self.assertTrue(first is second)
+        release.set()
+        self.assertEquals(jobs.STATUS_SUCCESS, first.wait()['status_code'])
+        self.assertEquals(1, get_job.call_count)
+
+    @mock.patch('mortar.luigi.jobpoller.jobs.get_job')
+    def test_slow_poll_does_not_block_others(self, get_job):
+        release = threading.Event()
+        def get_job_slow(api, job_id):
+            if job_id == 'slow':
+                release.wait()
+            return _job(jobs.STATUS_SUCCESS, 100)
+        get_job.side_effect = get_job_slow
+
+        slow = self.poller.watch(self.api, 'slow', polling_interval=0)
+        try:
+            job = self.poller.watch(self.api, 'job1', polling_interval=0).wait(timeout=5)
+            self.assertEquals(jobs.STATUS_SUCCESS, job['status_code'])
+            self.assertFalse(slow.done())
+        finally:
+            release.set()
+        self.assertEquals(jobs.STATUS_SUCCESS, slow.wait()['status_code'])
+
+    @mock.patch('mortar.luigi.jobpoller.jobs.get_job')
+    def test_pooled_api_polled_without_client_retries(self, get_job):
+        api = mortarapi.PooledAPI('me@example.com', 'key1', host='api.example.com')
+        with mock.patch.object(api, 'get_once') as get_once:
+            get_once.side_effect = [IOError('boom'), _job(jobs.STATUS_SUCCESS, 100)]
+            job = self.poller.wait(api, 'job1', polling_interval=0, num_polling_retries=1)
+        self.assertEquals(jobs.STATUS_SUCCESS, job['status_code'])
+        get_once.assert_called_with('jobs/job1')
+        self.assertFalse(get_job.called)
+
+    def test_get_job_poller_is_shared(self):
+        self.assertTrue(jobpoller.get_job_poller() is jobpoller.get_job_poller())
+
+    def test_get_job_status_description(self):
+        job = {'status_description': 'Running', 'status_details': 'Stage 1'}
+        self.assertEquals('Running - Stage 1', jobpoller.get_job_status_description(job))
+        job = {'status_description': None, 'status_details': 'Stage 1'}
+        self.assertEquals('Stage 1', jobpoller.get_job_status_description(job))
+
+class TestAdaptivePollingPolicy(unittest.TestCase):
+
+    def setUp(self):
+        self.policy = jobpoller.AdaptivePollingPolicy(interval=5, min_interval=1, max_interval=60,
+                                                      starting_interval=30, eta_fraction=0.25, jitter=0.5)
+        self.watch = jobpoller.JobWatch(mock.Mock(), 'job1', self.policy, 3)
+
+    def test_cluster_starting(self):
+        self.assertEquals(30, self.policy.next_interval(self.watch, _job(jobs.STATUS_STARTING_CLUSTER)))
+
+    def test_running_without_progress_rate(self):
+        self.assertEquals(5, self.policy.next_interval(self.watch, _job(jobs.STATUS_RUNNING, 0)))
+
+    def test_running_uses_progress_rate(self):
+        # 10% per 100 seconds leaves 500 seconds at 50%
+        self.watch.first_progress = (1000.0, 40)
+        self.watch.last_progress = (1100.0, 50)
+        self.assertEquals(60, self.policy.next_interval(self.watch, _job(jobs.STATUS_RUNNING, 50)))
+
+        # 10% per 10 seconds leaves 20 seconds at 80%
+        self.watch.first_progress = (1000.0, 70)
+        self.watch.last_progress = (1010.0, 80)
+        self.assertEquals(5, self.policy.next_interval(self.watch, _job(jobs.STATUS_RUNNING, 80)))
+
+        # almost done: poll as often as allowed
+        self.watch.last_progress = (1029.0, 99)
+        self.assertEquals(1, self.policy.next_interval(self.watch, _job(jobs.STATUS_RUNNING, 99)))
+
+    @mock.patch('mortar.luigi.jobpoller.random.uniform')
+    def test_retry_backs_off_with_jitter(self, uniform):
+        uniform.return_value = 1.2
+        self.watch.exception_count = 1
+        self.assertEquals(6, self.policy.retry_interval(self.watch))
+        self.watch.exception_count = 3
+        self.assertEquals(24, self.policy.retry_interval(self.watch))
+        self.watch.exception_count = 10
+        self.assertEquals(60, self.policy.retry_interval(self.watch))
+        uniform.assert_called_with(0.5, 1.5)
+
+    @mock.patch('mortar.luigi.jobpoller.jobs.get_job')
+    def test_poller_records_progress(self, get_job):
+        get_job.side_effect = [_job(jobs.STATUS_RUNNING, 10),
+                               _job(jobs.STATUS_RUNNING, 20),
+                               _job(jobs.STATUS_SUCCESS, 100)]
+        policy = jobpoller.AdaptivePollingPolicy(interval=0, min_interval=0, max_interval=0)
+        watch = jobpoller.JobPoller().watch(mock.Mock(), 'job1', policy=policy)
+        watch.wait()
+        self.assertEquals(10, watch.first_progress[1])
+        self.assertEquals(20, watch.last_progress[1])
+
+    def test_wait_with_timeout(self):
+        watch = jobpoller.JobWatch(mock.Mock(), 'job1', jobpoller.FixedPollingPolicy(0), 3)
+        self.assertEquals(None, watch.wait(timeout=0.01))
+        watch._finish(job=_job(jobs.STATUS_SUCCESS, 100))
+        self.assertEquals(jobs.STATUS_SUCCESS, watch.wait(timeout=0.01)['status_code'])
+
+    @mock.patch('mortar.luigi.jobpoller.jobs.get_job')
+    def test_progress_curve(self, get_job):
+        get_job.side_effect = [_job(jobs.STATUS_STARTING),
+                               _job(jobs.STATUS_RUNNING, 10),
+                               _job(jobs.STATUS_RUNNING, 20),
+                               _job(jobs.STATUS_SUCCESS, 100)]
+        watch = jobpoller.JobPoller().watch(mock.Mock(), 'job1', polling_interval=0)
+        watch.wait()
+        self.assertEquals([10, 20], [progress for (_, progress) in watch.progress_curve()])
+        self.assertTrue(all(elapsed >= 0 for (elapsed, _) in watch.progress_curve()))
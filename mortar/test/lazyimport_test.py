@@ -0,0 +1,42 @@
+import os
+import subprocess
+import sys
+import unittest
+
+import mock
+
+from mortar.luigi import lazyimport
+
+class TestLazyModule(unittest.TestCase):
+
+    def test_getattr(self):
+        lazy_json = lazyimport.LazyModule('json')
+        import json
+        self.assertEquals(json.dumps, lazy_json.dumps)
+
+    def test_patch(self):
+        lazy_json = lazyimport.LazyModule('json')
+        with mock.patch.object(lazy_json, 'dumps') as dumps:
+            dumps.return_value = 'patched'
+            self.assertEquals('patched', lazy_json.dumps({}))
+        self.assertEquals('{}', lazy_json.dumps({}))
+
+    def test_is_instance(self):
+        self.assertFalse(lazyimport.is_instance(object(), 'mortar.luigi.nonexistent', 'Missing'))
+        self.assertTrue(lazyimport.is_instance(mock.Mock(), 'mock', 'Mock'))
+        self.assertFalse(lazyimport.is_instance(object(), 'mock', 'Mock'))
+
+class TestImportCost(unittest.TestCase):
+
+    def _loaded_by_import(self, module, candidates):
+        # only count dependencies the import itself loaded
+        code = 'import sys; before = set(m for m in sys.modules if sys.modules[m]); import %s; ' \
+            'print(",".join(m for m in %r if sys.modules.get(m) and m not in before))' % (module, candidates)
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+        return subprocess.check_output([sys.executable, '-c', code], env=env).strip()
+
+    def test_modules_defer_heavy_dependencies(self):
+        for module in ('mortar.luigi.target_factory', 'mortar.luigi.mortartask',
+                       'mortar.luigi.shellscript', 'mortar.luigi.mongodb'):
+            self.assertEquals('', self._loaded_by_import(
+                module, ['boto', 'luigi.s3', 'requests', 'pymongo', 'mortar.api.v2']), module)
@@ -0,0 +1,78 @@
+import ConfigParser
+import unittest
+
+import mock
+
+from mortar.luigi import mortarapi
+from mortar.luigi.mortartask import MortarTask
+
+
+class TestMortarAPI(unittest.TestCase):
+
+    def test_get_api_is_pooled_per_account(self):
+        api = mortarapi.get_api('me@example.com', 'key1', host='api.example.com')
+        self.assertTrue(api is mortarapi.get_api('me@example.com', 'key1', host='api.example.com'))
+        self.assertFalse(api is mortarapi.get_api('me@example.com', 'key1', host='other.example.com'))
+        self.assertFalse(api is mortarapi.get_api('you@example.com', 'key1', host='api.example.com'))
+
+    def test_get_api_keyed_by_pool_size(self):
+        api = mortarapi.get_api('pool@example.com', 'key1', pool_size=3)
+        other = mortarapi.get_api('pool@example.com', 'key1', pool_size=5)
+        self.assertFalse(api is other)
+        self.assertEquals(5, other.pool_size)
+        self.assertTrue(api is mortarapi.get_api('pool@example.com', 'key1', pool_size=3))
+
+    def test_get_api_replaced_on_new_api_key(self):
+        api = mortarapi.get_api('rotate@example.com', 'key1')
+        new_api = mortarapi.get_api('rotate@example.com', 'key2')
+        self.assertFalse(api is new_api)
+        self.assertEquals('key2', new_api.auth.password)
+
+    def test_requests_use_session(self):
+        api = mortarapi.PooledAPI('me@example.com', 'key1', host='api.example.com', pool_size=3)
+        self.assertEquals(3, api.session.get_adapter('https://api.example.com').poolmanager.connection_pool_kw['maxsize'])
+        with mock.patch.object(api.session, 'request') as request:
+            request.return_value.status_code = 200
+            request.return_value.json.return_value = {'job_id': 'job1'}
+            self.assertEquals({'job_id': 'job1'}, api.post('jobs', {'a': 1}))
+            request.assert_called_with('POST', 'https://api.example.com/v2/jobs', data='{"a": 1}')
+            api.get('jobs/job1', params={'b': 2})
+            request.assert_called_with('GET', 'https://api.example.com/v2/jobs/job1', params={'b': 2})
+
+    @mock.patch('mortar.api.v2.api.sleep')
+    def test_requests_retried(self, sleep):
+        api = mortarapi.PooledAPI('me@example.com', 'key1', host='api.example.com')
+        ok = mock.Mock(status_code=200)
+        ok.json.return_value = {'status_code': 'running'}
+        with mock.patch.object(api.session, 'request') as request:
+            request.side_effect = [mortarapi.requests.ConnectionError('reset'), ok]
+            self.assertEquals({'status_code': 'running'}, api.get('jobs/job1'))
+            self.assertEquals(2, request.call_count)
+            self.assertEquals(1, sleep.call_count)
+
+    @mock.patch('mortar.api.v2.api.sleep')
+    def test_get_once_not_retried(self, sleep):
+        api = mortarapi.PooledAPI('me@example.com', 'key1', host='api.example.com')
+        with mock.patch.object(api.session, 'request') as request:
+            request.side_effect = mortarapi.requests.ConnectionError('reset')
+            self.assertRaises(mortarapi.requests.ConnectionError, api.get_once, 'jobs/job1')
+            self.assertEquals(1, request.call_count)
+            self.assertFalse(sleep.called)
+
+    def test_delete_with_payload_uses_session(self):
+        api = mortarapi.PooledAPI('me@example.com', 'key1', host='api.example.com')
+        with mock.patch.object(api.session, 'request') as request:
+            request.return_value.status_code = 200
+            api.delete_with_payload('clusters/c1', {'a': 1})
+            request.assert_called_with('DELETE', 'https://api.example.com/v2/clusters/c1', data='{"a": 1}')
+
+    @mock.patch('mortar.luigi.mortartask.luigi.configuration')
+    def test_mortar_task_reuses_api(self, mock_config):
+        conf = ConfigParser.ConfigParser()
+        conf.add_section('mortar')
+        conf.set('mortar', 'email', 'task@example.com')
+        conf.set('mortar', 'api_key', 'key1')
+        mock_config.get_config.return_value = conf
+        t = MortarTask()
+        self.assertTrue(t._get_api() is t._get_api())
+        self.assertEquals(mortarapi.DEFAULT_POOL_SIZE, t._get_api().pool_size)
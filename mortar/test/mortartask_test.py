@@ -1,11 +1,17 @@
-import unittest, luigi
+import shutil, tempfile, unittest, luigi
 from luigi import configuration
 from mock import patch
 
 from mortar.api.v2 import clusters
+from mortar.api.v2 import jobs
 
 
-from mortar.luigi.mortartask import MortarTask, MortarProjectTask
+from mortar.luigi import clustercache
+from mortar.luigi import jobpoller
+from mortar.luigi import mortarapi
+from mortar.luigi import placement
+from mortar.luigi.mortartask import MortarTask, MortarProjectTask, MortarProjectTaskGroup, run_concurrently
+from mortar.luigi.mortartask import MortarClusterShutdownTask, MortarClusterWarmUpTask, pending_cluster_demands
 
 PROJECT_NAME = 'projectName'
 
@@ -30,8 +36,31 @@ class TestMortarTaskProject(unittest.TestCase):
         t = TestMortarProjectTask()
         self.assertRaises(RuntimeError, lambda: t.project())
 
-    def test_get_usable_cluster(self):
+    @patch('mortar.luigi.mortartask.luigi.configuration')
+    def test_job_log_source_auth_only_for_api_host(self, configuration):
+        config = configuration.get_config.return_value
+        config.has_option.return_value = True
+        api = mortarapi.PooledAPI('me@example.com', 'key', host='api.mortardata.com')
+        t = TestMortarProjectTask()
+        config.get.return_value = 'https://api.mortardata.com/v2/jobs/{job_id}/log'
+        self.assertEquals(api.auth, t.job_log_source(api).auth)
+        config.get.return_value = 'https://logs.example.com/jobs/{job_id}/log'
+        self.assertEquals(None, t.job_log_source(api).auth)
+
+    @patch('mortar.luigi.mortartask.luigi.configuration')
+    def test_job_stop_supported_from_config(self, configuration):
+        config = configuration.get_config.return_value
         t = TestMortarProjectTask()
+        config.has_option.return_value = False
+        self.assertFalse(t.job_stop_supported())
+        config.has_option.return_value = True
+        config.getboolean.return_value = True
+        self.assertTrue(t.job_stop_supported())
+        config.getboolean.assert_called_with('mortar', 'job_stop_supported')
+
+    def test_get_usable_cluster(self):
+        # each call below uses a different API response
+        t = TestMortarProjectTask(cluster_cache_ttl=0)
 
         free_persistent = self._make_cluster()
         busy_persistent = self._make_cluster(num_jobs=2)
@@ -50,14 +79,340 @@ class TestMortarTaskProject(unittest.TestCase):
         self.assertEquals([free_persistent, busy_persistent],
                           t._get_usable_clusters(all_cluster_api, 3))
 
+    @patch('mortar.luigi.mortartask.clustercache.get_cluster_cache')
+    def test_claim_usable_cluster(self, get_cluster_cache):
+        get_cluster_cache.return_value = clustercache.ClusterCache()
+        big = self._make_cluster(size=10, cluster_id='big')
+        small = self._make_cluster(size=5, cluster_id='small')
+        api = self._mock_api([small, big])
+
+        first = TestMortarProjectTask(cluster_size=3)
+        second = TestMortarProjectTask(cluster_size=3, pig_version='0.9')
+        third = TestMortarProjectTask(cluster_size=3, pig_version='0.8')
+        (first_cluster_id, _) = first._claim_usable_cluster(api)
+        (second_cluster_id, _) = second._claim_usable_cluster(api)
+        # best fit: the small cluster is used first
+        self.assertEquals('small', first_cluster_id)
+        self.assertEquals('big', second_cluster_id)
+        self.assertEquals((None, None), third._claim_usable_cluster(api))
+        self.assertEquals({'hits': 2, 'misses': 1}, get_cluster_cache.return_value.stats())
+
+    @patch('mortar.luigi.mortartask.clustercache.get_cluster_cache')
+    def test_claim_shared_cluster_by_free_slots(self, get_cluster_cache):
+        get_cluster_cache.return_value = clustercache.ClusterCache()
+        # 10 nodes with one unknown job: 64 free map slots
+        busy = self._make_cluster(size=10, num_jobs=1, cluster_id='busy')
+        # 12 nodes, idle: 96 free map slots
+        idle = self._make_cluster(size=12, cluster_id='idle')
+        api = self._mock_api([idle, busy])
+
+        t = TestMortarProjectTask(cluster_size=6, share_running_cluster=True)
+        (cluster_id, claim) = t._claim_usable_cluster(api)
+        self.assertEquals('busy', cluster_id)
+        self.assertEquals(48, get_cluster_cache.return_value.job_demands()[claim].map_slots)
+
+        # largest cluster strategy ignores free slots
+        t.placement_strategy = lambda: placement.LargestClusterStrategy(t.share_running_cluster)
+        get_cluster_cache.return_value = clustercache.ClusterCache()
+        self.assertEquals('idle', t._claim_usable_cluster(api)[0])
+        # even when the largest cluster has no free slots left
+        full = self._make_cluster(size=20, num_jobs=10, cluster_id='full')
+        get_cluster_cache.return_value = clustercache.ClusterCache()
+        self.assertEquals('full', t._claim_usable_cluster(self._mock_api([idle, full]))[0])
+
     def _mock_api(self, clusters):
         return {'clusters': {'clusters': clusters }}
 
     def _make_cluster(self, size=5, status=clusters.CLUSTER_STATUS_RUNNING, 
-                      ctype=clusters.CLUSTER_TYPE_PERSISTENT, num_jobs=0):
+                      ctype=clusters.CLUSTER_TYPE_PERSISTENT, num_jobs=0, cluster_id=None):
         return {
+            'cluster_id': cluster_id,
             'status_code': status,
             'cluster_type_code': ctype,
             'size': size,
             'running_jobs': [ 'foo-%s' % (i) for i in range(num_jobs) ]
-        }
\ No newline at end of file
+        }
+
+class TestGroupedMortarProjectTask(MortarProjectTask):
+    token_dir = luigi.Parameter()
+    fail = luigi.BooleanParameter(default=False)
+
+    def is_control_script(self):
+        return False
+
+    def project(self):
+        return PROJECT_NAME
+
+    def script(self):
+        return 'my_pig_script'
+
+    def script_output(self):
+        return []
+
+    def token_path(self):
+        # tokens are named after the class, so keep each task's apart
+        return 'file://%s/%s' % (self.token_dir, self.pig_version)
+
+    def polling_policy(self):
+        return jobpoller.FixedPollingPolicy(0)
+
+    def parameters(self):
+        return {'fail': self.fail}
+
+class TestMortarProjectTaskGroup(MortarProjectTaskGroup):
+    token_dir = luigi.Parameter()
+
+    def tasks(self):
+        return [TestGroupedMortarProjectTask(token_dir=self.token_dir, cluster_size=0, pig_version=str(i))
+                for i in range(3)]
+
+class TestRunConcurrently(unittest.TestCase):
+
+    def setUp(self):
+        self.token_dir = tempfile.mkdtemp()
+        self.job_params = {}
+
+    def tearDown(self):
+        shutil.rmtree(self.token_dir)
+
+    def _post_job(self, api, project, script, cluster_id, **kwargs):
+        job_id = 'job-%s' % kwargs['pig_version']
+        self.job_params[job_id] = kwargs['parameters']
+        return job_id
+
+    def _get_job(self, api, job_id):
+        status = jobs.STATUS_EXECUTION_ERROR if self.job_params[job_id]['fail'] else jobs.STATUS_SUCCESS
+        return {'status_code': status, 'status_description': status}
+
+    @patch('mortar.luigi.mortartask.MortarTask._get_api')
+    @patch('mortar.luigi.jobpoller.jobs.get_job')
+    @patch('mortar.luigi.mortartask.jobs.post_job_existing_cluster')
+    def test_group_runs_all_tasks(self, post_job, get_job, get_api):
+        post_job.side_effect = self._post_job
+        get_job.side_effect = self._get_job
+        group = TestMortarProjectTaskGroup(token_dir=self.token_dir)
+        self.assertFalse(group.complete())
+        group.run()
+        self.assertTrue(group.complete())
+        self.assertEquals(3, post_job.call_count)
+        for task in group.tasks():
+            self.assertFalse(task.running_token().exists())
+
+    @patch('mortar.luigi.mortartask.MortarTask._get_api')
+    @patch('mortar.luigi.jobpoller.jobs.get_job')
+    @patch('mortar.luigi.mortartask.jobs.post_job_existing_cluster')
+    def test_failures_reported_after_all_finish(self, post_job, get_job, get_api):
+        post_job.side_effect = self._post_job
+        get_job.side_effect = self._get_job
+        good = TestGroupedMortarProjectTask(token_dir=self.token_dir, cluster_size=0, pig_version='good')
+        bad = TestGroupedMortarProjectTask(token_dir=self.token_dir, cluster_size=0, pig_version='bad', fail=True)
+        self.assertRaises(Exception, lambda: run_concurrently([bad, good]))
+        self.assertTrue(good.complete())
+        self.assertFalse(bad.complete())
+
+    @patch('mortar.luigi.mortartask.MortarTask._get_api')
+    @patch('mortar.luigi.jobpoller.jobs.get_job')
+    def test_tasks_sized_like_run(self, get_job, get_api):
+        get_job.side_effect = self._get_job
+        tasks = [TestGroupedMortarProjectTask(token_dir=self.token_dir, cluster_size=2, auto_cluster_size=True,
+                                              pig_version=str(i)) for i in range(2)]
+        for task in tasks:
+            self.job_params['job-%s' % task.pig_version] = {'fail': False}
+        with patch.object(TestGroupedMortarProjectTask, '_choose_cluster_size', return_value='sizing'), \
+                patch.object(TestGroupedMortarProjectTask, '_record_sizing') as record_sizing, \
+                patch.object(TestGroupedMortarProjectTask, '_run_job', autospec=True,
+                             side_effect=lambda task, api: 'job-%s' % task.pig_version):
+            run_concurrently(tasks)
+            self.assertEquals(2, record_sizing.call_count)
+            self.assertEquals('sizing', record_sizing.call_args[0][0])
+        for task in tasks:
+            self.assertTrue(task.complete())
+
+    def test_group_requires_flattened(self):
+        group = TestMortarProjectTaskGroup(token_dir=self.token_dir)
+        required = [luigi.Task(), luigi.Task()]
+        with patch.object(TestGroupedMortarProjectTask, 'requires', return_value=required):
+            self.assertEquals(required * 3, group.requires())
+
+
+class TestFingerprint(unittest.TestCase):
+
+    def setUp(self):
+        self.token_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.token_dir)
+
+    def test_fingerprint_changes_with_inputs(self):
+        t = TestGroupedMortarProjectTask(token_dir=self.token_dir, use_fingerprint=True)
+        same = TestGroupedMortarProjectTask(token_dir=self.token_dir, use_fingerprint=True, cluster_size=5)
+        other_params = TestGroupedMortarProjectTask(token_dir=self.token_dir, use_fingerprint=True, fail=True)
+        other_ref = TestGroupedMortarProjectTask(token_dir=self.token_dir, use_fingerprint=True, git_ref='abc123')
+        self.assertEquals(t.fingerprint(), same.fingerprint())
+        self.assertNotEquals(t.fingerprint(), other_params.fingerprint())
+        self.assertNotEquals(t.fingerprint(), other_ref.fingerprint())
+
+    def test_success_token_uses_fingerprint(self):
+        t = TestGroupedMortarProjectTask(token_dir=self.token_dir, use_fingerprint=True)
+        self.assertEquals('%s/%s/fingerprints/%s' % (self.token_dir, t.pig_version, t.fingerprint()),
+                          t.success_token().path)
+        self.assertFalse(t.complete())
+        t.running_token().open('w').close()
+        t._finish_job('job1', {'status_code': jobs.STATUS_SUCCESS})
+        self.assertTrue(t.complete())
+        self.assertEquals(t._fingerprint_inputs(), t.success_token().open().read().strip())
+        # an identical job in a new task is a cache hit
+        self.assertTrue(TestGroupedMortarProjectTask(token_dir=self.token_dir, use_fingerprint=True,
+                                                     cluster_size=5).complete())
+
+
+class TestExtractTask(luigi.Task):
+    def complete(self):
+        return False
+
+class TestWarmedMortarProjectTask(TestGroupedMortarProjectTask):
+    def requires(self):
+        return [TestExtractTask()]
+
+class TestMortarClusterWarmUpTask(MortarClusterWarmUpTask):
+    token_dir = luigi.Parameter()
+
+    def pipeline_tasks(self):
+        return [TestWarmedMortarProjectTask(token_dir=self.token_dir, cluster_size=5),
+                TestWarmedMortarProjectTask(token_dir=self.token_dir, cluster_size=3, pig_version='0.9'),
+                TestWarmedMortarProjectTask(token_dir=self.token_dir, cluster_size=0, pig_version='local'),
+                TestWarmedMortarProjectTask(token_dir=self.token_dir, cluster_size=3, pig_version='single',
+                                            run_on_single_use_cluster=True)]
+
+    def warm_up_script(self):
+        return 'warm_up'
+
+    def project(self):
+        return PROJECT_NAME
+
+class TestClusterWarmUp(unittest.TestCase):
+
+    def setUp(self):
+        self.token_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.token_dir)
+
+    def test_pending_cluster_demands(self):
+        t = TestMortarClusterWarmUpTask(token_dir=self.token_dir)
+        self.assertEquals([3, 5], sorted(d.cluster_size for d in pending_cluster_demands(t.pipeline_tasks())))
+        # completed tasks need no cluster
+        done = t.pipeline_tasks()[0]
+        done.running_token().open('w').close()
+        done._finish_job('job1', {'status_code': jobs.STATUS_SUCCESS})
+        self.assertEquals([3], [d.cluster_size for d in pending_cluster_demands(t.pipeline_tasks())])
+
+    def test_pending_cluster_demands_auto_sized(self):
+        input_path = '%s/input' % self.token_dir
+        with open(input_path, 'w') as f:
+            f.write('x' * 1000)
+        task = TestWarmedMortarProjectTask(token_dir=self.token_dir, cluster_size=2, pig_version='auto',
+                                           auto_cluster_size=True, bytes_per_node=200)
+        task.input_paths = lambda: [input_path]
+        self.assertEquals([5], [d.cluster_size for d in pending_cluster_demands([task])])
+
+    @patch('mortar.luigi.mortartask.clustercache.get_cluster_cache')
+    @patch('mortar.luigi.mortartask.MortarTask._get_api')
+    @patch('mortar.luigi.mortartask.jobs.post_job_new_cluster')
+    def test_starts_clusters_not_already_starting(self, post_job, get_api, get_cluster_cache):
+        get_cluster_cache.return_value = clustercache.ClusterCache()
+        get_api.return_value = {'clusters': {'clusters': [
+            {'cluster_id': 'starting', 'status_code': clusters.CLUSTER_STATUS_STARTING,
+             'cluster_type_code': clusters.CLUSTER_TYPE_PERSISTENT, 'size': 3, 'running_jobs': ['warm-up']},
+            {'cluster_id': 'single', 'status_code': clusters.CLUSTER_STATUS_RUNNING,
+             'cluster_type_code': clusters.CLUSTER_TYPE_SINGLE_JOB, 'size': 10, 'running_jobs': []}]}}
+        post_job.return_value = 'job1'
+        TestMortarClusterWarmUpTask(token_dir=self.token_dir, use_spot_instances=False).run()
+        self.assertEquals(1, post_job.call_count)
+        (args, kwargs) = post_job.call_args
+        self.assertEquals((PROJECT_NAME, 'warm_up', 5), args[1:])
+        self.assertEquals(clusters.CLUSTER_TYPE_PERSISTENT, kwargs['cluster_type'])
+        self.assertFalse(kwargs['use_spot_instances'])
+
+    @patch('mortar.luigi.mortartask.clustercache.get_cluster_cache')
+    @patch('mortar.luigi.mortartask.MortarTask._get_api')
+    def test_complete_once_clusters_starting(self, get_api, get_cluster_cache):
+        get_cluster_cache.return_value = clustercache.ClusterCache()
+        cluster_list = [
+            {'cluster_id': 'starting', 'status_code': clusters.CLUSTER_STATUS_STARTING,
+             'cluster_type_code': clusters.CLUSTER_TYPE_PERSISTENT, 'size': 3, 'running_jobs': ['warm-up']}]
+        get_api.return_value = {'clusters': {'clusters': cluster_list}}
+        t = TestMortarClusterWarmUpTask(token_dir=self.token_dir, plan_ttl=0)
+        self.assertFalse(t.complete())
+        cluster_list.append(
+            {'cluster_id': 'running', 'status_code': clusters.CLUSTER_STATUS_RUNNING,
+             'cluster_type_code': clusters.CLUSTER_TYPE_PERSISTENT, 'size': 5, 'running_jobs': []})
+        self.assertTrue(t.complete())
+
+    @patch('mortar.luigi.mortartask.clustercache.get_cluster_cache')
+    @patch('mortar.luigi.mortartask.MortarTask._get_api')
+    @patch('mortar.luigi.mortartask.jobs.post_job_new_cluster')
+    def test_plan_reused(self, post_job, get_api, get_cluster_cache):
+        get_cluster_cache.return_value = clustercache.ClusterCache()
+        get_api.return_value = {'clusters': {'clusters': []}}
+        post_job.return_value = 'job1'
+        t = TestMortarClusterWarmUpTask(token_dir=self.token_dir, pig_version='reused')
+        with patch('mortar.luigi.mortartask.pending_cluster_demands',
+                   wraps=pending_cluster_demands) as demands:
+            self.assertFalse(t.complete())
+            self.assertFalse(t.complete())
+            t.run()
+            self.assertTrue(t.complete())
+            self.assertEquals(1, demands.call_count)
+        self.assertEquals(2, post_job.call_count)
+
+
+class TestMortarClusterShutdownTask(unittest.TestCase):
+
+    def setUp(self):
+        self.clusters = [
+            {'cluster_id': 'busy', 'status_code': clusters.CLUSTER_STATUS_RUNNING, 'size': 5,
+             'running_jobs': ['job1']},
+            {'cluster_id': 'idle-1', 'status_code': clusters.CLUSTER_STATUS_RUNNING, 'size': 2,
+             'running_jobs': [], 'start_timestamp': '2014-01-01T00:00:00'},
+            {'cluster_id': 'idle-2', 'status_code': clusters.CLUSTER_STATUS_RUNNING, 'size': 2,
+             'running_jobs': [], 'start_timestamp': '2014-01-01T00:00:00'},
+            {'cluster_id': 'stopping', 'status_code': clusters.CLUSTER_STATUS_STOPPING, 'size': 2,
+             'running_jobs': []}]
+
+    @patch('mortar.luigi.mortartask.clustercache.get_cluster_cache')
+    @patch('mortar.luigi.mortartask.MortarTask._get_api')
+    @patch('mortar.luigi.mortartask.clusters.stop_cluster')
+    def test_stops_idle_clusters(self, stop_cluster, get_api, get_cluster_cache):
+        get_cluster_cache.return_value = clustercache.ClusterCache()
+        get_api.return_value = {'clusters': {'clusters': self.clusters}}
+        MortarClusterShutdownTask().run()
+        self.assertEquals(['idle-1', 'idle-2'], sorted(c[0][1] for c in stop_cluster.call_args_list))
+
+    @patch('mortar.luigi.mortartask.clustercache.get_cluster_cache')
+    @patch('mortar.luigi.mortartask.MortarTask._get_api')
+    @patch('mortar.luigi.mortartask.clusters.stop_cluster')
+    def test_keeps_recently_used_clusters(self, stop_cluster, get_api, get_cluster_cache):
+        cache = clustercache.ClusterCache()
+        get_cluster_cache.return_value = cache
+        get_api.return_value = {'clusters': {'clusters': self.clusters}}
+        cache.record_job(get_api.return_value, 'idle-1', 'job2')
+        MortarClusterShutdownTask(min_idle_seconds=600).run()
+        self.assertEquals(['idle-2'], [c[0][1] for c in stop_cluster.call_args_list])
+
+        stop_cluster.reset_mock()
+        MortarClusterShutdownTask(keep_warm_clusters=1).run()
+        self.assertEquals(['idle-2'], [c[0][1] for c in stop_cluster.call_args_list])
+
+    @patch('mortar.luigi.mortartask.clustercache.get_cluster_cache')
+    @patch('mortar.luigi.mortartask.MortarTask._get_api')
+    @patch('mortar.luigi.mortartask.clusters.stop_cluster')
+    def test_failures_reported_after_all_stops(self, stop_cluster, get_api, get_cluster_cache):
+        get_cluster_cache.return_value = clustercache.ClusterCache()
+        get_api.return_value = {'clusters': {'clusters': self.clusters}}
+        def stop(api, cluster_id):
+            if cluster_id == 'idle-1':
+                raise IOError('boom')
+        stop_cluster.side_effect = stop
+        self.assertRaises(Exception, lambda: MortarClusterShutdownTask().run())
+        self.assertEquals(2, stop_cluster.call_count)
@@ -0,0 +1,73 @@
+import unittest
+
+from mortar.luigi import placement
+from mortar.luigi.placement import BestFitStrategy, ClusterSlots, JobDemand, LargestClusterStrategy
+
+
+class TestClusterSlots(unittest.TestCase):
+
+    def test_from_cluster(self):
+        cluster = {'cluster_id': 'c1', 'size': '5', 'running_jobs': ['known', 'unknown']}
+        slots = ClusterSlots.from_cluster(cluster, {'known': JobDemand(1)})
+        # 40 map / 15 reduce slots, less 1 known node and 2 assumed nodes
+        self.assertEquals(16, slots.free_map_slots)
+        self.assertEquals(6, slots.free_reduce_slots)
+
+    def test_fits(self):
+        slots = ClusterSlots('c1', 4, free_map_slots=16, free_reduce_slots=6)
+        self.assertTrue(slots.fits(JobDemand(2)))
+        self.assertFalse(slots.fits(JobDemand(3)))
+        # a job never runs on a cluster smaller than its cluster_size
+        self.assertFalse(ClusterSlots('c2', 2).fits(JobDemand(3)))
+
+
+class TestStrategies(unittest.TestCase):
+
+    def _clusters(self):
+        return [ClusterSlots('big', 10), ClusterSlots('medium', 5), ClusterSlots('small', 2)]
+
+    def test_largest(self):
+        self.assertEquals('big', LargestClusterStrategy().choose(self._clusters(), JobDemand(2)).cluster_id)
+        self.assertEquals(None, LargestClusterStrategy().choose(self._clusters(), JobDemand(11)))
+
+    def test_largest_ignores_free_slots(self):
+        clusters = self._clusters()
+        clusters[0].allocate(JobDemand(10))
+        # idle clusters only, unless sharing running clusters
+        self.assertEquals('medium', LargestClusterStrategy().choose(clusters, JobDemand(2)).cluster_id)
+        self.assertEquals('big', LargestClusterStrategy(True).choose(clusters, JobDemand(2)).cluster_id)
+
+    def test_best_fit(self):
+        strategy = BestFitStrategy()
+        self.assertEquals('small', strategy.choose(self._clusters(), JobDemand(2)).cluster_id)
+        self.assertEquals('medium', strategy.choose(self._clusters(), JobDemand(3)).cluster_id)
+        self.assertEquals(None, strategy.choose(self._clusters(), JobDemand(11)))
+
+    def test_best_fit_place_all_places_largest_first(self):
+        placements = BestFitStrategy().place_all(self._clusters(),
+            [JobDemand(2), JobDemand(2), JobDemand(10), JobDemand(5)])
+        self.assertEquals(['small', None, 'big', 'medium'],
+                          [p and p.cluster_id for p in placements])
+
+    def test_simulated_makespan(self):
+        # two small jobs arrive just before a large one
+        jobs = [(0, 2, 60), (0, 2, 60), (1, 10, 60)]
+        cluster_sizes = [10, 4]
+        self.assertEquals(120, placement.simulate(LargestClusterStrategy(), cluster_sizes, jobs))
+        self.assertEquals(61, placement.simulate(BestFitStrategy(), cluster_sizes, jobs))
+
+    def test_simulate_rejects_oversized_jobs(self):
+        self.assertRaises(ValueError, lambda: placement.simulate(BestFitStrategy(), [2], [(0, 5, 10)]))
+
+
+class TestPlanClusterLaunches(unittest.TestCase):
+
+    def test_launches_for_jobs_without_a_cluster(self):
+        candidates = [ClusterSlots('medium', 5)]
+        demands = [JobDemand(2), JobDemand(5), JobDemand(3), JobDemand(10)]
+        # the 5-node job takes the running cluster
+        self.assertEquals([10, 3, 2], placement.plan_cluster_launches(BestFitStrategy(), candidates, demands))
+
+    def test_max_launches(self):
+        demands = [JobDemand(2), JobDemand(5), JobDemand(3)]
+        self.assertEquals([5, 3], placement.plan_cluster_launches(BestFitStrategy(), [], demands, max_launches=2))
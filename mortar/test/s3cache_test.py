@@ -0,0 +1,139 @@
+import gzip
+import os
+import shutil
+import StringIO
+import tempfile
+import unittest
+
+import luigi
+import mock
+from luigi.s3 import S3Client
+from moto import mock_s3
+
+from mortar.luigi import redshift
+from mortar.luigi import s3cache
+from mortar.luigi import target_factory
+
+AWS_ACCESS_KEY = "XXXXXX"
+AWS_SECRET_KEY = "XXXXXX"
+
+class TestDiskCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.cache = s3cache.DiskCache(os.path.join(self.tmp_dir, 'cache'), max_bytes=10)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _download(self, data):
+        def download(path):
+            with open(path, 'w') as f:
+                f.write(data)
+        return download
+
+    def test_keyed_by_etag(self):
+        self.assertEquals(None, self.cache.get('s3://b/a', '"1"'))
+        entry = self.cache.put('s3://b/a', '"1"', self._download('abc'))
+        self.assertEquals(entry, self.cache.get('s3://b/a', '"1"'))
+        self.assertEquals(None, self.cache.get('s3://b/a', '"2"'))
+        self.cache.put('s3://b/a', '"2"', self._download('abcd'))
+        # the old version is replaced
+        self.assertEquals(None, self.cache.get('s3://b/a', '"1"'))
+        self.assertEquals(1, len(os.listdir(self.cache.directory)))
+        self.assertEquals((1, 3), (self.cache.hits, self.cache.misses))
+
+    def test_lru_eviction(self):
+        a = self.cache.put('s3://b/a', '1', self._download('aaaa'))
+        b = self.cache.put('s3://b/b', '1', self._download('bbbb'))
+        os.utime(a, (1000, 1000))
+        os.utime(b, (2000, 2000))
+        # using a makes b the least recently used
+        self.cache.get('s3://b/a', '1')
+        self.cache.put('s3://b/c', '1', self._download('cccc'))
+        self.assertTrue(os.path.exists(a))
+        self.assertFalse(os.path.exists(b))
+
+    def test_failed_download_leaves_nothing(self):
+        def download(path):
+            raise IOError('boom')
+        self.assertRaises(IOError, self.cache.put, 's3://b/a', '1', download)
+        self.assertEquals([], os.listdir(self.cache.directory))
+
+class TestCachedS3Target(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.cache = s3cache.DiskCache(self.tmp_dir, max_bytes=1000)
+        target_factory.clear_cache()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+        target_factory.clear_cache()
+
+    def _client(self):
+        client = S3Client(AWS_ACCESS_KEY, AWS_SECRET_KEY)
+        client.s3.create_bucket('bucket')
+        return client
+
+    @mock_s3
+    def test_read_through(self):
+        client = self._client()
+        client.put_string('v1', 's3://bucket/data')
+        target = s3cache.CachedS3Target('s3://bucket/data', self.cache, client=client)
+        self.assertEquals('v1', target.open('r').read())
+        self.assertEquals('v1', target.open('r').read())
+        self.assertEquals((1, 1), (self.cache.hits, self.cache.misses))
+
+        client.put_string('v2', 's3://bucket/data')
+        self.assertEquals('v2', target.open('r').read())
+        self.assertEquals((1, 2), (self.cache.hits, self.cache.misses))
+
+    @mock_s3
+    def test_large_objects_bypass_cache(self):
+        client = self._client()
+        client.put_string('x' * 2000, 's3://bucket/big')
+        target = s3cache.CachedS3Target('s3://bucket/big', self.cache, client=client)
+        self.assertEquals('x' * 2000, target.open('r').read())
+        self.assertEquals([], os.listdir(self.tmp_dir))
+
+    @mock_s3
+    def test_compressed(self):
+        client = self._client()
+        data = StringIO.StringIO()
+        with gzip.GzipFile(fileobj=data, mode='w') as f:
+            f.write('compressed')
+        client.put_string(data.getvalue(), 's3://bucket/data.gz')
+        target = s3cache.CachedS3Target('s3://bucket/data.gz', self.cache,
+                                        format=luigi.format.Gzip, client=client)
+        self.assertEquals('compressed', target.open('r').read())
+        self.assertEquals('compressed', target.open('r').read())
+        self.assertEquals(1, self.cache.hits)
+
+    @mock_s3
+    def test_missing(self):
+        client = self._client()
+        target = s3cache.CachedS3Target('s3://bucket/missing', self.cache, client=client)
+        self.assertRaises(luigi.s3.FileNotFoundException, target.open, 'r')
+
+    @mock.patch('mortar.luigi.target_factory.luigi.configuration')
+    @mock_s3
+    def test_get_target_uses_cache_when_configured(self, configuration):
+        config = configuration.get_config.return_value
+        config.has_option.side_effect = lambda section, option: option == 's3_cache_dir'
+        config.get.return_value = self.tmp_dir
+        client = self._client()
+        with mock.patch.object(target_factory, 'get_s3_client', return_value=client):
+            target = target_factory.get_target('s3://bucket/data')
+        self.assertTrue(isinstance(target, s3cache.CachedS3Target))
+        self.assertEquals(self.tmp_dir, target.cache.directory)
+
+    @mock_s3
+    def test_redshift_schema_file(self):
+        client = self._client()
+        client.put_string('{"fields": []}', 's3://bucket/out/.pig_schema')
+        task = mock.Mock()
+        task.s3_schema_path.return_value = 's3://bucket/out/.pig_schema'
+        with mock.patch.object(target_factory, 'get_s3_client', return_value=client):
+            self.assertEquals('{"fields": []}',
+                              redshift.CopyPigOutputToRedshiftTask._read_schema_file.im_func(task))
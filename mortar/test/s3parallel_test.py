@@ -0,0 +1,360 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import mock
+from boto import exception as boto_exception
+from boto.s3 import key as boto_s3_key
+from luigi.s3 import S3Client
+from moto import mock_s3
+
+from mortar.luigi import checksum
+from mortar.luigi import s3parallel
+from mortar.luigi.s3transfer import S3ToLocalTask
+
+AWS_ACCESS_KEY = "XXXXXX"
+AWS_SECRET_KEY = "XXXXXX"
+
+class TestPartRanges(unittest.TestCase):
+
+    def test_part_ranges(self):
+        self.assertEquals([(0, 3), (4, 7), (8, 9)], s3parallel.part_ranges(10, 4))
+        self.assertEquals([(0, 9)], s3parallel.part_ranges(10, 10))
+        self.assertEquals([], s3parallel.part_ranges(0, 10))
+
+class TestUpload(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _file(self, data):
+        path = os.path.join(self.tmp_dir, 'source')
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def test_choose_part_size(self):
+        mb = 1024 ** 2
+        # small files fit in one part, so are uploaded in one request
+        self.assertEquals(s3parallel.MIN_AUTO_PART_SIZE, s3parallel.choose_part_size(mb))
+        # medium files are split to keep every thread busy
+        self.assertEquals(13 * mb, s3parallel.choose_part_size(100 * mb, max_threads=8))
+        self.assertEquals(s3parallel.DEFAULT_PART_SIZE, s3parallel.choose_part_size(10 * 1024 * mb))
+        # huge files stay within the part count limit
+        size = 1024 ** 4
+        part_size = s3parallel.choose_part_size(size)
+        self.assertTrue(part_size > s3parallel.DEFAULT_PART_SIZE)
+        self.assertEquals(0, part_size % mb)
+        self.assertTrue(len(s3parallel.part_ranges(size, part_size)) <= s3parallel.MAX_PARTS)
+
+    def test_concurrent_parts(self):
+        data = ''.join(chr(i % 256) for i in range(10000))
+        active = []
+        overlapped = threading.Event()
+        bodies = {}
+
+        class FakeMultipart(object):
+            def upload_part_from_file(self, fp, part_num, md5=None, size=None):
+                active.append(part_num)
+                if len(active) > 1:
+                    overlapped.set()
+                time.sleep(0.01)
+                bodies[part_num] = fp
+                contents = fp.read(size)
+                assert md5[0] == hashlib.md5(contents).hexdigest()
+                active.remove(part_num)
+
+            def complete_upload(self):
+                digests = [hashlib.md5(data[start:end + 1]).digest()
+                           for (start, end) in s3parallel.part_ranges(len(data), 1000)]
+                return mock.Mock(etag=checksum.multipart_etag(digests))
+
+        client = mock.Mock()
+        client._path_to_bucket_and_key.return_value = ('bucket', 'data')
+        bucket = client.s3.get_bucket.return_value
+        bucket.initiate_multipart_upload.return_value = FakeMultipart()
+        with mock.patch('mortar.luigi.s3parallel._fit_part_size', lambda size, part_size: part_size):
+            s3parallel.upload(client, self._file(data), 's3://bucket/data', part_size=1000, max_threads=4)
+        self.assertTrue(overlapped.is_set())
+        self.assertEquals(range(1, 11), sorted(bodies.keys()))
+        # parts are sent from the mapped file, not copied into strings
+        self.assertFalse(any(isinstance(body, str) for body in bodies.values()))
+        bucket.initiate_multipart_upload.assert_called_once_with(
+            'data', metadata={checksum.PART_SIZE_METADATA: '1000'})
+
+    def test_failed_part_cancels(self):
+        client = mock.Mock()
+        client._path_to_bucket_and_key.return_value = ('bucket', 'data')
+        multipart = client.s3.get_bucket.return_value.initiate_multipart_upload.return_value
+        multipart.upload_part_from_file.side_effect = IOError('boom')
+        path = self._file('x' * (s3parallel.MIN_PART_SIZE + 1))
+        self.assertRaises(IOError, s3parallel.upload, client, path, 's3://bucket/data',
+                          part_size=s3parallel.MIN_PART_SIZE)
+        multipart.cancel_upload.assert_called_once_with()
+        self.assertFalse(multipart.complete_upload.called)
+
+    def test_small_part_size_raised(self):
+        client = mock.Mock()
+        client._path_to_bucket_and_key.return_value = ('bucket', 'data')
+        bucket = client.s3.get_bucket.return_value
+        bucket.initiate_multipart_upload.return_value.upload_part_from_file.side_effect = IOError('boom')
+        path = self._file('x' * (s3parallel.MIN_PART_SIZE + 1))
+        self.assertRaises(IOError, s3parallel.upload, client, path, 's3://bucket/data', part_size=1000)
+        bucket.initiate_multipart_upload.assert_called_once_with(
+            'data', metadata={checksum.PART_SIZE_METADATA: str(s3parallel.MIN_PART_SIZE)})
+
+    def test_kms_etag_not_verified(self):
+        client = mock.Mock()
+        client._path_to_bucket_and_key.return_value = ('bucket', 'data')
+        bucket = client.s3.get_bucket.return_value
+        bucket.initiate_multipart_upload.return_value.complete_upload.return_value = mock.Mock(etag='"kms"')
+        path = self._file('x' * (s3parallel.MIN_PART_SIZE + 1))
+        self.assertEquals('"kms"', s3parallel.upload(client, path, 's3://bucket/data',
+                                                     part_size=s3parallel.MIN_PART_SIZE))
+
+        # boto checks a single part PUT's ETag against its MD5 itself
+        bucket.new_key.return_value.set_contents_from_file.side_effect = \
+            boto_exception.S3DataError('ETag from S3 did not match computed MD5')
+        bucket.get_key.return_value = mock.Mock(etag='"kms"')
+        self.assertEquals('"kms"', s3parallel.upload(client, self._file('small'), 's3://bucket/data'))
+        bucket.get_key.return_value = mock.Mock(etag='"%s"' % hashlib.md5('other').hexdigest())
+        self.assertRaises(boto_exception.S3DataError, s3parallel.upload,
+                          client, self._file('small'), 's3://bucket/data')
+
+    @mock_s3
+    def test_empty_file(self):
+        client = S3Client(AWS_ACCESS_KEY, AWS_SECRET_KEY)
+        client.s3.create_bucket('bucket')
+        etag = s3parallel.upload(client, self._file(''), 's3://bucket/empty')
+        self.assertEquals('"%s"' % hashlib.md5('').hexdigest(), etag)
+        self.assertEquals('', client.get_key('s3://bucket/empty').get_contents_as_string())
+
+class TestRunTransfers(unittest.TestCase):
+
+    def test_run_transfers(self):
+        done = []
+        transfers = [('f%d' % i, 10, lambda i=i: done.append(i)) for i in range(5)]
+        self.assertEquals(50, s3parallel.run_transfers(transfers, max_workers=3))
+        self.assertEquals(range(5), sorted(done))
+        self.assertEquals(0, s3parallel.run_transfers([]))
+
+    def test_failures_after_all_attempted(self):
+        done = []
+        def fail():
+            raise IOError('boom')
+        transfers = [('a', 1, fail), ('b', 1, lambda: done.append('b')), ('c', 1, fail)]
+        with mock.patch('mortar.luigi.s3parallel.timing.emit') as emit:
+            self.assertRaises(IOError, s3parallel.run_transfers, transfers, max_workers=2)
+        self.assertEquals(['b'], done)
+        self.assertEquals(2, emit.call_args[1]['failures'])
+
+class TestListedKeyMatches(unittest.TestCase):
+
+    def setUp(self):
+        (fd, self.path) = tempfile.mkstemp()
+        self.data = 'x' * 2500
+        os.write(fd, self.data)
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def _key(self, etag, metadata=None):
+        key = mock.Mock(etag=etag, size=len(self.data), metadata=metadata or {})
+        key.name = 'key'
+        return key
+
+    def test_heads_for_part_size(self):
+        # uploaded in parts of 900 bytes, listed without the part size
+        etag = checksum.file_etag(self.path, 900)
+        listed = self._key(etag)
+        listed.bucket.get_key.return_value = self._key(etag, {checksum.PART_SIZE_METADATA: '900'})
+        self.assertTrue(s3parallel.listed_key_matches(self.path, listed, 1000))
+        listed.bucket.get_key.assert_called_once_with('key')
+        self.assertFalse(s3parallel.needs_download(listed, self.path, 1000))
+
+        # same layout, other content
+        other = '"%s-3"' % hashlib.md5('other').hexdigest()
+        listed = self._key(other)
+        listed.bucket.get_key.return_value = self._key(other, {checksum.PART_SIZE_METADATA: '900'})
+        self.assertFalse(s3parallel.listed_key_matches(self.path, listed, 1000))
+
+    def test_no_head_when_etag_matches(self):
+        listed = self._key(checksum.file_etag(self.path, 1000))
+        self.assertTrue(s3parallel.listed_key_matches(self.path, listed, 1000))
+        listed = self._key('"%s"' % hashlib.md5(self.data).hexdigest())
+        self.assertTrue(s3parallel.listed_key_matches(self.path, listed, 1000))
+        self.assertFalse(listed.bucket.get_key.called)
+
+    def test_size_only_when_etag_unknown(self):
+        # encrypted with SSE-KMS
+        listed = self._key('"kms-etag"')
+        self.assertTrue(s3parallel.listed_key_matches(self.path, listed, 1000))
+        self.assertFalse(listed.bucket.get_key.called)
+        # parts of an unrecorded size
+        listed = self._key('"%s-2"' % hashlib.md5('x').hexdigest())
+        listed.bucket.get_key.return_value = self._key(listed.etag)
+        self.assertTrue(s3parallel.listed_key_matches(self.path, listed, 1000))
+        listed.size = 10
+        self.assertFalse(s3parallel.listed_key_matches(self.path, listed, 1000))
+
+class TestDownload(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.data = ''.join(chr(i % 256) for i in range(10000))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _key(self, data):
+        client = S3Client(AWS_ACCESS_KEY, AWS_SECRET_KEY)
+        bucket = client.s3.create_bucket('bucket')
+        client.put_string(data, 's3://bucket/data')
+        return bucket.get_key('data')
+
+    # moto's HTTP mocking is not thread-safe, so tests against it fetch
+    # one range at a time; test_concurrent_parts covers concurrency
+    @mock_s3
+    def test_download_in_parts(self):
+        local_path = os.path.join(self.tmp_dir, 'sub', 'data')
+        s3parallel.download(self._key(self.data), local_path, part_size=999, max_threads=1,
+                            verify=False)
+        self.assertEquals(self.data, open(local_path, 'rb').read())
+        self.assertEquals(['data'], os.listdir(os.path.dirname(local_path)))
+
+    def test_concurrent_parts(self):
+        data = self.data
+        active = []
+        overlapped = threading.Event()
+
+        class FakeKey(object):
+            def __init__(self, bucket, name):
+                self.local_hashes = {}
+
+            def get_contents_to_file(self, f, headers):
+                (start, end) = [int(b) for b in headers['Range'][len('bytes='):].split('-')]
+                active.append(start)
+                if len(active) > 1:
+                    overlapped.set()
+                time.sleep(0.01)
+                f.write(data[start:end + 1])
+                self.local_hashes['md5'] = hashlib.md5(data[start:end + 1]).digest()
+                active.remove(start)
+
+        digests = [hashlib.md5(data[start:end + 1]).digest() for (start, end) in s3parallel.part_ranges(len(data), 999)]
+        key = mock.Mock(size=len(data), etag=checksum.multipart_etag(digests),
+                        metadata={checksum.PART_SIZE_METADATA: '999'})
+        key.name = 'data'
+        local_path = os.path.join(self.tmp_dir, 'data')
+        with mock.patch('boto.s3.key.Key', FakeKey):
+            s3parallel.download(key, local_path, part_size=5000, max_threads=4)
+        self.assertEquals(data, open(local_path, 'rb').read())
+        self.assertTrue(overlapped.is_set())
+
+    def _fake_key_class(self, served, fetched):
+        class FakeKey(object):
+            def __init__(self, bucket, name):
+                self.local_hashes = {}
+
+            def get_contents_to_file(self, f, headers):
+                (start, end) = [int(b) for b in headers['Range'][len('bytes='):].split('-')]
+                fetched.append((start, end))
+                f.write(served[start:end + 1])
+                self.local_hashes['md5'] = hashlib.md5(served[start:end + 1]).digest()
+        return FakeKey
+
+    def test_verified_download_keeps_part_size(self):
+        fetched = []
+        key = mock.Mock(size=len(self.data), etag='"%s"' % hashlib.md5(self.data).hexdigest(), metadata={})
+        key.name = 'data'
+        local_path = os.path.join(self.tmp_dir, 'data')
+        with mock.patch('boto.s3.key.Key', self._fake_key_class(self.data, fetched)):
+            s3parallel.download(key, local_path, part_size=1000, max_threads=4)
+        self.assertEquals(s3parallel.part_ranges(len(self.data), 1000), sorted(fetched))
+        self.assertEquals(self.data, open(local_path, 'rb').read())
+
+    def test_corrupt_split_part_fails(self):
+        fetched = []
+        digests = [hashlib.md5(self.data[start:end + 1]).digest()
+                   for (start, end) in s3parallel.part_ranges(len(self.data), 4000)]
+        key = mock.Mock(size=len(self.data), etag=checksum.multipart_etag(digests),
+                        metadata={checksum.PART_SIZE_METADATA: '4000'})
+        key.name = 'data'
+        corrupt = self.data[:4500] + 'X' + self.data[4501:]
+        local_path = os.path.join(self.tmp_dir, 'data')
+        with mock.patch('boto.s3.key.Key', self._fake_key_class(corrupt, fetched)):
+            self.assertRaises(IOError, s3parallel.download, key, local_path, part_size=1000, max_threads=4)
+        # ranges never span uploaded parts
+        self.assertTrue((4000, 4999) in fetched and (8000, 8999) in fetched and (9000, 9999) in fetched)
+        self.assertEquals([], os.listdir(self.tmp_dir))
+
+    @mock_s3
+    def test_checksum_mismatch_leaves_nothing(self):
+        local_path = os.path.join(self.tmp_dir, 'data')
+        key = self._key(self.data)
+        key.etag = '"%s"' % hashlib.md5('something else').hexdigest()
+        # moto ignores If-Match, so the download gets the stored data
+        self.assertRaises(IOError, s3parallel.download, key, local_path)
+        self.assertEquals([], os.listdir(self.tmp_dir))
+
+    @mock_s3
+    def test_multipart_round_trip(self):
+        client = S3Client(AWS_ACCESS_KEY, AWS_SECRET_KEY)
+        client.s3.create_bucket('bucket')
+        part_size = 5 * 1024 ** 2
+        data = self.data * (2 * part_size / len(self.data) + 1)
+        source = os.path.join(self.tmp_dir, 'source')
+        with open(source, 'wb') as f:
+            f.write(data)
+        etag = s3parallel.upload(client, source, 's3://bucket/big', part_size=part_size, max_threads=1)
+        self.assertEquals(etag, checksum.file_etag(source, part_size))
+        self.assertTrue(etag.endswith('-3"'))
+
+        key = client.get_key('s3://bucket/big')
+        self.assertEquals(str(part_size), key.get_metadata(checksum.PART_SIZE_METADATA))
+        local_path = os.path.join(self.tmp_dir, 'copy')
+        with mock.patch('boto.s3.key.Key.get_contents_to_file', autospec=True,
+                        side_effect=boto_s3_key.Key.get_contents_to_file) as get:
+            s3parallel.download(key, local_path, part_size=1024 ** 2, max_threads=1)
+        # 1MB ranges within each 5MB uploaded part
+        self.assertEquals(11, get.call_count)
+        self.assertEquals(data, open(local_path, 'rb').read())
+
+    @mock_s3
+    def test_empty_object(self):
+        local_path = os.path.join(self.tmp_dir, 'data')
+        s3parallel.download(self._key(''), local_path)
+        self.assertEquals('', open(local_path, 'rb').read())
+
+    @mock_s3
+    def test_failed_part_leaves_nothing(self):
+        local_path = os.path.join(self.tmp_dir, 'data')
+        key = self._key(self.data)
+        with mock.patch('boto.s3.key.Key.get_contents_to_file', side_effect=IOError('boom')):
+            self.assertRaises(IOError, s3parallel.download, key, local_path, part_size=1000)
+        self.assertEquals([], os.listdir(self.tmp_dir))
+
+    @mock_s3
+    def test_short_read(self):
+        local_path = os.path.join(self.tmp_dir, 'data')
+        key = self._key(self.data)
+        with mock.patch('boto.s3.key.Key.get_contents_to_file'):
+            self.assertRaises(IOError, s3parallel.download, key, local_path, part_size=1000)
+        self.assertEquals([], os.listdir(self.tmp_dir))
+
+    @mock_s3
+    def test_s3_to_local_task(self):
+        key = self._key(self.data)
+        local_path = os.path.join(self.tmp_dir, 'data')
+        t = S3ToLocalTask(s3_path='s3://bucket/data', local_path=local_path, part_size=1000, max_threads=1)
+        t.client = S3Client(AWS_ACCESS_KEY, AWS_SECRET_KEY)
+        t.run()
+        self.assertEquals(self.data, open(local_path, 'rb').read())
@@ -1,7 +1,10 @@
-import unittest, luigi, tempfile, os
+import unittest, luigi, tempfile, os, shutil, time
 from luigi import LocalTarget, configuration
 from mock import patch
-from mortar.luigi.s3transfer import LocalToS3Task, S3ToLocalTask, S3TransferTask
+from mortar.luigi import checksum
+from mortar.luigi import s3parallel
+from mortar.luigi.s3transfer import LocalToS3Task, S3ToLocalTask, S3TransferTask, \
+    S3PrefixToLocalTask, LocalDirToS3Task
 from luigi.s3 import S3Target, S3PathTask, S3Client
 import boto
 from boto.s3.key import Key
@@ -15,7 +18,6 @@ AWS_SECRET_KEY = "XXXXXX"
 
 
 class TestS3ToLocalTask(unittest.TestCase):
-    @mock_s3
     @patch("luigi.configuration")
     def setUp(self, mock_config):
 
@@ -29,13 +31,17 @@ class TestS3ToLocalTask(unittest.TestCase):
         self.file_name = f.name[f.name.rindex('/')+1:]
         self.s3_path = s3_root_path + '/' + self.file_name
 
+        self.mock = mock_s3()
+        self.mock.start()
         self.s3_client = S3Client(AWS_ACCESS_KEY, AWS_SECRET_KEY)
         bucket = self.s3_client.s3.create_bucket('bucket')
         k = Key(bucket)
         k.key = 'key/%s' % self.file_name
+        k.set_contents_from_string(self.temp_file_contents)
         mock_config.get_config.return_value.get.return_value = AWS_ACCESS_KEY 
 
     def tearDown(self):
+        self.mock.stop()
         os.remove(self.local_path)
     
     def test_path_s3(self):
@@ -59,6 +65,34 @@ class TestS3ToLocalTask(unittest.TestCase):
         target = t.output_target()
         self.assertEquals(target.open('r').read(), self.temp_file_contents)
 
+    def test_recopy_truncated(self):
+        """
+        Test that a truncated local copy is not complete, and is copied again
+        """
+        with open(self.local_path, 'w') as f:
+            f.write(self.temp_file_contents[:10])
+        t = S3ToLocalTask(s3_path=self.s3_path, local_path=self.local_path)
+        t.client = self.s3_client
+        self.assertFalse(t.complete())
+        luigi.build([t], local_scheduler=True)
+        self.assertTrue(t.complete())
+        self.assertEquals(t.output_target().open('r').read(), self.temp_file_contents)
+
+    def test_complete_hashes_only_when_needed(self):
+        """
+        Test that complete() skips hashing on a size mismatch, and after a download
+        """
+        with open(self.local_path, 'w') as f:
+            f.write(self.temp_file_contents[:10])
+        t = S3ToLocalTask(s3_path=self.s3_path, local_path=self.local_path)
+        t.client = self.s3_client
+        with patch('mortar.luigi.checksum.PartHasher', wraps=checksum.PartHasher) as hasher:
+            self.assertFalse(t.complete())
+            t.run()
+            self.assertTrue(t.complete())
+            self.assertTrue(t.complete())
+            self.assertEquals(0, hasher.call_count)
+
 
 """
 Test LocalToS3Task
@@ -108,3 +142,145 @@ class TestLocalToS3Task(unittest.TestCase):
         luigi.build([t], local_scheduler=True)
         self.assertTrue(t.output_target().exists())
         self.assertEquals(t.output_target().open('r').read(), self.temp_file_contents)
+
+    def test_recopy_changed(self):
+        """
+        Test that a changed local file of the same size is uploaded again.
+        """
+        new_s3_path = s3_root_path + '/new.txt'
+        t = LocalToS3Task(local_path=self.temp_file_path, s3_path=new_s3_path)
+        t.client = self.s3_client
+        luigi.build([t], local_scheduler=True)
+        self.assertTrue(t.complete())
+        changed_contents = self.temp_file_contents.upper()
+        with open(self.temp_file_path, 'w') as f:
+            f.write(changed_contents)
+        self.assertFalse(t.complete())
+        luigi.build([t], local_scheduler=True)
+        self.assertTrue(t.complete())
+        self.assertEquals(t.output_target().open('r').read(), changed_contents)
+
+    def test_complete_after_upload_does_not_hash(self):
+        """
+        Test that the hash computed while uploading is reused by complete().
+        """
+        t = LocalToS3Task(local_path=self.temp_file_path, s3_path=s3_root_path + '/new.txt')
+        t.client = self.s3_client
+        t.run()
+        with patch('mortar.luigi.checksum.PartHasher', wraps=checksum.PartHasher) as hasher:
+            self.assertTrue(t.complete())
+            self.assertEquals(0, hasher.call_count)
+
+
+class TestPrefixSync(unittest.TestCase):
+    def setUp(self):
+        self.mock = mock_s3()
+        self.mock.start()
+        self.s3_client = S3Client(AWS_ACCESS_KEY, AWS_SECRET_KEY)
+        self.bucket = self.s3_client.s3.create_bucket('bucket')
+        self.local_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.mock.stop()
+        shutil.rmtree(self.local_dir)
+
+    def _put(self, name, contents):
+        k = Key(self.bucket)
+        k.key = 'key/%s' % name
+        k.set_contents_from_string(contents)
+
+    def _write(self, name, contents, mtime=1000000000):
+        path = os.path.join(self.local_dir, name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write(contents)
+        os.utime(path, (mtime, mtime))
+
+    def _read(self, name):
+        with open(os.path.join(self.local_dir, name)) as f:
+            return f.read()
+
+    def _download_task(self):
+        # moto's HTTP mocking is not thread-safe, so transfer one file at a time
+        t = S3PrefixToLocalTask(s3_path=s3_root_path, local_path=self.local_dir, part_size=4, max_workers=1)
+        t.client = self.s3_client
+        return t
+
+    def _upload_task(self):
+        t = LocalDirToS3Task(local_path=self.local_dir, s3_path=s3_root_path, max_workers=1)
+        t.client = self.s3_client
+        return t
+
+    def test_download_prefix(self):
+        """
+        Tests that every file under the prefix is downloaded, then the flag written.
+        """
+        self._put('part-00000', 'first part')
+        self._put('nested/part-00001', 'second part')
+        t = self._download_task()
+        self.assertFalse(t.output_target().exists())
+        t.run()
+        self.assertEquals('first part', self._read('part-00000'))
+        self.assertEquals('second part', self._read('nested/part-00001'))
+        self.assertTrue(t.output_target().exists())
+
+    def test_download_only_changed(self):
+        """
+        Tests that only missing, resized and newer objects are downloaded again.
+        """
+        self._put('same', 'unchanged')
+        self._put('resized', 'longer than before')
+        self._put('newer', 'new')
+        self._put('missing', 'missing')
+        self._write('same', 'unchanged', mtime=time.time() + 3600)
+        self._write('resized', 'short', mtime=time.time() + 3600)
+        self._write('newer', 'old')
+        with patch('mortar.luigi.s3parallel.download', wraps=s3parallel.download) as download:
+            self._download_task().run()
+        self.assertEquals(['key/missing', 'key/newer', 'key/resized'],
+                          sorted(call[0][0].name for call in download.call_args_list))
+        self.assertEquals('longer than before', self._read('resized'))
+        self.assertEquals('new', self._read('newer'))
+
+    def test_download_failure(self):
+        """
+        Tests that a failed download fails the task without writing the flag.
+        """
+        self._put('part-00000', 'first part')
+        self._put('part-00001', 'second part')
+        t = self._download_task()
+        with patch('mortar.luigi.s3parallel.download', side_effect=[None, IOError('boom')]):
+            self.assertRaises(IOError, t.run)
+        self.assertFalse(t.output_target().exists())
+
+    def test_upload_dir(self):
+        """
+        Tests that every file under the directory is uploaded, then the flag written.
+        """
+        self._write('part-00000', 'first part')
+        self._write('nested/part-00001', 'second part')
+        t = self._upload_task()
+        self.assertFalse(t.output_target().exists())
+        t.run()
+        self.assertEquals('first part', S3Target(s3_root_path + '/part-00000', client=self.s3_client).open('r').read())
+        self.assertEquals('second part', S3Target(s3_root_path + '/nested/part-00001', client=self.s3_client).open('r').read())
+        self.assertTrue(t.output_target().exists())
+
+    def test_upload_only_changed(self):
+        """
+        Tests that only missing, resized and newer files are uploaded again.
+        """
+        self._put('same', 'unchanged')
+        self._put('resized', 'short')
+        self._put('newer', 'old')
+        self._write('same', 'unchanged')
+        self._write('resized', 'longer than before')
+        self._write('newer', 'new', mtime=time.time() + 3600)
+        self._write('missing', 'missing')
+        t = self._upload_task()
+        with patch('mortar.luigi.s3parallel.upload', wraps=s3parallel.upload) as upload:
+            t.run()
+        self.assertEquals([s3_root_path + '/missing', s3_root_path + '/newer', s3_root_path + '/resized'],
+                          sorted(call[0][2] for call in upload.call_args_list))
+        self.assertEquals('new', S3Target(s3_root_path + '/newer', client=self.s3_client).open('r').read())
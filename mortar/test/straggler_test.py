@@ -0,0 +1,47 @@
+import shutil
+import tempfile
+import unittest
+
+from mortar.luigi import target_factory
+from mortar.luigi.straggler import ProgressModel
+
+
+class TestProgressModel(unittest.TestCase):
+
+    def setUp(self):
+        # three runs of 100, 200 and 300 seconds
+        self.model = ProgressModel(runs=[[(50, 50), (100, 100)],
+                                         [(100, 50), (200, 100)],
+                                         [(150, 50), (300, 100)]])
+
+    def test_expected_elapsed(self):
+        self.assertEquals(100, self.model.expected_elapsed(50))
+        self.assertEquals(50, self.model.expected_elapsed(25))
+        self.assertEquals(200, self.model.expected_elapsed(100))
+
+    def test_needs_min_runs(self):
+        self.assertEquals(None, ProgressModel(runs=self.model.runs[:2]).expected_elapsed(50))
+        self.assertFalse(ProgressModel().is_straggling(10000, 0))
+
+    def test_is_straggling(self):
+        # past runs reached 11% after 22 seconds
+        self.assertFalse(self.model.is_straggling(60, 10))
+        self.assertTrue(self.model.is_straggling(70, 10))
+        self.assertFalse(self.model.is_straggling(70, 10, min_elapsed=600))
+        self.assertFalse(self.model.is_straggling(500, 99))
+
+    def test_add_run_keeps_most_recent(self):
+        model = ProgressModel(max_runs=2)
+        for duration in [1, 2, 3]:
+            model.add_run([(duration, 100)])
+        self.assertEquals([[(2, 100)], [(3, 100)]], model.runs)
+
+    def test_save_and_load(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            target = target_factory.get_target('%s/progress/my_script' % tmp_dir)
+            self.assertEquals([], ProgressModel.load(target).runs)
+            self.model.save(target)
+            self.assertEquals(self.model.runs, ProgressModel.load(target).runs)
+        finally:
+            shutil.rmtree(tmp_dir)
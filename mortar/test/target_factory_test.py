@@ -1,9 +1,19 @@
+import bz2
+import distutils.spawn
+import gzip
 import mock
 import os
+import shutil
+import StringIO
 import tempfile
 import unittest
+from luigi.s3 import S3Client
+from moto import mock_s3
 from mortar.luigi import target_factory
 
+AWS_ACCESS_KEY = "XXXXXX"
+AWS_SECRET_KEY = "XXXXXX"
+
 class TestTargetFactory(unittest.TestCase):
 
     def setUp(self):
@@ -11,18 +21,23 @@ class TestTargetFactory(unittest.TestCase):
         self.tmp = tempfile.NamedTemporaryFile(delete=False)
         self.tmp.write(self.data)
         self.tmp.close()
+        target_factory.clear_cache()
 
     def tearDown(self):
         if self.tmp:
             os.remove(self.tmp.name)
             self.tmp = None
+        target_factory.clear_cache()
 
-    @mock.patch('mortar.luigi.target_factory.S3Target')
-    def test_get_target_s3(self, mock_s3_target_cls):
+    @mock.patch('luigi.s3.S3Client')
+    @mock.patch('luigi.s3.S3Target')
+    def test_get_target_s3(self, mock_s3_target_cls, mock_s3_client_cls):
         mock_s3_target = mock.Mock()
         mock_s3_target_cls.return_value = mock_s3_target
         s3_target = target_factory.get_target('s3://mybucket/mypath')
         self.assertEquals(mock_s3_target, s3_target)
+        mock_s3_target_cls.assert_called_once_with('s3://mybucket/mypath', format=None,
+                                                   client=mock_s3_client_cls.return_value)
 
     def test_get_target_local(self):
         local_target = target_factory.get_target(self.tmp.name)
@@ -32,4 +47,95 @@ class TestTargetFactory(unittest.TestCase):
     def test_get_target_file(self):
         file_target = target_factory.get_target('file://%s' % self.tmp.name)
         reread_data = file_target.open().read()
-        self.assertEquals(self.data, reread_data)        
\ No newline at end of file
+        self.assertEquals(self.data, reread_data)        
+
+    @mock.patch('luigi.s3.S3Client')
+    def test_targets_and_clients_are_interned(self, mock_s3_client_cls):
+        first = target_factory.get_target('s3://mybucket/a')
+        self.assertIs(first, target_factory.get_target('s3://mybucket/a'))
+        second = target_factory.get_target('s3://mybucket/b')
+        self.assertIs(first.fs, second.fs)
+        self.assertEquals(1, mock_s3_client_cls.call_count)
+        self.assertIs(target_factory.get_target(self.tmp.name),
+                      target_factory.get_target('file://%s' % self.tmp.name))
+
+    def test_interning_is_bounded(self):
+        with mock.patch.object(target_factory, 'MAX_INTERNED_TARGETS', 2):
+            first = target_factory.get_target('/tmp/a')
+            target_factory.get_target('/tmp/b')
+            target_factory.get_target('/tmp/c')
+            self.assertIsNot(first, target_factory.get_target('/tmp/a'))
+
+    def test_register_scheme(self):
+        made = []
+        def memory_target(path, format=None):
+            made.append(path)
+            return mock.Mock(path=path)
+        target_factory.register_scheme('memory://', memory_target)
+        target_factory.register_scheme('memory://special/', lambda path, format=None: 'special')
+        try:
+            self.assertEquals('memory://a', target_factory.get_target('memory://a').path)
+            self.assertEquals('special', target_factory.get_target('memory://special/a'))
+            self.assertEquals(['memory://a'], made)
+        finally:
+            target_factory.unregister_scheme('memory://')
+            target_factory.unregister_scheme('memory://special/')
+
+    def test_unknown_scheme(self):
+        self.assertRaises(RuntimeError, target_factory.get_target, 'nope://a')
+
+class TestCompressedTargets(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        target_factory.clear_cache()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+        target_factory.clear_cache()
+
+    def _roundtrip(self, path, compression=None):
+        target = target_factory.get_target(path, compression=compression)
+        with target.open('w') as f:
+            f.write('line 1\nline 2\n' * 100)
+        self.assertEquals('line 1\nline 2\n' * 100, target.open('r').read())
+
+    def test_gzip_suffix(self):
+        path = os.path.join(self.tmp_dir, 'data.gz')
+        self._roundtrip(path)
+        self.assertEquals('line 1\nline 2\n' * 100, gzip.open(path).read())
+        self.assertTrue(os.path.getsize(path) < 100)
+
+    def test_explicit_compression(self):
+        path = os.path.join(self.tmp_dir, 'data.txt')
+        self._roundtrip(path, compression='bzip2')
+        self.assertEquals('line 1\nline 2\n' * 100, bz2.BZ2File(path).read())
+
+    def test_no_compression(self):
+        path = os.path.join(self.tmp_dir, 'data.gz')
+        self._roundtrip(path, compression='none')
+        self.assertEquals('line 1\nline 2\n' * 100, open(path).read())
+        self.assertIsNot(target_factory.get_target(path),
+                         target_factory.get_target(path, compression='none'))
+
+    @unittest.skipUnless(distutils.spawn.find_executable('zstd'), 'zstd is not installed')
+    def test_zstd_suffix(self):
+        path = os.path.join(self.tmp_dir, 'data.zst')
+        self._roundtrip(path)
+        self.assertNotEquals('line 1\nline 2\n' * 100, open(path).read())
+
+    def test_unknown_compression(self):
+        self.assertRaises(RuntimeError, target_factory.get_target, '/tmp/data', compression='lzma')
+
+    def test_token_stores_are_not_compressed(self):
+        self.assertRaises(RuntimeError, target_factory.get_target,
+                          'sqlite://%s/tokens.db/MyTask' % self.tmp_dir, compression='gzip')
+
+    @mock_s3
+    def test_s3_gzip(self):
+        client = S3Client(AWS_ACCESS_KEY, AWS_SECRET_KEY)
+        client.s3.create_bucket('bucket')
+        with mock.patch.object(target_factory, 'get_s3_client', return_value=client):
+            self._roundtrip('s3://bucket/data.gz')
+        data = client.s3.get_bucket('bucket').get_key('data.gz').get_contents_as_string()
+        self.assertEquals('line 1\nline 2\n' * 100, gzip.GzipFile(fileobj=StringIO.StringIO(data)).read())
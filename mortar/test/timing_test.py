@@ -0,0 +1,90 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+from mortar.api.v2 import jobs
+from mortar.luigi import jobpoller
+from mortar.luigi import timing
+
+
+class RecordingTimingSink(timing.TimingSink):
+
+    def __init__(self):
+        self.events = []
+
+    def emit(self, event):
+        self.events.append(event)
+
+    def of_type(self, event_type):
+        return [e for e in self.events if e['event'] == event_type]
+
+class TestTiming(unittest.TestCase):
+
+    def setUp(self):
+        self.sink = RecordingTimingSink()
+        timing.set_sink(self.sink)
+
+    def tearDown(self):
+        timing.set_sink(None)
+
+    def test_emit(self):
+        timing.emit('token_read', token='s3://bucket/token')
+        self.assertEquals(1, len(self.sink.events))
+        event = self.sink.events[0]
+        self.assertEquals('token_read', event['event'])
+        self.assertEquals('s3://bucket/token', event['token'])
+        self.assertTrue(event['timestamp'] > 0)
+
+    def test_emit_swallows_sink_errors(self):
+        sink = mock.Mock()
+        sink.emit.side_effect = IOError('disk full')
+        timing.set_sink(sink)
+        timing.emit('token_read')
+
+    def test_timed(self):
+        with timing.timed('job_submit', task='t') as event:
+            event['job_id'] = 'job1'
+        event = self.sink.events[0]
+        self.assertEquals('job_submit', event['event'])
+        self.assertEquals('job1', event['job_id'])
+        self.assertTrue(event['duration_seconds'] >= 0)
+
+    def test_timed_emits_on_error(self):
+        try:
+            with timing.timed('job_submit'):
+                raise ValueError('boom')
+        except ValueError:
+            pass
+        self.assertEquals(1, len(self.sink.of_type('job_submit')))
+
+    def test_json_lines_sink(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp_dir, 'timing.jsonl')
+            sink = timing.JsonLinesTimingSink(path)
+            sink.emit({'event': 'a', 'timestamp': 1})
+            sink.emit({'event': 'b', 'timestamp': 2})
+            with open(path) as f:
+                events = [json.loads(line) for line in f]
+            self.assertEquals(['a', 'b'], [e['event'] for e in events])
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    @mock.patch('mortar.luigi.jobpoller.jobs.get_job')
+    def test_poller_emits_job_events(self, get_job):
+        get_job.side_effect = [{'status_code': jobs.STATUS_STARTING_CLUSTER},
+                               {'status_code': jobs.STATUS_RUNNING, 'progress': 50},
+                               {'status_code': jobs.STATUS_SUCCESS, 'progress': 100}]
+        jobpoller.JobPoller().wait(mock.Mock(), 'job1', polling_interval=0)
+        statuses = self.sink.of_type('job_status')
+        self.assertEquals([jobs.STATUS_STARTING_CLUSTER, jobs.STATUS_RUNNING],
+                          [e['status_code'] for e in statuses])
+        self.assertTrue(all(e['duration_seconds'] >= 0 for e in statuses))
+        self.assertEquals([50], [e['progress'] for e in self.sink.of_type('job_progress')])
+        complete = self.sink.of_type('job_complete')
+        self.assertEquals(1, len(complete))
+        self.assertEquals(jobs.STATUS_SUCCESS, complete[0]['status_code'])
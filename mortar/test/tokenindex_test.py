@@ -0,0 +1,117 @@
+import unittest
+
+import mock
+from luigi.s3 import S3Client
+from moto import mock_s3
+
+from mortar.luigi import target_factory
+from mortar.luigi import tokenindex
+
+AWS_ACCESS_KEY = "XXXXXX"
+AWS_SECRET_KEY = "XXXXXX"
+
+def _key(name):
+    key = mock.Mock()
+    key.name = name
+    return key
+
+class TestTokenIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.index = tokenindex.TokenIndex()
+        self.client = S3Client(AWS_ACCESS_KEY, AWS_SECRET_KEY)
+        self.client.s3 = mock.Mock()
+        self.bucket = self.client.s3.get_bucket.return_value
+        self.bucket.list.return_value = [_key('tokens/TaskA'), _key('tokens/TaskB-Running'),
+                                         _key('tokens/fingerprints/')]
+        target_factory.clear_cache()
+
+    def tearDown(self):
+        target_factory.clear_cache()
+
+    def test_lists_each_directory_once(self):
+        exists = self.index.exists_many(['s3://bucket/tokens/TaskA', 's3://bucket/tokens/TaskB',
+                                         's3://bucket/tokens/TaskB-Running', 's3://bucket/tokens/fingerprints'],
+                                        self.client)
+        self.assertEquals({'s3://bucket/tokens/TaskA': True,
+                           's3://bucket/tokens/TaskB': False,
+                           's3://bucket/tokens/TaskB-Running': True,
+                           's3://bucket/tokens/fingerprints': True}, exists)
+        self.client.s3.get_bucket.assert_called_once_with('bucket', validate=False)
+        self.bucket.list.assert_called_once_with(prefix='tokens/', delimiter='/')
+        self.assertEquals(1, self.index.listings)
+
+    def test_add_and_discard(self):
+        self.assertFalse(self.index.exists('s3://bucket/tokens/TaskB', self.client))
+        self.index.add('s3://bucket/tokens/TaskB')
+        self.assertTrue(self.index.exists('s3://bucket/tokens/TaskB', self.client))
+        self.index.discard('s3://bucket/tokens/TaskB')
+        self.assertFalse(self.index.exists('s3://bucket/tokens/TaskB', self.client))
+        self.assertEquals(1, self.bucket.list.call_count)
+
+    def test_invalidate(self):
+        self.index.exists('s3://bucket/tokens/TaskA', self.client)
+        self.index.invalidate('s3://bucket/tokens/TaskA')
+        self.index.exists('s3://bucket/tokens/TaskA', self.client)
+        self.assertEquals(2, self.bucket.list.call_count)
+
+    def test_listing_expires(self):
+        self.index.ttl = 60
+        with mock.patch.object(tokenindex.time, 'time', return_value=1000):
+            self.assertFalse(self.index.exists('s3://bucket/tokens/TaskC', self.client))
+        with mock.patch.object(tokenindex.time, 'time', return_value=1059):
+            self.assertFalse(self.index.exists('s3://bucket/tokens/TaskC', self.client))
+        self.assertEquals(1, self.bucket.list.call_count)
+        self.bucket.list.return_value.append(_key('tokens/TaskC'))
+        with mock.patch.object(tokenindex.time, 'time', return_value=1061):
+            self.assertTrue(self.index.exists('s3://bucket/tokens/TaskC', self.client))
+        self.assertEquals(2, self.bucket.list.call_count)
+
+    def test_changes_while_listing_are_kept(self):
+        def list_keys(prefix, delimiter):
+            # written by another thread while the listing is under way
+            self.index.add('s3://bucket/tokens/TaskC')
+            self.index.discard('s3://bucket/tokens/TaskA')
+            return [self.bucket.list.return_value[1]]
+        self.bucket.list.side_effect = list_keys
+        self.assertEquals({'s3://bucket/tokens/TaskA': False,
+                           's3://bucket/tokens/TaskB-Running': True,
+                           's3://bucket/tokens/TaskC': True},
+                          self.index.exists_many(['s3://bucket/tokens/TaskA', 's3://bucket/tokens/TaskB-Running',
+                                                  's3://bucket/tokens/TaskC'], self.client))
+        self.assertEquals({}, self.index._changes)
+
+
+class TestIndexedS3Target(unittest.TestCase):
+
+    @mock_s3
+    @mock.patch('mortar.luigi.tokenindex.get_token_index')
+    def test_write_and_remove_tokens(self, get_token_index):
+        index = tokenindex.TokenIndex()
+        get_token_index.return_value = index
+        client = S3Client(AWS_ACCESS_KEY, AWS_SECRET_KEY)
+        client.s3.create_bucket('bucket')
+        client.put_string('done', 's3://bucket/tokens/Existing')
+
+        existing = tokenindex.IndexedS3Target('s3://bucket/tokens/Existing', client=client)
+        new = tokenindex.IndexedS3Target('s3://bucket/tokens/New', client=client)
+        self.assertTrue(existing.exists())
+        self.assertFalse(new.exists())
+
+        target_factory.write_file(new)
+        self.assertTrue(new.exists())
+        new.remove()
+        self.assertFalse(new.exists())
+        self.assertEquals(1, index.listings)
+
+    @mock.patch('luigi.s3.S3Client')
+    @mock.patch('mortar.luigi.target_factory.luigi.configuration')
+    def test_get_token_target(self, configuration, s3_client):
+        configuration.get_config.return_value.has_option.return_value = False
+        self.assertTrue(isinstance(target_factory.get_token_target('s3://bucket/tokens/Task'),
+                                   tokenindex.IndexedS3Target))
+        configuration.get_config.return_value.has_option.side_effect = \
+            lambda section, option: option == 'token_index'
+        configuration.get_config.return_value.getboolean.return_value = False
+        self.assertFalse(isinstance(target_factory.get_token_target('s3://bucket/tokens/Task'),
+                                    tokenindex.IndexedS3Target))
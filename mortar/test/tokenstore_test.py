@@ -0,0 +1,217 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import mock
+from luigi.s3 import S3Client
+from moto import mock_s3
+
+from mortar.luigi import target_factory
+from mortar.luigi import tokenstore
+
+AWS_ACCESS_KEY = "XXXXXX"
+AWS_SECRET_KEY = "XXXXXX"
+
+class TestSplitStorePath(unittest.TestCase):
+
+    def test_split(self):
+        self.assertEquals(('/var/luigi/tokens.db', 'MyTask'),
+            tokenstore.split_store_path('sqlite:///var/luigi/tokens.db/MyTask', 'sqlite://', '.db'))
+        self.assertEquals(('bucket/p.tokens', 'fingerprints/abc'),
+            tokenstore.split_store_path('s3tokens://bucket/p.tokens/fingerprints/abc', 's3tokens://', '.tokens'))
+
+    def test_no_store(self):
+        self.assertRaises(RuntimeError, tokenstore.split_store_path,
+                          'sqlite:///var/luigi/MyTask', 'sqlite://', '.db')
+        self.assertRaises(RuntimeError, tokenstore.split_store_path,
+                          'sqlite:///var/luigi/tokens.db', 'sqlite://', '.db')
+
+class TestSqliteTokenStore(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.store = tokenstore.SqliteTokenStore(os.path.join(self.tmp_dir, 'sub', 'tokens.db'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_write_read_remove(self):
+        self.assertFalse(self.store.exists('A'))
+        self.store.write('A', 'job-1')
+        self.assertTrue(self.store.exists('A'))
+        self.assertEquals('job-1', self.store.read('A'))
+        self.store.write('A', 'job-2')
+        self.assertEquals('job-2', self.store.read('A'))
+        self.store.remove('A')
+        self.assertFalse(self.store.exists('A'))
+        self.assertEquals(None, self.store.read('A'))
+
+    def test_exists_many(self):
+        names = ['Task%s' % i for i in range(2500)]
+        self.store.append([(name, 'done') for name in names[::2]])
+        exists = self.store.exists_many(names)
+        self.assertEquals(1250, sum(exists.values()))
+        self.assertTrue(exists['Task0'])
+        self.assertFalse(exists['Task1'])
+
+    def test_compact(self):
+        self.store.write('A', '1')
+        self.store.write('A', '2')
+        self.store.write('B', '1')
+        self.store.remove('B')
+        self.store.compact()
+        conn = self.store._connect()
+        self.assertEquals([('A', '2')], conn.execute('SELECT name, text FROM tokens').fetchall())
+        conn.close()
+
+class TestTokenStoreTargets(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        target_factory.clear_cache()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+        target_factory.clear_cache()
+
+    def test_sqlite_targets(self):
+        path = 'sqlite://%s/tokens.db/MyTask' % self.tmp_dir
+        target = target_factory.get_target(path)
+        self.assertFalse(target.exists())
+        target_factory.write_file(target, text='job-1')
+        self.assertTrue(target_factory.get_token_target(path).exists())
+        self.assertEquals('job-1', target.open('r').read().strip())
+        other = target_factory.get_target('sqlite://%s/tokens.db/Other' % self.tmp_dir)
+        self.assertEquals([True, False], tokenstore.exists_many([target, other]))
+        target.remove()
+        self.assertFalse(target.exists())
+        self.assertRaises(IOError, target.open, 'r')
+
+    def test_failed_write_appends_nothing(self):
+        target = target_factory.get_target('sqlite://%s/tokens.db/MyTask' % self.tmp_dir)
+        try:
+            with target.open('w') as f:
+                f.write('partial')
+                raise ValueError()
+        except ValueError:
+            pass
+        self.assertFalse(target.exists())
+
+class TestS3SegmentTokenStore(unittest.TestCase):
+
+    @mock_s3
+    def test_segments(self):
+        client = S3Client(AWS_ACCESS_KEY, AWS_SECRET_KEY)
+        client.s3.create_bucket('bucket')
+        writer = tokenstore.S3SegmentTokenStore('s3://bucket/p.tokens', client=client)
+        writer.append([('A', 'done'), ('B', 'done')])
+        writer.remove('B')
+
+        reader = tokenstore.S3SegmentTokenStore('s3://bucket/p.tokens', client=client)
+        self.assertEquals({'A': True, 'B': False, 'C': False}, reader.exists_many(['A', 'B', 'C']))
+        self.assertEquals(2, reader.segment_reads)
+
+        writer.write('C', 'done')
+        self.assertFalse(reader.exists('C'))
+        reader.refresh()
+        self.assertTrue(reader.exists('C'))
+        self.assertEquals(3, reader.segment_reads)
+
+        self.assertEquals(3, writer.compact(grace_seconds=0))
+        self.assertEquals(1, len(list(client.list('s3://bucket/p.tokens'))))
+        reader.refresh()
+        self.assertEquals({'A': True, 'B': False, 'C': True}, reader.exists_many(['A', 'B', 'C']))
+        fresh = tokenstore.S3SegmentTokenStore('s3://bucket/p.tokens', client=client)
+        self.assertEquals('done', fresh.read('C'))
+        self.assertEquals(1, fresh.segment_reads)
+
+    @mock_s3
+    def test_compaction_keeps_merged_segments_for_grace_period(self):
+        client = S3Client(AWS_ACCESS_KEY, AWS_SECRET_KEY)
+        client.s3.create_bucket('bucket')
+        writer = tokenstore.S3SegmentTokenStore('s3://bucket/p.tokens', client=client)
+        writer.write('A', 'done')
+        writer.write('B', 'done')
+        reader = tokenstore.S3SegmentTokenStore('s3://bucket/p.tokens', client=client)
+        reader.refresh()
+
+        self.assertEquals(2, writer.compact())
+        self.assertEquals(3, len(list(client.list('s3://bucket/p.tokens'))))
+        self.assertEquals(0, writer.compact())
+        self.assertEquals(3, len(list(client.list('s3://bucket/p.tokens'))))
+
+        later = time.time() + tokenstore.DEFAULT_COMPACTION_GRACE_SECONDS + 60
+        with mock.patch.object(tokenstore.time, 'time', return_value=later):
+            self.assertEquals(0, writer.compact())
+        self.assertEquals(1, len(list(client.list('s3://bucket/p.tokens'))))
+        reader.refresh()
+        self.assertEquals({'A': True, 'B': True}, reader.exists_many(['A', 'B']))
+
+    @mock_s3
+    def test_later_appends_win_regardless_of_clock(self):
+        client = S3Client(AWS_ACCESS_KEY, AWS_SECRET_KEY)
+        client.s3.create_bucket('bucket')
+        first = tokenstore.S3SegmentTokenStore('s3://bucket/p.tokens', client=client)
+        second = tokenstore.S3SegmentTokenStore('s3://bucket/p.tokens', client=client)
+        with mock.patch.object(tokenstore.time, 'time', return_value=2000000000):
+            first.write('A', 'first')
+        with mock.patch.object(tokenstore.time, 'time', return_value=1000000000):
+            second.write('A', 'second')
+        first.refresh()
+        self.assertEquals('second', first.read('A'))
+        fresh = tokenstore.S3SegmentTokenStore('s3://bucket/p.tokens', client=client)
+        self.assertEquals('second', fresh.read('A'))
+
+    @mock_s3
+    def test_lists_again_when_segment_disappears(self):
+        client = S3Client(AWS_ACCESS_KEY, AWS_SECRET_KEY)
+        client.s3.create_bucket('bucket')
+        writer = tokenstore.S3SegmentTokenStore('s3://bucket/p.tokens', client=client)
+        writer.write('A', 'done')
+        writer.write('B', 'done')
+        reader = tokenstore.S3SegmentTokenStore('s3://bucket/p.tokens', client=client)
+        list_keys = reader._list_keys
+        listings = []
+        def stale_list_keys():
+            listed = list_keys()
+            if not listings:
+                # compacted by another process right after this listing
+                writer.compact(grace_seconds=0)
+            listings.append(listed)
+            return listed
+        with mock.patch.object(reader, '_list_keys', side_effect=stale_list_keys):
+            self.assertEquals({'A': True, 'B': True}, reader.exists_many(['A', 'B']))
+        self.assertEquals(2, len(listings))
+
+    @mock_s3
+    def test_lists_again_after_ttl(self):
+        client = S3Client(AWS_ACCESS_KEY, AWS_SECRET_KEY)
+        client.s3.create_bucket('bucket')
+        reader = tokenstore.S3SegmentTokenStore('s3://bucket/p.tokens', client=client, ttl=60)
+        self.assertFalse(reader.exists('A'))
+        writer = tokenstore.S3SegmentTokenStore('s3://bucket/p.tokens', client=client)
+        writer.write('A', 'done')
+        self.assertFalse(reader.exists('A'))
+        with mock.patch.object(tokenstore.time, 'time', return_value=time.time() + 61):
+            self.assertTrue(reader.exists('A'))
+        self.assertEquals(1, reader.segment_reads)
+
+    def test_uses_shared_client(self):
+        client = S3Client(AWS_ACCESS_KEY, AWS_SECRET_KEY)
+        with mock.patch.object(target_factory, 'get_s3_client', return_value=client):
+            self.assertTrue(tokenstore.S3SegmentTokenStore('s3://bucket/p.tokens')._client() is client)
+
+    @mock_s3
+    def test_refresh_target(self):
+        client = S3Client(AWS_ACCESS_KEY, AWS_SECRET_KEY)
+        client.s3.create_bucket('bucket')
+        store = tokenstore.S3SegmentTokenStore('s3://bucket/p.tokens', client=client)
+        target = tokenstore.TokenStoreTarget('s3tokens://bucket/p.tokens/Running', store, 'Running')
+        self.assertFalse(target.exists())
+        other = tokenstore.S3SegmentTokenStore('s3://bucket/p.tokens', client=client)
+        other.write('Running', 'job-1')
+        self.assertFalse(target.exists())
+        target_factory.refresh(target)
+        self.assertTrue(target.exists())